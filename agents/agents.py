@@ -3,26 +3,70 @@
 Este módulo implementa un chatbot conversacional inteligente que usa Groq
 para procesar lenguaje natural y gestionar goals/métricas/leaderboard.
 """
+import asyncio
 import json
 import re
+import time
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from groq import Groq
 
+try:
+    from groq import AsyncGroq
+except ImportError:
+    AsyncGroq = None
+
 from config import config
 from api_client import api_client
-from database import (
-    get_whatsapp_user, 
-    create_or_update_whatsapp_user,
-    get_pending_action,
-    set_pending_action,
-    clear_pending_action,
-    save_conversation,
-    get_recent_conversations
-)
-
-# Cliente Groq
+from command_router import command_router
+from prefetch import prefetcher
+from user_state import user_state
+from context_cache import context_cache
+from conversation_log import conversation_log
+from webapp_outbox import webapp_outbox
+
+# Acciones que solo escriben y no dependen de otras: en un mensaje con varias
+# acciones se ejecutan a la vez. El resto (lecturas, goals) va en orden.
+INDEPENDENT_ACTIONS = {"ADD_METRIC_USERS", "ADD_METRIC_REVENUE", "ADD_ACHIEVEMENT"}
+
+# Máximo de acciones que se ejecutan de un solo mensaje
+MAX_ACTIONS_PER_MESSAGE = 6
+
+# Se añade a la confirmación si la webapp no respondió a tiempo
+PENDING_WRITE_NOTE = "\n\n⏳ La webapp va lenta: lo guardo en cuanto responda."
+
+
+def intent_actions(intent: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Normaliza un intent (una acción o lista "actions") a una lista ordenada"""
+    actions = intent.get("actions")
+    if isinstance(actions, list):
+        actions = [a for a in actions if isinstance(a, dict) and a.get("action")]
+        if actions:
+            return [
+                {"action": a["action"], "params": a.get("params") or {}}
+                for a in actions[:MAX_ACTIONS_PER_MESSAGE]
+            ]
+    return [{"action": intent.get("action", "CHAT"), "params": intent.get("params") or {}}]
+
+
+def plan_stages(actions: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Agrupa las acciones en etapas: las independientes consecutivas comparten
+    etapa (se ejecutan en paralelo); cada acción dependiente es su propia etapa.
+    """
+    stages: List[List[Dict[str, Any]]] = []
+    for item in actions:
+        if item["action"] in INDEPENDENT_ACTIONS and stages and stages[-1][0]["action"] in INDEPENDENT_ACTIONS:
+            stages[-1].append(item)
+        else:
+            stages.append([item])
+    return stages
+
+
+# Cliente Groq. El async se usa siempre que el SDK lo tenga; el sync queda
+# como fallback y se ejecuta en un thread para no bloquear el event loop.
 groq_client = Groq(api_key=config.GROQ_API_KEY)
+async_groq_client = AsyncGroq(api_key=config.GROQ_API_KEY) if AsyncGroq else None
 
 
 class ConversationalAgent:
@@ -30,6 +74,9 @@ class ConversationalAgent:
     
     def __init__(self):
         self.model = config.GROQ_MODEL
+        self.timeout = config.GROQ_TIMEOUT
+        # Limita las llamadas simultáneas a Groq entre todos los usuarios
+        self._llm_semaphore = asyncio.Semaphore(config.GROQ_MAX_CONCURRENCY)
         self.system_prompt = """Eres un asistente de productividad para LovableGrowth. Responde en español.
 
 IMPORTANTE - DIFERENCIA ENTRE GOALS Y MÉTRICAS:
@@ -64,18 +111,39 @@ ACCIONES DISPONIBLES:
 FORMATO DE RESPUESTA (siempre JSON):
 {"action": "NOMBRE", "params": {...}, "response": "texto si es CHAT"}
 
+SI EL MENSAJE PIDE VARIAS COSAS, devuelve una lista ordenada de acciones:
+{"actions": [{"action": "NOMBRE", "params": {...}}, ...], "response": "texto si hay CHAT"}
+Ejemplo: "completé el goal 2, tengo 80 usuarios y 3000 de revenue" →
+{"actions": [{"action": "COMPLETE_GOAL", "params": {"goal_index": 2}}, {"action": "ADD_METRIC_USERS", "params": {"value": 80}}, {"action": "ADD_METRIC_REVENUE", "params": {"value": 3000}}]}
+
 Sé conciso y amigable. Usa emojis con moderación."""
 
-    def _call_groq(self, messages: list) -> str:
-        """Llama a Groq API"""
+    async def _complete(self, messages: list) -> str:
+        """Hace la llamada a Groq sin bloquear el event loop"""
+        kwargs = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 500
+        }
+        if async_groq_client is not None:
+            response = await async_groq_client.chat.completions.create(**kwargs)
+        else:
+            response = await asyncio.to_thread(groq_client.chat.completions.create, **kwargs)
+        return response.choices[0].message.content
+    
+    async def _call_groq(self, messages: list) -> str:
+        """Llama a Groq API (con límite de concurrencia y timeout)"""
         try:
-            response = groq_client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=500
-            )
-            return response.choices[0].message.content
+            async with self._llm_semaphore:
+                return await asyncio.wait_for(self._complete(messages), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            print(f"Timeout llamando a Groq ({self.timeout}s)")
+            return json.dumps({
+                "action": "CHAT",
+                "params": {},
+                "response": "Lo siento, estoy tardando demasiado en responder. ¿Puedes intentarlo de nuevo?"
+            })
         except Exception as e:
             print(f"Error llamando a Groq: {e}")
             return json.dumps({
@@ -84,14 +152,14 @@ Sé conciso y amigable. Usa emojis con moderación."""
                 "response": "Lo siento, tuve un problema procesando tu mensaje. ¿Puedes intentarlo de nuevo?"
             })
     
-    def parse_intent(self, message: str, context: str = "") -> Dict[str, Any]:
+    async def parse_intent(self, message: str, context: str = "") -> Dict[str, Any]:
         """Analiza la intención del mensaje usando Groq"""
         messages = [
             {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": f"Contexto previo: {context}\n\nMensaje del usuario: {message}"}
         ]
         
-        response = self._call_groq(messages)
+        response = await self._call_groq(messages)
         
         # Intentar parsear JSON
         try:
@@ -111,7 +179,7 @@ Sé conciso y amigable. Usa emojis con moderación."""
                 "response": response
             }
     
-    def generate_response(self, context: str, data: Any, action_type: str) -> str:
+    async def generate_response(self, context: str, data: Any, action_type: str) -> str:
         """Genera una respuesta conversacional basada en los datos"""
         prompt = f"""Genera una respuesta conversacional y amigable basada en:
 
@@ -127,7 +195,25 @@ NO uses formato JSON, solo el texto de respuesta."""
             {"role": "user", "content": prompt}
         ]
         
-        return self._call_groq(messages)
+        return await self._call_groq(messages)
+
+
+def _find_goal(active: List[Dict[str, Any]], description: str) -> Optional[Dict[str, Any]]:
+    """Primer goal activo cuya descripción contiene el texto"""
+    if not description:
+        return None
+    for g in active:
+        if description.lower() in g["description"].lower():
+            return g
+    return None
+
+
+def _which_goal_prompt(active: List[Dict[str, Any]]) -> str:
+    text = "¿Cuál goal completaste? Tus goals activos son:\n\n"
+    for i, g in enumerate(active, 1):
+        text += f"{i}. {g['description']}\n"
+    text += "\nDime el número o el nombre del goal."
+    return text
 
 
 class ChatOrchestrator:
@@ -136,43 +222,169 @@ class ChatOrchestrator:
     def __init__(self):
         self.agent = ConversationalAgent()
     
-    async def process_message(self, phone_number: str, message: str) -> str:
-        """Procesa un mensaje y genera respuesta"""
+    async def process_burst(self, phone_number: str, messages: List[str], message_sids: List[str] = None, logged: bool = False) -> str:
+        """
+        Procesa varios mensajes seguidos del mismo número como un solo turno.
+        
+        Para usuarios verificados se unen en un único mensaje (una sola llamada
+        a parse_intent). El flujo de autenticación es paso a paso, así que ahí
+        se procesan en orden y se devuelve la última respuesta.
+        """
+        message_sids = message_sids or [None] * len(messages)
+        if len(messages) == 1:
+            return await self.process_message(phone_number, messages[0], message_sids, logged)
+        
+        user = await user_state.get_user(phone_number)
+        if user and user.is_verified:
+            return await self.process_message(phone_number, "\n".join(messages), message_sids, logged)
+        
+        response = ""
+        for message, sid in zip(messages, message_sids):
+            response = await self.process_message(phone_number, message, [sid], logged)
+        return response
+    
+    async def process_message(self, phone_number: str, message: str, message_sids: List[str] = None, logged: bool = False) -> str:
+        """
+        Procesa un mensaje y genera respuesta.
+        
+        Si el mensaje ya lo registró la cola de entrada (`logged`), aquí solo
+        se le añade el intent por su MessageSid. La respuesta la registra quien
+        la envía.
+        """
         
         # Obtener usuario
-        user = get_whatsapp_user(phone_number)
-        pending = get_pending_action(phone_number)
+        user, pending = await user_state.get(phone_number)
         
         # Si no autenticado, manejar auth
         if not user or not user.is_verified:
             return await self._handle_auth(phone_number, message, pending)
         
-        # Guardar mensaje en conversación
-        save_conversation(phone_number, message, "inbound")
+        # Comandos conocidos se resuelven sin LLM
+        prefetch = None
+        intent = command_router.match(message)
+        if intent is None:
+            # Obtener contexto de conversaciones recientes
+            # (sin los mensajes de este turno, que ya están registrados)
+            current = set(sid for sid in (message_sids or []) if sid)
+            recent = await context_cache.get_recent(phone_number, limit=5 + len(message_sids or []))
+            if logged:
+                # Sin MessageSid se reconocen por el texto
+                recent = [c for c in recent if not (c.direction == "inbound" and (c.message_sid in current if c.message_sid else c.message in message))]
+            recent = recent[:5]
+            context = "\n".join([f"{'Usuario' if c.direction == 'inbound' else 'Asistente'}: {c.message}" for c in reversed(recent)]) if recent else ""
+            
+            # Adelantar la lectura probable mientras Groq analiza la intención
+            recent_intents = [c.intent for c in recent if c.direction == "inbound" and c.intent]
+            prefetch = prefetcher.start(message, recent_intents, user.auth_token, user.user_id)
+            
+            # Analizar intención con Groq
+            start = time.perf_counter()
+            intent = await self.agent.parse_intent(message, context)
+            command_router.record_llm((time.perf_counter() - start) * 1000)
+        actions = intent_actions(intent)
+        
+        # Registrar el intent del mensaje (para entrenar el router)
+        label = "+".join(a["action"] for a in actions)
+        if logged:
+            conversation_log.tag_intent(phone_number, message_sids, label)
+        else:
+            conversation_log.log(phone_number, message, "inbound", intent=label)
         
-        # Obtener contexto de conversaciones recientes
-        recent = get_recent_conversations(phone_number, limit=5)
-        context = "\n".join([f"{'Usuario' if c.direction == 'inbound' else 'Asistente'}: {c.message}" for c in reversed(recent)]) if recent else ""
+        # Ejecutar acción(es)
+        try:
+            if len(actions) == 1:
+                response = await self._execute_action(actions[0]["action"], actions[0]["params"], user.auth_token, intent, user.user_id, prefetch, phone_number)
+            else:
+                response = await self._execute_actions(actions, user.auth_token, intent, user.user_id, prefetch, phone_number)
+        finally:
+            prefetcher.finish(prefetch)
         
-        # Analizar intención con Groq
-        intent = self.agent.parse_intent(message, context)
-        action = intent.get("action", "CHAT")
-        params = intent.get("params", {})
+        return response
+    
+    async def _execute_actions(
+        self,
+        actions: List[Dict[str, Any]],
+        auth_token: str,
+        intent: dict,
+        user_id: int = None,
+        prefetch=None,
+        phone_number: str = None
+    ) -> str:
+        """
+        Ejecuta varias acciones de un mismo mensaje y devuelve una sola respuesta.
         
-        # Ejecutar acción
-        response = await self._execute_action(action, params, user.auth_token, intent)
+        Las escrituras independientes se lanzan a la vez; las demás se ejecutan
+        en el orden en que las pidió el usuario.
+        """
+        await self._resolve_goal_indices(actions, auth_token, prefetch)
         
-        # Guardar respuesta
-        save_conversation(phone_number, response, "outbound")
+        replies: List[str] = []
+        for stage in plan_stages(actions):
+            if len(stage) == 1:
+                replies.append(await self._execute_action(stage[0]["action"], stage[0]["params"], auth_token, intent, user_id, prefetch, phone_number))
+            else:
+                replies.extend(await asyncio.gather(*[
+                    self._execute_action(item["action"], item["params"], auth_token, intent, user_id, prefetch, phone_number)
+                    for item in stage
+                ]))
         
-        return response
+        return "\n\n".join(reply for reply in replies if reply)
     
-    async def _execute_action(self, action: str, params: dict, auth_token: str, intent: dict) -> str:
+    async def _resolve_goal_indices(self, actions: List[Dict[str, Any]], auth_token: str, prefetch=None):
+        """
+        Fija qué goal corresponde a cada COMPLETE_GOAL antes de completar ninguno.
+        
+        Los números se refieren a la lista que vio el usuario; si se resolvieran
+        uno a uno, completar el goal 1 desplazaría el número del goal 2.
+        """
+        completes = [a for a in actions if a["action"] == "COMPLETE_GOAL" and a["params"].get("goal_index")]
+        if not completes:
+            return
+        
+        try:
+            result = await prefetcher.fetch(prefetch, "goals", api_client.get_goals, auth_token)
+        except Exception as e:
+            print(f"Error obteniendo goals: {e}")
+            return
+        active = [g for g in result.get("goals", []) if g.get("status") == "active"]
+        if not active:
+            return
+        
+        for item in completes:
+            try:
+                goal_index = int(item["params"]["goal_index"])
+            except (TypeError, ValueError):
+                goal_index = 0
+            goal = active[goal_index - 1] if 1 <= goal_index <= len(active) else _find_goal(active, item["params"].get("description", ""))
+            if goal:
+                item["params"] = {"goal_id": goal["id"], "description": goal["description"]}
+            else:
+                # Número fuera de la lista: se pregunta con la lista que vio el usuario
+                item["params"] = {"prompt": _which_goal_prompt(active)}
+    
+    async def _write(self, phone_number: str, auth_token: str, operation: str, payload: Dict[str, Any]) -> str:
+        """
+        Escritura en la webapp a través del outbox. Devuelve la nota para la
+        respuesta: vacía si ya está aplicada, PENDING_WRITE_NOTE si sigue en cola.
+        """
+        applied = await webapp_outbox.submit(phone_number, auth_token, operation, payload)
+        return "" if applied else PENDING_WRITE_NOTE
+    
+    async def _execute_action(
+        self,
+        action: str,
+        params: dict,
+        auth_token: str,
+        intent: dict,
+        user_id: int = None,
+        prefetch=None,
+        phone_number: str = None
+    ) -> str:
         """Ejecuta la acción detectada"""
         
         try:
             if action == "LIST_GOALS":
-                result = await api_client.get_goals(auth_token)
+                result = await prefetcher.fetch(prefetch, "goals", api_client.get_goals, auth_token)
                 goals = result.get("goals", [])
                 
                 if not goals:
@@ -189,6 +401,10 @@ class ChatOrchestrator:
                 if completed:
                     text += f"\n✅ Completados: {len(completed)}"
                 
+                pending = webapp_outbox.pending_count(phone_number)
+                if pending:
+                    text += f"\n⏳ {pending} cambio(s) pendientes de guardar en la webapp"
+                
                 text += "\n\n¿Quieres completar alguno o añadir uno nuevo?"
                 return text
             
@@ -197,14 +413,21 @@ class ChatOrchestrator:
                 if not desc:
                     return "¿Cuál es el goal que quieres crear? Descríbemelo 📝"
                 
-                await api_client.create_goal(auth_token, desc)
-                return f"✅ ¡Goal creado!\n\n📌 \"{desc}\"\n\n¡A por ello! 💪 Avísame cuando lo completes."
+                note = await self._write(phone_number, auth_token, "create_goal", {"description": desc})
+                return f"✅ ¡Goal creado!\n\n📌 \"{desc}\"\n\n¡A por ello! 💪 Avísame cuando lo completes.{note}"
             
             elif action == "COMPLETE_GOAL":
                 goal_index = params.get("goal_index")
                 goal_desc = params.get("description", "")
                 
-                result = await api_client.get_goals(auth_token)
+                # Goal ya resuelto (mensaje con varias acciones)
+                if params.get("prompt"):
+                    return params["prompt"]
+                if params.get("goal_id"):
+                    note = await self._write(phone_number, auth_token, "complete_goal", {"goal_id": params["goal_id"]})
+                    return f"🎉 ¡Felicidades!\n\n✅ Completaste: \"{goal_desc}\"\n\n¡Tu ranking puede haber subido! 📈 ¿Qué más vas a conquistar?{note}"
+                
+                result = await prefetcher.fetch(prefetch, "goals", api_client.get_goals, auth_token)
                 active = [g for g in result.get("goals", []) if g.get("status") == "active"]
                 
                 if not active:
@@ -214,22 +437,14 @@ class ChatOrchestrator:
                 
                 if goal_index and 1 <= goal_index <= len(active):
                     goal_to_complete = active[goal_index - 1]
-                elif goal_desc:
-                    # Buscar por descripción
-                    for g in active:
-                        if goal_desc.lower() in g["description"].lower():
-                            goal_to_complete = g
-                            break
+                else:
+                    goal_to_complete = _find_goal(active, goal_desc)
                 
                 if goal_to_complete:
-                    await api_client.complete_goal(auth_token, goal_to_complete["id"])
-                    return f"🎉 ¡Felicidades!\n\n✅ Completaste: \"{goal_to_complete['description']}\"\n\n¡Tu ranking puede haber subido! 📈 ¿Qué más vas a conquistar?"
+                    note = await self._write(phone_number, auth_token, "complete_goal", {"goal_id": goal_to_complete["id"]})
+                    return f"🎉 ¡Felicidades!\n\n✅ Completaste: \"{goal_to_complete['description']}\"\n\n¡Tu ranking puede haber subido! 📈 ¿Qué más vas a conquistar?{note}"
                 else:
-                    text = "¿Cuál goal completaste? Tus goals activos son:\n\n"
-                    for i, g in enumerate(active, 1):
-                        text += f"{i}. {g['description']}\n"
-                    text += "\nDime el número o el nombre del goal."
-                    return text
+                    return _which_goal_prompt(active)
             
             elif action == "ADD_METRIC_USERS":
                 value = params.get("value")
@@ -237,8 +452,12 @@ class ChatOrchestrator:
                     return "¿Cuántos usuarios tienes ahora? Dame el número 👥"
                 
                 today = datetime.now().strftime("%Y-%m-%d")
-                await api_client.add_metric(auth_token, "users", float(value), today)
-                return f"📊 ¡Registrado!\n\n👥 Usuarios: {value}\n📅 {today}\n\n¡Sigue creciendo! 🚀"
+                note = await self._write(phone_number, auth_token, "add_metric", {
+                    "metric_name": "users",
+                    "metric_value": float(value),
+                    "recorded_date": today
+                })
+                return f"📊 ¡Registrado!\n\n👥 Usuarios: {value}\n📅 {today}\n\n¡Sigue creciendo! 🚀{note}"
             
             elif action == "ADD_METRIC_REVENUE":
                 value = params.get("value")
@@ -246,11 +465,15 @@ class ChatOrchestrator:
                     return "¿Cuánto revenue tienes? Dame el número 💰"
                 
                 today = datetime.now().strftime("%Y-%m-%d")
-                await api_client.add_metric(auth_token, "revenue", float(value), today)
-                return f"📊 ¡Registrado!\n\n💰 Revenue: ${value}\n📅 {today}\n\n¡El dinero está entrando! 🎉"
+                note = await self._write(phone_number, auth_token, "add_metric", {
+                    "metric_name": "revenue",
+                    "metric_value": float(value),
+                    "recorded_date": today
+                })
+                return f"📊 ¡Registrado!\n\n💰 Revenue: ${value}\n📅 {today}\n\n¡El dinero está entrando! 🎉{note}"
             
             elif action == "VIEW_LEADERBOARD":
-                result = await api_client.get_leaderboard(auth_token)
+                result = await prefetcher.fetch(prefetch, "leaderboard", api_client.get_leaderboard, auth_token, user_id)
                 leaderboard = result.get("leaderboard", [])
                 
                 if not leaderboard:
@@ -276,11 +499,11 @@ class ChatOrchestrator:
                     return "🏆 ¿Qué logro conseguiste? Cuéntame 👀"
                 
                 today = datetime.now().strftime("%Y-%m-%d")
-                await api_client.add_achievement(auth_token, today, desc)
-                return f"🏆 ¡Logro registrado!\n\n\"{desc}\"\n\n¡Eres increíble! 💪"
+                note = await self._write(phone_number, auth_token, "add_achievement", {"date": today, "description": desc})
+                return f"🏆 ¡Logro registrado!\n\n\"{desc}\"\n\n¡Eres increíble! 💪{note}"
             
             elif action == "VIEW_METRICS":
-                result = await api_client.get_metrics_history(auth_token)
+                result = await prefetcher.fetch(prefetch, "metrics", api_client.get_metrics_history, auth_token)
                 history = result.get("metricsHistory", [])
                 
                 if not history:
@@ -310,7 +533,7 @@ class ChatOrchestrator:
         """Maneja el flujo de autenticación"""
         
         if not pending:
-            set_pending_action(phone_number, "AUTH_EMAIL")
+            await user_state.set_pending(phone_number, "AUTH_EMAIL")
             return """🎯 *¡Hola! Soy tu asistente de LovableGrowth*
 
 Te ayudaré a gestionar tus goals, métricas y más directamente desde WhatsApp.
@@ -325,7 +548,7 @@ Para empezar, necesito vincular tu cuenta.
             if "@" not in email or "." not in email:
                 return "Hmm, eso no parece un email válido. ¿Puedes verificarlo? 📧"
             
-            set_pending_action(phone_number, "AUTH_CODE", json.dumps({"email": email}))
+            await user_state.set_pending(phone_number, "AUTH_CODE", json.dumps({"email": email}))
             
             return f"""📧 Perfecto: {email}
 
@@ -360,14 +583,14 @@ Para empezar, necesito vincular tu cuenta.
                 
                 if result and result.get("token"):
                     # Éxito
-                    create_or_update_whatsapp_user(
+                    await user_state.save_user(
                         phone_number=phone_number,
                         user_id=result.get("user", {}).get("id"),
                         auth_token=result.get("token"),
                         email=email,
                         is_verified=True
                     )
-                    clear_pending_action(phone_number)
+                    await user_state.clear_pending(phone_number)
                     
                     name = result.get("user", {}).get("name", email.split("@")[0])
                     
@@ -391,8 +614,7 @@ Ahora puedes hablarme naturalmente:
                 return "❌ Hubo un error verificando el código.\n\nGenera uno nuevo en la app web e intenta de nuevo."
         
         # Fallback
-        clear_pending_action(phone_number)
-        set_pending_action(phone_number, "AUTH_EMAIL")
+        await user_state.set_pending(phone_number, "AUTH_EMAIL")
         return "Parece que hubo un problema. Empecemos de nuevo.\n\n📧 ¿Cuál es tu email registrado?"
 
 
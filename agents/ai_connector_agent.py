@@ -25,6 +25,9 @@ from agno.tools import tool
 # OpenAI
 import openai
 
+# Índice local de inversores (directorio de VCs)
+from investor_index import get_investor_index, parse_ticket
+
 
 @dataclass
 class AIConnectorConfig:
@@ -460,6 +463,61 @@ Respond with ONLY one word: INVESTOR or ENTREPRENEUR
         
         return sorted(matches, key=lambda x: x['score'], reverse=True)
     
+    def _find_directory_investors(
+        self,
+        current_user: Dict[str, Any],
+        search_criteria: Dict[str, Any],
+        top_k: int = 5
+    ) -> List[Dict[str, Any]]:
+        """
+        Find investors in the local VC directory using the extracted criteria
+        """
+        index = get_investor_index()
+        if index is None:
+            return []
+        
+        keywords = search_criteria.get('keywords') or []
+        query = " ".join([
+            " ".join(keywords) if isinstance(keywords, list) else str(keywords),
+            search_criteria.get('industry') or current_user.get('industry') or '',
+            current_user.get('bio') or ''
+        ])
+        
+        results = index.search(
+            query=query,
+            stage=search_criteria.get('stage') or current_user.get('stage'),
+            industry=search_criteria.get('industry') or current_user.get('industry'),
+            geography=search_criteria.get('location'),
+            ticket_usd=parse_ticket(
+                search_criteria.get('ticket_usd') or search_criteria.get('ticket') or search_criteria.get('amount')
+            ),
+            top_k=top_k
+        )
+        
+        matches = []
+        for r in results:
+            reasons = [f"💰 Fondo: {r.get('stage') or 'multi-stage'}"]
+            if r.get('sectors'):
+                reasons.append(f"🎯 Sectores: {r['sectors']}")
+            if r.get('geography'):
+                reasons.append(f"🌍 {r['geography']}")
+            matches.append({
+                "id": f"vc_{r['id']}",
+                "name": r.get('name'),
+                "score": min(100, 60 + int(r.get('relevance', 0) * 40)),
+                "reason": " • ".join(reasons),
+                "conversation_starters": [],
+                "user_type": "investor",
+                "industry": r.get('sectors'),
+                "stage": r.get('stage'),
+                "country": r.get('country'),
+                "avatar_url": None,
+                "bio": r.get('description') or '',
+                "ai_detected": False,
+                "source": "vc_directory"
+            })
+        return matches
+    
     def _stage_value(self, stage: str) -> int:
         """Convert stage to numeric value for comparison"""
         stages = {
@@ -547,6 +605,11 @@ Respond with ONLY one word: INVESTOR or ENTREPRENEUR
                 potential_matches=available_users,
                 search_criteria=search_criteria
             )
+            
+            # Sin inversores en la plataforma: sugerir fondos del directorio local
+            if not matches and 'invest' in (search_criteria.get('target_type') or '').lower():
+                matches = self._find_directory_investors(session.get("user_context", {}), search_criteria)
+            
             session["suggested_connections"] = matches
             
             print(f"✓ Found {len(matches)} real matches from database")
@@ -684,6 +747,7 @@ Campos: target_type (entrepreneur/investor/validator/partner/mentor),
 industry (fintech/healthtech/edtech/saas/ecommerce/ai/blockchain/gaming/foodtech/proptech/agritech/cleantech/biotech/legaltech/hrtech/martech), 
 stage (idea/mvp/seed/series_a/series_b/growth/scale),
 location (país o región),
+ticket_usd (importe que busca levantar o invertir, en USD, número entero; omitir si no se menciona),
 keywords (array de palabras clave relevantes),
 looking_for (qué busca: funding/cofounder/validation/customers/talent/partner/mentor)"""
                     },
@@ -789,6 +853,11 @@ looking_for (qué busca: funding/cofounder/validation/customers/talent/partner/m
                 criteria['keywords'].extend([kw for kw in keywords if kw in message_lower])
                 break
         
+        # Ticket: solo importes con unidad o moneda ("500k", "$1M", "2 millones")
+        ticket = parse_ticket(message_lower, require_unit=True)
+        if ticket:
+            criteria['ticket_usd'] = ticket
+        
         # Extract location if mentioned
         countries = ['españa', 'mexico', 'colombia', 'argentina', 'chile', 'peru', 
                     'spain', 'usa', 'uk', 'brazil', 'france', 'germany']
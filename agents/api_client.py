@@ -1,14 +1,57 @@
 """
 Cliente HTTP para comunicarse con la API de la webapp
+
+Usa un único httpx.AsyncClient por proceso (keep-alive, HTTP/2 si `h2` está
+instalado) que se abre/cierra desde el lifespan de FastAPI. Los GET se
+reintentan con backoff exponencial + jitter; las escrituras nunca (las
+reintenta el outbox, `webapp_outbox.py`, con su cabecera Idempotency-Key).
+
+Los goals se cachean por token (invalidados por las escrituras de goals) y el
+leaderboard se cachea una sola vez para todos con TTL corto; el flag
+`is_current_user` se calcula localmente para cada usuario. Si el usuario no
+está en la lista compartida, su `current_user` (el que calcula la API) se
+cachea por token con el mismo TTL.
 """
+import asyncio
+import random
+import time
 import httpx
 from typing import Optional, List, Dict, Any
 from config import config
 
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Timeouts por endpoint (segundos). El resto usa DEFAULT_TIMEOUT.
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+ENDPOINT_TIMEOUTS = {
+    "/dashboard/leaderboard": httpx.Timeout(15.0, connect=5.0),
+    "/dashboard/admin/internal-dashboard": httpx.Timeout(20.0, connect=5.0),
+    "/auth/verify-whatsapp-code": httpx.Timeout(30.0, connect=5.0),
+}
+
+# Respuestas que merece la pena reintentar en un GET
+RETRYABLE_STATUS = {429, 502, 503, 504}
+
+# A partir de este tamaño se purgan las entradas expiradas de la caché de goals
+GOALS_CACHE_MAX_TOKENS = 1000
+
+
 class WebAppAPIClient:
     """Cliente para interactuar con la API de la webapp"""
-    
-    def __init__(self, base_url: str = None, auth_token: str = None):
+
+    def __init__(
+        self,
+        base_url: str = None,
+        auth_token: str = None,
+        max_connections: int = None,
+        max_keepalive: int = None,
+        max_retries: int = None,
+        http2: bool = None
+    ):
         raw_url = base_url or config.WEBAPP_API_URL
         # Asegurar que la URL termina en /api
         if not raw_url.endswith('/api'):
@@ -19,8 +62,150 @@ class WebAppAPIClient:
         else:
             self.base_url = raw_url
         self.auth_token = auth_token
-        print(f"API Client initialized with base_url: {self.base_url}")
-        
+
+        self.limits = httpx.Limits(
+            max_connections=max_connections or config.WEBAPP_MAX_CONNECTIONS,
+            max_keepalive_connections=max_keepalive or config.WEBAPP_MAX_KEEPALIVE,
+            keepalive_expiry=60.0
+        )
+        self.max_retries = config.WEBAPP_MAX_RETRIES if max_retries is None else max_retries
+        wants_http2 = config.WEBAPP_HTTP2 if http2 is None else http2
+        self.http2 = wants_http2 and HTTP2_AVAILABLE
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "errors": 0,
+            "total_latency_ms": 0.0,
+        }
+
+        # Caché de goals: token -> (expira_en, datos)
+        self.goals_ttl = config.GOALS_CACHE_TTL
+        self._goals_cache: Dict[str, tuple] = {}
+        self._goals_generation: Dict[str, int] = {}
+
+        # Caché global del leaderboard: (expira_en, datos)
+        self.leaderboard_ttl = config.LEADERBOARD_CACHE_TTL
+        self._leaderboard_cache: Optional[tuple] = None
+        self._leaderboard_generation = 0
+        self._leaderboard_lock = asyncio.Lock()
+        # current_user de la API por token: token -> (expira_en, datos)
+        self._current_user_cache: Dict[str, tuple] = {}
+
+        self._cache_stats = {
+            "goals_hits": 0,
+            "goals_misses": 0,
+            "leaderboard_hits": 0,
+            "leaderboard_misses": 0,
+        }
+        print(f"API Client initialized with base_url: {self.base_url} (http2={self.http2})")
+
+    # ------------------------------------------------------------------
+    # Ciclo de vida
+    # ------------------------------------------------------------------
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Devuelve el cliente compartido, creándolo si hace falta"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=self.limits,
+                timeout=DEFAULT_TIMEOUT,
+                http2=self.http2
+            )
+        return self._client
+
+    async def start(self):
+        """Abre el pool (llamado desde el lifespan de la app)"""
+        self._get_client()
+
+    async def aclose(self):
+        """Cierra el pool y sus conexiones keep-alive"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Estadísticas del pool de conexiones y de las peticiones hechas"""
+        connections = []
+        if self._client is not None and not self._client.is_closed:
+            # httpx no expone el pool públicamente; leemos el de httpcore si existe
+            pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []) or [])
+
+        requests = self._stats["requests"]
+        return {
+            "open": self._client is not None and not self._client.is_closed,
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "connections": len(connections),
+            "idle_connections": sum(1 for c in connections if c.is_idle()),
+            "requests": requests,
+            "retries": self._stats["retries"],
+            "errors": self._stats["errors"],
+            "avg_latency_ms": round(self._stats["total_latency_ms"] / requests, 2) if requests else 0.0,
+        }
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """Aciertos/fallos de las cachés de goals y leaderboard"""
+        return {
+            **self._cache_stats,
+            "goals_cached_tokens": len(self._goals_cache),
+            "leaderboard_cached": self._leaderboard_cache is not None,
+        }
+
+    # ------------------------------------------------------------------
+    # Caché
+    # ------------------------------------------------------------------
+
+    def invalidate_goals(self, auth_token: str):
+        """Descarta los goals cacheados de un token"""
+        self._goals_cache.pop(auth_token, None)
+        self._goals_generation[auth_token] = self._goals_generation.get(auth_token, 0) + 1
+
+    def invalidate_leaderboard(self):
+        """Descarta el leaderboard cacheado"""
+        self._leaderboard_cache = None
+        self._current_user_cache.clear()
+        self._leaderboard_generation += 1
+
+    def _with_current_user(self, data: Dict[str, Any], user_id: Optional[int]) -> Dict[str, Any]:
+        """Aplica el flag is_current_user sobre una copia del leaderboard compartido"""
+        leaderboard = [
+            {**entry, "is_current_user": user_id is not None and entry.get("user_id") == user_id}
+            for entry in data.get("leaderboard", [])
+        ]
+        current = next((e for e in leaderboard if e["is_current_user"]), None)
+        return {**data, "leaderboard": leaderboard, "current_user": current}
+
+    def _store_leaderboard(self, auth_token: str, data: Dict[str, Any]):
+        """Guarda la lista compartida y el current_user del token que la pidió"""
+        now = time.monotonic()
+        expires = now + self.leaderboard_ttl
+        self._leaderboard_cache = (expires, data)
+        self._current_user_cache = {t: c for t, c in self._current_user_cache.items() if c[0] > now}
+        self._current_user_cache[auth_token] = (expires, data.get("current_user"))
+
+    async def _current_user(self, auth_token: str) -> Optional[Dict[str, Any]]:
+        """current_user de la API para un usuario fuera de la lista compartida"""
+        cached = self._current_user_cache.get(auth_token)
+        if cached and cached[0] > time.monotonic():
+            self._cache_stats["leaderboard_hits"] += 1
+            return cached[1]
+
+        self._cache_stats["leaderboard_misses"] += 1
+        generation = self._leaderboard_generation
+        data = await self._get_json("/dashboard/leaderboard", auth_token)
+        if self._leaderboard_generation == generation:
+            self._store_leaderboard(auth_token, data)
+        return data.get("current_user")
+
+    # ------------------------------------------------------------------
+    # Peticiones
+    # ------------------------------------------------------------------
+
     def _get_headers(self, token: str = None) -> Dict[str, str]:
         """Genera headers con autenticación"""
         auth = token or self.auth_token
@@ -29,157 +214,221 @@ class WebAppAPIClient:
             headers["Authorization"] = f"Bearer {auth}"
             headers["Cookie"] = f"authToken={auth}"
         return headers
-    
+
+    def _backoff(self, attempt: int) -> float:
+        """Backoff exponencial con full jitter"""
+        return random.uniform(0, min(2.0, 0.2 * (2 ** attempt)))
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+        json: Any = None
+    ) -> httpx.Response:
+        """
+        Hace una petición con el cliente compartido.
+
+        Solo los GET (idempotentes) se reintentan ante errores de red o
+        respuestas 429/5xx de gateway.
+        """
+        client = self._get_client()
+        timeout = ENDPOINT_TIMEOUTS.get(path, DEFAULT_TIMEOUT)
+        retries = self.max_retries if method == "GET" else 0
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            self._stats["requests"] += 1
+            try:
+                response = await client.request(method, path, headers=headers, json=json, timeout=timeout)
+            except httpx.TransportError:
+                self._stats["total_latency_ms"] += (time.perf_counter() - start) * 1000
+                if attempt >= retries:
+                    self._stats["errors"] += 1
+                    raise
+            else:
+                self._stats["total_latency_ms"] += (time.perf_counter() - start) * 1000
+                if response.status_code not in RETRYABLE_STATUS or attempt >= retries:
+                    if response.status_code >= 400:
+                        self._stats["errors"] += 1
+                    return response
+
+            attempt += 1
+            self._stats["retries"] += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+    async def _get_json(self, path: str, auth_token: str) -> Dict[str, Any]:
+        response = await self._request("GET", path, self._get_headers(auth_token))
+        response.raise_for_status()
+        return response.json()
+
+    async def _send_json(
+        self,
+        method: str,
+        path: str,
+        auth_token: str,
+        payload: Dict[str, Any],
+        idempotency_key: str = None
+    ) -> Dict[str, Any]:
+        headers = self._get_headers(auth_token)
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        response = await self._request(method, path, headers, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    # ------------------------------------------------------------------
+    # Endpoints
+    # ------------------------------------------------------------------
+
     async def get_goals(self, auth_token: str) -> Dict[str, Any]:
-        """Obtiene los goals del usuario"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/dashboard/goals",
-                headers=self._get_headers(auth_token)
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def create_goal(self, auth_token: str, description: str) -> Dict[str, Any]:
+        """Obtiene los goals del usuario (read-through sobre la caché por token)"""
+        cached = self._goals_cache.get(auth_token)
+        if cached and cached[0] > time.monotonic():
+            self._cache_stats["goals_hits"] += 1
+            return cached[1]
+
+        self._cache_stats["goals_misses"] += 1
+        generation = self._goals_generation.get(auth_token, 0)
+        data = await self._get_json("/dashboard/goals", auth_token)
+        # Si hubo una escritura mientras leíamos, no cacheamos datos viejos
+        if self._goals_generation.get(auth_token, 0) == generation:
+            if len(self._goals_cache) >= GOALS_CACHE_MAX_TOKENS:
+                now = time.monotonic()
+                self._goals_cache = {t: v for t, v in self._goals_cache.items() if v[0] > now}
+            self._goals_cache[auth_token] = (time.monotonic() + self.goals_ttl, data)
+        return data
+
+    async def create_goal(self, auth_token: str, description: str, idempotency_key: str = None) -> Dict[str, Any]:
         """Crea un nuevo goal"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/dashboard/goals",
-                headers=self._get_headers(auth_token),
-                json={"description": description}
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def update_goal_status(self, auth_token: str, goal_id: int, status: str) -> Dict[str, Any]:
+        try:
+            return await self._send_json("POST", "/dashboard/goals", auth_token, {"description": description}, idempotency_key)
+        finally:
+            self.invalidate_goals(auth_token)
+            self.invalidate_leaderboard()
+
+    async def update_goal_status(self, auth_token: str, goal_id: int, status: str, idempotency_key: str = None) -> Dict[str, Any]:
         """Actualiza el estado de un goal"""
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.base_url}/dashboard/goals/{goal_id}",
-                headers=self._get_headers(auth_token),
-                json={"status": status}
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def complete_goal(self, auth_token: str, goal_id: int) -> Dict[str, Any]:
+        try:
+            return await self._send_json("PUT", f"/dashboard/goals/{goal_id}", auth_token, {"status": status}, idempotency_key)
+        finally:
+            self.invalidate_goals(auth_token)
+            self.invalidate_leaderboard()
+
+    async def complete_goal(self, auth_token: str, goal_id: int, idempotency_key: str = None) -> Dict[str, Any]:
         """Marca un goal como completado"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/dashboard/goals/complete",
-                headers=self._get_headers(auth_token),
-                json={"goalId": goal_id}
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def add_metric(self, auth_token: str, metric_name: str, metric_value: float, recorded_date: str) -> Dict[str, Any]:
+        try:
+            return await self._send_json("POST", "/dashboard/goals/complete", auth_token, {"goalId": goal_id}, idempotency_key)
+        finally:
+            self.invalidate_goals(auth_token)
+            self.invalidate_leaderboard()
+
+    async def add_metric(
+        self,
+        auth_token: str,
+        metric_name: str,
+        metric_value: float,
+        recorded_date: str,
+        idempotency_key: str = None
+    ) -> Dict[str, Any]:
         """Añade una métrica"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/dashboard/metrics",
-                headers=self._get_headers(auth_token),
-                json={
-                    "metric_name": metric_name,
-                    "metric_value": metric_value,
-                    "recorded_date": recorded_date
-                }
-            )
-            response.raise_for_status()
-            return response.json()
-    
+        self.invalidate_leaderboard()
+        return await self._send_json("POST", "/dashboard/metrics", auth_token, {
+            "metric_name": metric_name,
+            "metric_value": metric_value,
+            "recorded_date": recorded_date
+        }, idempotency_key)
+
     async def get_metrics_history(self, auth_token: str) -> Dict[str, Any]:
         """Obtiene el historial de métricas"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/dashboard/metrics-history",
-                headers=self._get_headers(auth_token)
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def add_achievement(self, auth_token: str, date: str, description: str) -> Dict[str, Any]:
+        return await self._get_json("/dashboard/metrics-history", auth_token)
+
+    async def add_achievement(self, auth_token: str, date: str, description: str, idempotency_key: str = None) -> Dict[str, Any]:
         """Añade un logro"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/dashboard/achievements",
-                headers=self._get_headers(auth_token),
-                json={
-                    "date": date,
-                    "description": description
-                }
-            )
-            response.raise_for_status()
-            return response.json()
-    
+        self.invalidate_leaderboard()
+        return await self._send_json("POST", "/dashboard/achievements", auth_token, {
+            "date": date,
+            "description": description
+        }, idempotency_key)
+
     async def get_achievements(self, auth_token: str) -> Dict[str, Any]:
         """Obtiene los logros del usuario"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/dashboard/achievements",
-                headers=self._get_headers(auth_token)
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def get_leaderboard(self, auth_token: str) -> Dict[str, Any]:
-        """Obtiene el leaderboard público"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/dashboard/leaderboard",
-                headers=self._get_headers(auth_token)
-            )
-            response.raise_for_status()
-            return response.json()
-    
+        return await self._get_json("/dashboard/achievements", auth_token)
+
+    async def get_leaderboard(self, auth_token: str, user_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Obtiene el leaderboard público.
+
+        El leaderboard es igual para todos salvo `is_current_user`, así que se
+        comparte una copia con TTL corto y el flag se aplica con `user_id`.
+        Si el usuario no sale en la lista, `current_user` es el que devolvió
+        la API para su token. Sin `user_id` se va directo a la API.
+        """
+        if user_id is None:
+            return await self._get_json("/dashboard/leaderboard", auth_token)
+
+        result = await self._shared_leaderboard(auth_token, user_id)
+        if result["current_user"] is None:
+            result["current_user"] = await self._current_user(auth_token)
+        return result
+
+    async def _shared_leaderboard(self, auth_token: str, user_id: int) -> Dict[str, Any]:
+        cached = self._leaderboard_cache
+        if cached and cached[0] > time.monotonic():
+            self._cache_stats["leaderboard_hits"] += 1
+            return self._with_current_user(cached[1], user_id)
+
+        # Single-flight: solo una petición refresca; el resto espera y reutiliza
+        async with self._leaderboard_lock:
+            cached = self._leaderboard_cache
+            if cached and cached[0] > time.monotonic():
+                self._cache_stats["leaderboard_hits"] += 1
+                return self._with_current_user(cached[1], user_id)
+
+            self._cache_stats["leaderboard_misses"] += 1
+            generation = self._leaderboard_generation
+            data = await self._get_json("/dashboard/leaderboard", auth_token)
+            if self._leaderboard_generation == generation:
+                self._store_leaderboard(auth_token, data)
+            return self._with_current_user(data, user_id)
+
     async def get_my_stats(self, auth_token: str) -> Dict[str, Any]:
         """Obtiene las estadísticas del usuario actual"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/dashboard/my-stats",
-                headers=self._get_headers(auth_token)
-            )
-            response.raise_for_status()
-            return response.json()
-    
+        return await self._get_json("/dashboard/my-stats", auth_token)
+
     async def get_internal_dashboard(self, auth_token: str) -> Dict[str, Any]:
         """Obtiene el dashboard interno para calcular leaderboard"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/dashboard/admin/internal-dashboard",
-                headers=self._get_headers(auth_token)
-            )
-            response.raise_for_status()
-            return response.json()
-    
+        return await self._get_json("/dashboard/admin/internal-dashboard", auth_token)
+
     async def check_user_exists(self, email: str) -> Optional[Dict[str, Any]]:
         """Verifica si un usuario existe y obtiene info básica"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/auth/check-user",
-                headers={"Content-Type": "application/json"},
-                json={"email": email}
+        response = await self._request(
+            "POST",
+            "/auth/check-user",
+            {"Content-Type": "application/json"},
+            json={"email": email}
+        )
+        if response.status_code == 200:
+            return response.json()
+        return None
+
+    async def verify_whatsapp_code(self, email: str, code: str) -> Optional[Dict[str, Any]]:
+        """Verifica código temporal de WhatsApp"""
+        try:
+            response = await self._request(
+                "POST",
+                "/auth/verify-whatsapp-code",
+                {"Content-Type": "application/json"},
+                json={"email": email, "code": code}
             )
+            print(f"Verify code response: {response.status_code} - {response.text}")
             if response.status_code == 200:
                 return response.json()
             return None
-    
-    async def verify_whatsapp_code(self, email: str, code: str) -> Optional[Dict[str, Any]]:
-        """Verifica código temporal de WhatsApp"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            try:
-                response = await client.post(
-                    f"{self.base_url}/auth/verify-whatsapp-code",
-                    headers={"Content-Type": "application/json"},
-                    json={"email": email, "code": code}
-                )
-                print(f"Verify code response: {response.status_code} - {response.text}")
-                if response.status_code == 200:
-                    return response.json()
-                return None
-            except Exception as e:
-                print(f"Error verifying code: {e}")
-                return None
+        except Exception as e:
+            print(f"Error verifying code: {e}")
+            return None
 
 # Instancia global del cliente
 api_client = WebAppAPIClient()
@@ -210,9 +210,11 @@ async def search_profiles(request: SearchRequest):
             result = linkedin_team.find_investors(
                 startup_description=request.query,
                 funding_stage=request.filters.get("stage", "seed"),
-                industry=request.filters.get("industry", "Technology"),
+                # Sin industria no se filtra por sector en el índice local
+                industry=request.filters.get("industry", ""),
                 location=request.filters.get("location", ""),
-                max_results=request.maxResults or 20
+                max_results=request.maxResults or 20,
+                ticket=request.filters.get("ticket") or request.filters.get("amount")
             )
         elif request.type == "talent":
             result = linkedin_team.find_talent(
@@ -0,0 +1,245 @@
+"""
+Motor de broadcasts (envíos masivos a usuarios verificados)
+
+Los destinatarios se recorren por páginas con un cursor keyset sobre
+`whatsapp_users.id`, sin cargar la tabla entera. Los envíos pasan por el token
+bucket de la cuenta de Twilio (`twilio_bucket`, compartido con la cola
+saliente, así que entre los dos no superan TWILIO_SEND_RATE), también los
+reintentos ante 429/5xx (hasta TWILIO_MAX_RETRIES). Al
+terminar cada página se guardan en una sola transacción: el historial de
+salida (inserción en bloque), los fallos y el avance del cursor en
+`broadcasts`.
+
+Un broadcast interrumpido (caída o apagado) queda en estado "running" y se
+reanuda desde su cursor al arrancar; como mucho se repite la última página.
+Se puede cancelar en cualquier momento.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import select, insert, update, func
+
+from change_feed import change_feed
+from config import config
+from context_cache import context_cache
+from database import AsyncSessionLocal, BroadcastDB, BroadcastFailureDB, ConversationHistoryDB, WhatsAppUserDB
+from rate_limit import TokenBucket, twilio_bucket
+from twilio_service import SendResult, twilio_service
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = {"cancelled", "completed"}
+
+
+def _to_dict(row: BroadcastDB) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "status": row.status,
+        "total": row.total,
+        "sent": row.sent,
+        "failed": row.failed,
+        "remaining": max(0, (row.total or 0) - (row.sent or 0) - (row.failed or 0)),
+        "error": row.error,
+        "created_at": str(row.created_at) if row.created_at else None,
+        "finished_at": str(row.finished_at) if row.finished_at else None,
+    }
+
+
+class BroadcastEngine:
+    """Ejecuta broadcasts en segundo plano con límite de ritmo y progreso persistente"""
+
+    def __init__(self, rate: float = None, burst: int = None, page_size: int = None, concurrency: int = None):
+        if rate is None:
+            self.bucket = twilio_bucket
+        else:
+            self.bucket = TokenBucket(rate, burst or config.TWILIO_SEND_BURST)
+        self.page_size = page_size or config.BROADCAST_PAGE_SIZE
+        self._semaphore = asyncio.Semaphore(concurrency or config.BROADCAST_CONCURRENCY)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._cancelled: set = set()
+
+    async def start(self):
+        """Reanuda los broadcasts que quedaron a medias"""
+        async with AsyncSessionLocal() as db:
+            ids = (await db.execute(
+                select(BroadcastDB.id).where(BroadcastDB.status == "running")
+            )).scalars().all()
+        for broadcast_id in ids:
+            logger.info(f"📣 Reanudando broadcast {broadcast_id}")
+            self._launch(broadcast_id)
+
+    async def stop(self):
+        """Detiene los envíos en curso; se reanudarán en el próximo arranque"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def create(self, message: str) -> Dict[str, Any]:
+        async with AsyncSessionLocal() as db:
+            total = (await db.execute(
+                select(func.count()).select_from(WhatsAppUserDB).where(WhatsAppUserDB.is_verified == True)
+            )).scalar()
+            row = BroadcastDB(message=message, status="running", total=total)
+            db.add(row)
+            await db.commit()
+        self._launch(row.id)
+        return _to_dict(row)
+
+    async def get(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            row = await db.get(BroadcastDB, broadcast_id)
+            return _to_dict(row) if row else None
+
+    async def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(BroadcastDB).order_by(BroadcastDB.id.desc()).limit(limit)
+            )).scalars().all()
+            return [_to_dict(row) for row in rows]
+
+    async def failures(self, broadcast_id: int, limit: int = 100) -> List[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(BroadcastFailureDB)
+                .where(BroadcastFailureDB.broadcast_id == broadcast_id)
+                .order_by(BroadcastFailureDB.id)
+                .limit(limit)
+            )).scalars().all()
+            return [{"phone_number": r.phone_number, "error": r.error, "created_at": str(r.created_at)} for r in rows]
+
+    async def cancel(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        """Cancela un broadcast; los envíos ya en vuelo terminan"""
+        async with AsyncSessionLocal() as db:
+            row = await db.get(BroadcastDB, broadcast_id)
+            if row is None:
+                return None
+            if row.status not in FINISHED_STATUSES:
+                row.status = "cancelled"
+                row.finished_at = datetime.utcnow()
+                await db.commit()
+                if broadcast_id in self._tasks:
+                    self._cancelled.add(broadcast_id)
+            return _to_dict(row)
+
+    async def resume(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        """Reanuda un broadcast fallido o interrumpido desde su cursor"""
+        async with AsyncSessionLocal() as db:
+            row = await db.get(BroadcastDB, broadcast_id)
+            if row is None:
+                return None
+            if row.status in FINISHED_STATUSES or broadcast_id in self._tasks:
+                return _to_dict(row)
+            row.status = "running"
+            row.error = None
+            await db.commit()
+        self._launch(broadcast_id)
+        return _to_dict(row)
+
+    def _launch(self, broadcast_id: int):
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id: int):
+        async with AsyncSessionLocal() as db:
+            row = await db.get(BroadcastDB, broadcast_id)
+            message, cursor = row.message, row.cursor or 0
+
+        try:
+            while broadcast_id not in self._cancelled:
+                async with AsyncSessionLocal() as db:
+                    page = (await db.execute(
+                        select(WhatsAppUserDB.id, WhatsAppUserDB.phone_number)
+                        .where(WhatsAppUserDB.is_verified == True)
+                        .where(WhatsAppUserDB.id > cursor)
+                        .order_by(WhatsAppUserDB.id)
+                        .limit(self.page_size)
+                    )).all()
+                if not page:
+                    await self._finish(broadcast_id, "completed")
+                    return
+
+                results = await asyncio.gather(*[self._send(phone, message) for _, phone in page])
+                cursor = page[-1][0]
+                await self._save_page(broadcast_id, cursor, message, list(zip([p for _, p in page], results)))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Broadcast {broadcast_id} falló: {str(e)}")
+            await self._finish(broadcast_id, "failed", str(e))
+        finally:
+            self._cancelled.discard(broadcast_id)
+
+    async def _send(self, phone_number: str, message: str) -> SendResult:
+        async with self._semaphore:
+            attempt = 0
+            while True:
+                # Cada intento, también los reintentos, consume un token del bucket
+                await self.bucket.acquire()
+                result = await twilio_service.send(phone_number, message, max_retries=0)
+                if result.sid or not result.retryable or attempt >= twilio_service.max_retries:
+                    return result
+                await asyncio.sleep(twilio_service.backoff(attempt, result.retry_after))
+                attempt += 1
+
+    async def _save_page(self, broadcast_id: int, cursor: int, message: str, results: List[Tuple[str, SendResult]]):
+        now = datetime.utcnow()
+        sent = [(phone, result.sid) for phone, result in results if result.sid]
+        failed = [(phone, result.error) for phone, result in results if not result.sid]
+
+        async with AsyncSessionLocal() as db:
+            if sent:
+                await db.execute(insert(ConversationHistoryDB.__table__), [
+                    {"phone_number": phone, "message_sid": sid, "direction": "outbound", "message": message, "created_at": now}
+                    for phone, sid in sent
+                ])
+            if failed:
+                await db.execute(insert(BroadcastFailureDB.__table__), [
+                    {"broadcast_id": broadcast_id, "phone_number": phone, "error": error, "created_at": now}
+                    for phone, error in failed
+                ])
+            await db.execute(
+                update(BroadcastDB)
+                .where(BroadcastDB.id == broadcast_id)
+                .values(
+                    cursor=cursor,
+                    sent=BroadcastDB.sent + len(sent),
+                    failed=BroadcastDB.failed + len(failed),
+                    updated_at=now
+                )
+            )
+            await db.commit()
+
+        for phone, sid in sent:
+            context_cache.record(phone, message, "outbound", sid, created_at=now)
+            change_feed.publish("message", phone, {
+                "direction": "outbound",
+                "message": message,
+                "message_sid": sid,
+                "intent": None,
+                "created_at": now.isoformat(),
+            })
+
+    async def _finish(self, broadcast_id: int, status: str, error: str = None):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(BroadcastDB)
+                .where(BroadcastDB.id == broadcast_id)
+                .where(BroadcastDB.status == "running")
+                .values(status=status, error=error, finished_at=datetime.utcnow())
+            )
+            await db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": sorted(self._tasks),
+            "rate_per_s": self.bucket.rate,
+            "page_size": self.page_size,
+        }
+
+
+# Instancia global
+broadcast_engine = BroadcastEngine()
@@ -0,0 +1,154 @@
+"""
+Feed de cambios en tiempo real para el panel de administración (SSE)
+
+Cada escritura relevante publica un evento con un id creciente: mensajes
+entrantes y salientes (al volcarse a la base de datos), cambios de estado de
+autenticación y estados de entrega de Twilio. Los suscriptores reciben los
+eventos por Server-Sent Events, filtrados por número si lo piden.
+
+Los últimos CHANGE_FEED_HISTORY eventos se guardan en memoria para reanudar
+desde `Last-Event-ID`. Cada suscriptor tiene un buffer acotado: si se llena
+(cliente lento), se le envía `reset` y se cierra la conexión; al reconectar
+con su último id se le reenvía lo que falte. Si ese id ya no está en memoria
+(o el servidor se reinició), también recibe `reset` y debe recargar por la API.
+
+En modo multiproceso los procesos worker no reparten nada: reenvían cada
+evento al proceso web, que es el que tiene los suscriptores.
+"""
+import asyncio
+import itertools
+import json
+from collections import deque
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Iterable, AsyncIterator, Callable
+
+from config import config
+
+
+class Subscriber:
+    """Conexión de un panel con su filtro y su buffer"""
+
+    def __init__(self, phones: Optional[set], buffer_size: int):
+        self.phones = phones
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        self.overflowed = False
+
+    def wants(self, event: Dict[str, Any]) -> bool:
+        return self.phones is None or event["phone_number"] in self.phones
+
+    def push(self, event: Optional[Dict[str, Any]]) -> bool:
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+
+def _format_sse(event: Dict[str, Any]) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+
+
+class ChangeFeed:
+    """Publica eventos a los suscriptores y guarda los recientes para reanudar"""
+
+    def __init__(self, history: int = None, buffer_size: int = None, max_subscribers: int = None):
+        self.buffer_size = buffer_size or config.CHANGE_FEED_SUBSCRIBER_BUFFER
+        self.max_subscribers = max_subscribers or config.CHANGE_FEED_MAX_SUBSCRIBERS
+        self._history: deque = deque(maxlen=history or config.CHANGE_FEED_HISTORY)
+        self._ids = itertools.count(1)
+        self._last_id = 0
+        self._subscribers: List[Subscriber] = []
+        self._forward: Optional[Callable] = None
+        self._stats = {
+            "published": 0,
+            "delivered": 0,
+            "overflows": 0,
+            "resets": 0,
+        }
+
+    def forward_to(self, sink: Callable[[str, Optional[str], Dict[str, Any]], None]):
+        """Envía los eventos a `sink` en lugar de repartirlos aquí (procesos worker)"""
+        self._forward = sink
+
+    def publish(self, event_type: str, phone_number: Optional[str], data: Dict[str, Any]):
+        """Registra un evento y lo reparte sin bloquear"""
+        if self._forward is not None:
+            self._forward(event_type, phone_number, data)
+            return
+        self._last_id = next(self._ids)
+        event = {
+            "id": self._last_id,
+            "type": event_type,
+            "phone_number": phone_number,
+            "at": datetime.utcnow().isoformat(),
+            "data": data,
+        }
+        self._history.append(event)
+        self._stats["published"] += 1
+
+        for subscriber in self._subscribers:
+            if subscriber.overflowed or not subscriber.wants(event):
+                continue
+            if subscriber.push(event):
+                self._stats["delivered"] += 1
+            else:
+                # Se cierra; el cliente reanuda con su último id
+                subscriber.overflowed = True
+                self._stats["overflows"] += 1
+
+    def is_full(self) -> bool:
+        return len(self._subscribers) >= self.max_subscribers
+
+    async def stream(self, phones: Optional[Iterable[str]] = None, last_event_id: int = None) -> AsyncIterator[str]:
+        """Eventos en formato SSE: primero los pendientes desde `last_event_id`, después en vivo"""
+        subscriber = Subscriber(set(phones) if phones else None, self.buffer_size)
+        # Copia del histórico y alta en el mismo paso: ningún evento se pierde ni se repite
+        history, last_sent = list(self._history), self._last_id
+        self._subscribers.append(subscriber)
+        try:
+            if last_event_id is not None:
+                oldest = history[0]["id"] if history else last_sent + 1
+                if last_event_id > last_sent or last_event_id < oldest - 1:
+                    self._stats["resets"] += 1
+                    yield _format_sse({"id": last_sent, "type": "reset", "phone_number": None, "data": {"reason": "gap"}})
+                else:
+                    for event in history:
+                        if event["id"] > last_event_id and subscriber.wants(event):
+                            yield _format_sse(event)
+            # Último id al suscribirse, para poder reanudar aunque no llegue ningún evento
+            yield f"id: {last_sent}\n\n"
+
+            while True:
+                if subscriber.overflowed and subscriber.queue.empty():
+                    self._stats["resets"] += 1
+                    yield _format_sse({"id": last_sent, "type": "reset", "phone_number": None, "data": {"reason": "overflow"}})
+                    return
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=config.CHANGE_FEED_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    return
+                yield _format_sse(event)
+                last_sent = event["id"]
+        finally:
+            self._subscribers.remove(subscriber)
+
+    def close(self):
+        """Cierra todas las conexiones (al apagar)"""
+        for subscriber in self._subscribers:
+            if not subscriber.push(None):
+                subscriber.overflowed = True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "subscribers": len(self._subscribers),
+            "last_event_id": self._last_id,
+            "history": len(self._history),
+        }
+
+
+# Instancia global
+change_feed = ChangeFeed()
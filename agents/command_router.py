@@ -0,0 +1,246 @@
+"""
+Router determinista de comandos de WhatsApp
+
+Resuelve los comandos de la ayuda ("mis goals", "leaderboard", "usuarios 120",
+"revenue 5000", "completar 2", ...) directamente a acciones de
+`ChatOrchestrator._execute_action` sin llamar a Groq. Si la gramática no
+reconoce el mensaje, un clasificador Naive Bayes entrenado con la columna
+`intent` de `conversation_history` puede resolver las acciones sin parámetros
+cuando está muy seguro. En cualquier otro caso se usa el LLM.
+"""
+import math
+import re
+import unicodedata
+from typing import Optional, Dict, Any, List, Tuple
+
+from config import config
+from twilio_service import TEMPLATES
+
+# Acciones que el clasificador puede resolver (no necesitan parámetros)
+CLASSIFIER_ACTIONS = {"LIST_GOALS", "VIEW_LEADERBOARD", "VIEW_METRICS", "VIEW_STATUS"}
+
+_NUMBER = r"\$?\s*(\d{1,3}(?:[.,]\d{3})+|\d+(?:[.,]\d+)?)\s*(k)?"
+
+
+def normalize(text: str) -> str:
+    """Minúsculas, sin acentos, sin signos de puntuación al principio/final"""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" \t\n¡!¿?.,;:")
+
+
+def parse_number(raw: str, thousands: Optional[str] = None) -> float:
+    """'5.000' / '5,000' -> 5000, '2,5' -> 2.5, '3' + 'k' -> 3000"""
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", raw):
+        value = float(re.sub(r"[.,]", "", raw))
+    else:
+        value = float(raw.replace(",", "."))
+    if thousands:
+        value *= 1000
+    return value
+
+
+def _clean_value(value: float):
+    return int(value) if value == int(value) else value
+
+
+# (acción, regex, extractor de params)
+COMMANDS: List[Tuple[str, re.Pattern, Any]] = [
+    ("LIST_GOALS", re.compile(r"(?:ver |mostrar |lista(?:r)? (?:de )?)?(?:mis |los )?(?:goals?|objetivos|metas)"), None),
+    ("VIEW_LEADERBOARD", re.compile(r"(?:ver |mostrar )?(?:el )?(?:leaderboard|ranking|clasificacion)"), None),
+    ("VIEW_METRICS", re.compile(r"(?:ver |mostrar )?(?:mis )?(?:metricas|metrics|estadisticas)"), None),
+    ("VIEW_STATUS", re.compile(r"(?:mi )?(?:estado|status)"), None),
+    ("HELP", re.compile(r"ayuda|help|comandos|menu"), None),
+    ("ADD_METRIC_USERS", re.compile(r"(?:usuarios|users)\s*:?\s*" + _NUMBER),
+     lambda m: {"value": _clean_value(parse_number(m.group(1), m.group(2)))}),
+    ("ADD_METRIC_USERS", re.compile(r"(?:tengo )?" + _NUMBER + r"\s+(?:usuarios|users)"),
+     lambda m: {"value": _clean_value(parse_number(m.group(1), m.group(2)))}),
+    ("ADD_METRIC_REVENUE", re.compile(r"(?:revenue|ingresos|facturacion)\s*:?\s*" + _NUMBER),
+     lambda m: {"value": _clean_value(parse_number(m.group(1), m.group(2)))}),
+    ("ADD_METRIC_REVENUE", re.compile(r"(?:tengo )?" + _NUMBER + r"\s+(?:de )?(?:revenue|ingresos)"),
+     lambda m: {"value": _clean_value(parse_number(m.group(1), m.group(2)))}),
+    ("COMPLETE_GOAL", re.compile(r"(?:completar|complete|completado|completada|hecho|done)\s+(?:el )?(?:goal |objetivo )?#?(\d+)"),
+     lambda m: {"goal_index": int(m.group(1))}),
+    ("ADD_GOAL", re.compile(r"(?:nuevo|anadir|agregar|crear|add|new)\s+(?:goal|objetivo|meta)\s*:?\s+(.+)", re.DOTALL),
+     None),
+]
+
+
+# Separadores entre comandos de un mismo mensaje ("completé el 2, tengo 80 usuarios y 3000 de revenue").
+# La coma exige espacio detrás para no partir números como "5,000".
+_CLAUSE_SPLIT = re.compile(r"\s*[,;]\s+|\s+(?:y|e)\s+")
+
+# Comandos que pueden combinarse en un mensaje con varias acciones
+MULTI_ACTIONS = {"ADD_METRIC_USERS", "ADD_METRIC_REVENUE", "COMPLETE_GOAL", "LIST_GOALS", "VIEW_LEADERBOARD", "VIEW_METRICS"}
+
+
+class NaiveBayesIntentClassifier:
+    """Clasificador multinomial Naive Bayes sobre tokens del mensaje"""
+
+    def __init__(self, min_examples: int = 20):
+        self.min_examples = min_examples
+        self.class_counts: Dict[str, int] = {}
+        self.token_counts: Dict[str, Dict[str, int]] = {}
+        self.class_totals: Dict[str, int] = {}
+        self.vocabulary: set = set()
+        self.trained = False
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return re.findall(r"[a-z]+|\d+", normalize(text))
+
+    def fit(self, examples: List[Tuple[str, str]]):
+        counts: Dict[str, int] = {}
+        for _, label in examples:
+            counts[label] = counts.get(label, 0) + 1
+        # Solo clases con ejemplos suficientes
+        keep = {label for label, n in counts.items() if n >= self.min_examples}
+
+        self.class_counts, self.token_counts, self.class_totals = {}, {}, {}
+        self.vocabulary = set()
+        for text, label in examples:
+            if label not in keep:
+                continue
+            self.class_counts[label] = self.class_counts.get(label, 0) + 1
+            bucket = self.token_counts.setdefault(label, {})
+            for token in self.tokenize(text):
+                bucket[token] = bucket.get(token, 0) + 1
+                self.class_totals[label] = self.class_totals.get(label, 0) + 1
+                self.vocabulary.add(token)
+        self.trained = len(self.class_counts) >= 2
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """Devuelve (clase, probabilidad posterior)"""
+        if not self.trained:
+            return None, 0.0
+        tokens = self.tokenize(text)
+        if not tokens:
+            return None, 0.0
+
+        total = sum(self.class_counts.values())
+        vocab = len(self.vocabulary) + 1
+        log_probs = {}
+        for label, n in self.class_counts.items():
+            bucket = self.token_counts.get(label, {})
+            denom = self.class_totals.get(label, 0) + vocab
+            lp = math.log(n / total)
+            for token in tokens:
+                lp += math.log((bucket.get(token, 0) + 1) / denom)
+            log_probs[label] = lp
+
+        best = max(log_probs, key=log_probs.get)
+        top = log_probs[best]
+        norm = sum(math.exp(lp - top) for lp in log_probs.values())
+        return best, 1.0 / norm
+
+
+class CommandRouter:
+    """Resuelve comandos conocidos sin LLM y lleva estadísticas de aciertos"""
+
+    def __init__(self, threshold: float = None):
+        self.threshold = config.COMMAND_CLASSIFIER_THRESHOLD if threshold is None else threshold
+        self.classifier = NaiveBayesIntentClassifier()
+        self._hits: Dict[str, int] = {}
+        self._classifier_hits: Dict[str, int] = {}
+        self._llm_fallbacks = 0
+        # Media móvil de la latencia de parse_intent con Groq
+        self._llm_latency_ms = 0.0
+
+    def match(self, message: str) -> Optional[Dict[str, Any]]:
+        """Devuelve un intent compatible con _execute_action o None si hay que usar el LLM"""
+        # Los mensajes agrupados (varias líneas) siempre van al LLM
+        if "\n" in (message or "").strip():
+            return None
+        text = normalize(message)
+        if not text:
+            return None
+
+        intent = self._match_grammar(message, text)
+        if intent is not None:
+            self._hits[intent["action"]] = self._hits.get(intent["action"], 0) + 1
+            return intent
+
+        actions = self._match_clauses(text)
+        if actions is not None:
+            self._hits["MULTI"] = self._hits.get("MULTI", 0) + 1
+            return {"action": actions[0]["action"], "params": actions[0]["params"], "actions": actions}
+
+        label, prob = self.classifier.predict(text)
+        if label in CLASSIFIER_ACTIONS and prob >= self.threshold:
+            self._classifier_hits[label] = self._classifier_hits.get(label, 0) + 1
+            return {"action": label, "params": {}}
+
+        return None
+
+    def _match_grammar(self, message: str, text: str) -> Optional[Dict[str, Any]]:
+        for action, pattern, extract in COMMANDS:
+            m = pattern.fullmatch(text)
+            if not m:
+                continue
+            if action == "HELP":
+                intent = {"action": "CHAT", "params": {}, "response": TEMPLATES["help"]}
+            elif action == "ADD_GOAL":
+                # Usar el texto original para conservar mayúsculas y acentos
+                original = re.split(r"(?i)goal|objetivo|meta", message.strip(), maxsplit=1)[-1]
+                intent = {"action": action, "params": {"description": original.strip(" :\t\n")}}
+            else:
+                intent = {"action": action, "params": extract(m) if extract else {}}
+            return intent
+        return None
+
+    def _match_clauses(self, text: str) -> Optional[List[Dict[str, Any]]]:
+        """Varias órdenes en un mensaje: solo si TODAS las partes son comandos conocidos"""
+        clauses = [c for c in _CLAUSE_SPLIT.split(text) if c]
+        if len(clauses) < 2:
+            return None
+        actions = []
+        for clause in clauses:
+            intent = self._match_grammar(clause, clause)
+            if intent is None or intent["action"] not in MULTI_ACTIONS:
+                return None
+            actions.append({"action": intent["action"], "params": intent["params"]})
+        return actions
+
+    def record_llm(self, elapsed_ms: float):
+        """Registra una llamada al LLM (para estimar la latencia ahorrada)"""
+        self._llm_fallbacks += 1
+        if self._llm_latency_ms:
+            self._llm_latency_ms = 0.9 * self._llm_latency_ms + 0.1 * elapsed_ms
+        else:
+            self._llm_latency_ms = elapsed_ms
+
+    def train_from_history(self, limit: int = 20000) -> int:
+        """Entrena el clasificador con mensajes entrantes etiquetados del historial"""
+        from database import SessionLocal, ConversationHistoryDB
+
+        db = SessionLocal()
+        try:
+            rows = db.query(ConversationHistoryDB.message, ConversationHistoryDB.intent).filter(
+                ConversationHistoryDB.direction == "inbound",
+                ConversationHistoryDB.intent.isnot(None)
+            ).order_by(ConversationHistoryDB.id.desc()).limit(limit).all()
+        finally:
+            db.close()
+
+        self.classifier.fit([(message, intent) for message, intent in rows])
+        return len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        grammar_hits = sum(self._hits.values())
+        classifier_hits = sum(self._classifier_hits.values())
+        fast = grammar_hits + classifier_hits
+        total = fast + self._llm_fallbacks
+        return {
+            "grammar_hits": dict(self._hits),
+            "classifier_hits": dict(self._classifier_hits),
+            "classifier_trained": self.classifier.trained,
+            "llm_fallbacks": self._llm_fallbacks,
+            "fast_path_rate": round(fast / total, 3) if total else 0.0,
+            "avg_llm_latency_ms": round(self._llm_latency_ms, 1),
+            "estimated_latency_saved_ms": round(fast * self._llm_latency_ms, 1),
+        }
+
+
+# Instancia global
+command_router = CommandRouter()
@@ -12,21 +12,113 @@ class Config:
     TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
     TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER", "whatsapp:+13158601046")
     TWILIO_SANDBOX_CODE = os.getenv("TWILIO_SANDBOX_CODE", "")  # ej: "join hungry-wolf"
+    TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL", "https://api.twilio.com")
+    # URL pública de /webhook/whatsapp/status (vacío = la configurada en la consola de Twilio)
+    TWILIO_STATUS_CALLBACK_URL = os.getenv("TWILIO_STATUS_CALLBACK_URL", "")
+    TWILIO_MAX_CONCURRENCY = int(os.getenv("TWILIO_MAX_CONCURRENCY", 20))
+    TWILIO_MAX_RETRIES = int(os.getenv("TWILIO_MAX_RETRIES", 3))
+    TWILIO_TIMEOUT = float(os.getenv("TWILIO_TIMEOUT", 15))  # segundos
     
     # API WebApp (tu aplicación de Cloudflare Workers)
     WEBAPP_API_URL = os.getenv("WEBAPP_API_URL", "https://webapp.pages.dev/api")
     WEBAPP_API_TOKEN = os.getenv("WEBAPP_API_TOKEN")  # Token JWT para autenticación
+    WEBAPP_HTTP2 = os.getenv("WEBAPP_HTTP2", "true").lower() == "true"
+    WEBAPP_MAX_CONNECTIONS = int(os.getenv("WEBAPP_MAX_CONNECTIONS", 20))
+    WEBAPP_MAX_KEEPALIVE = int(os.getenv("WEBAPP_MAX_KEEPALIVE", 10))
+    WEBAPP_MAX_RETRIES = int(os.getenv("WEBAPP_MAX_RETRIES", 2))
+    GOALS_CACHE_TTL = float(os.getenv("GOALS_CACHE_TTL", 60))  # segundos
+    LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", 15))  # segundos
+    # Outbox de escrituras: se confirma al usuario tras esperar como mucho CONFIRM_WAIT
+    WEBAPP_OUTBOX_WORKERS = int(os.getenv("WEBAPP_OUTBOX_WORKERS", 4))
+    WEBAPP_OUTBOX_CONFIRM_WAIT = float(os.getenv("WEBAPP_OUTBOX_CONFIRM_WAIT", 2.0))  # segundos
+    WEBAPP_OUTBOX_MAX_ATTEMPTS = int(os.getenv("WEBAPP_OUTBOX_MAX_ATTEMPTS", 10))
+    WEBAPP_OUTBOX_RETRY_BASE = float(os.getenv("WEBAPP_OUTBOX_RETRY_BASE", 2))  # segundos, se duplica en cada intento
+    WEBAPP_OUTBOX_RETRY_MAX = float(os.getenv("WEBAPP_OUTBOX_RETRY_MAX", 600))
     
     # OpenAI (LLM Provider - GPT-4o)
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # Modelo económico y eficiente
     
+    # Groq (LLM del chat de WhatsApp)
+    GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+    GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
+    GROQ_MAX_CONCURRENCY = int(os.getenv("GROQ_MAX_CONCURRENCY", 8))
+    GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", 20))  # segundos
+    
+    # Umbral de confianza del clasificador de comandos (evita llamar a Groq)
+    COMMAND_CLASSIFIER_THRESHOLD = float(os.getenv("COMMAND_CLASSIFIER_THRESHOLD", 0.9))
+    
+    # Ritmo de envío de la cuenta de Twilio (mensajes/segundo), compartido por la cola saliente y los broadcasts
+    TWILIO_SEND_RATE = float(os.getenv("TWILIO_SEND_RATE", 10))
+    TWILIO_SEND_BURST = int(os.getenv("TWILIO_SEND_BURST", 10))
+    # Cola persistente de mensajes salientes (respuestas y envíos puntuales)
+    OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 8))
+    OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", 6))
+    OUTBOUND_QUEUE_MAX = int(os.getenv("OUTBOUND_QUEUE_MAX", 10000))
+    OUTBOUND_RETRY_BASE = float(os.getenv("OUTBOUND_RETRY_BASE", 2))  # segundos, se duplica en cada intento
+    OUTBOUND_RETRY_MAX = float(os.getenv("OUTBOUND_RETRY_MAX", 300))
+    BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 100))
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+    
     # Server
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", 8000))
+    API_PAGE_SIZE = int(os.getenv("API_PAGE_SIZE", 50))  # filas por página de la API de administración
+    API_PAGE_MAX = int(os.getenv("API_PAGE_MAX", 500))
+    EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))  # filas por lectura al exportar
+    CONNECT_CACHE_MAX_AGE = int(os.getenv("CONNECT_CACHE_MAX_AGE", 300))  # segundos de caché de /connect/qr en el navegador
+    
+    # Procesamiento en segundo plano de mensajes entrantes
+    INBOUND_WORKERS = int(os.getenv("INBOUND_WORKERS", 4))
+    INBOUND_QUEUE_MAXSIZE = int(os.getenv("INBOUND_QUEUE_MAXSIZE", 1000))
+    INBOUND_COALESCE_WINDOW = float(os.getenv("INBOUND_COALESCE_WINDOW", 0.8))  # segundos
+    # Modo multiproceso: N procesos worker particionados por número (0 = todo en el proceso web)
+    INBOUND_PROCESSES = int(os.getenv("INBOUND_PROCESSES", 0))
+    INBOUND_DURABLE_QUEUE_MAX = int(os.getenv("INBOUND_DURABLE_QUEUE_MAX", 50000))  # mensajes sin procesar en la BD
+    WORKER_STATS_INTERVAL = float(os.getenv("WORKER_STATS_INTERVAL", 5))  # segundos entre envíos de métricas al proceso web
     
     # Database (SQLite local para caché de conversaciones)
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./agents.db")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+    
+    # Caché de usuario + acción pendiente por número (write-through)
+    USER_STATE_CACHE_TTL = float(os.getenv("USER_STATE_CACHE_TTL", 300))  # segundos
+    USER_STATE_CACHE_MAX = int(os.getenv("USER_STATE_CACHE_MAX", 10000))
+    PENDING_ACTION_TTL = int(os.getenv("PENDING_ACTION_TTL", 1800))  # segundos que dura un flujo de login
+    
+    # Idempotencia del webhook por MessageSid
+    IDEMPOTENCY_MEMORY_SIZE = int(os.getenv("IDEMPOTENCY_MEMORY_SIZE", 100000))
+    IDEMPOTENCY_RETENTION_DAYS = int(os.getenv("IDEMPOTENCY_RETENTION_DAYS", 7))
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+    
+    # Estados de entrega (callbacks de Twilio) y latencias por mensaje
+    DELIVERY_STATUS_FLUSH_INTERVAL = float(os.getenv("DELIVERY_STATUS_FLUSH_INTERVAL", 1.0))  # segundos
+    DELIVERY_STATUS_MAX_BUFFER = int(os.getenv("DELIVERY_STATUS_MAX_BUFFER", 500))
+    DELIVERY_STATUS_MAX_ATTEMPTS = int(os.getenv("DELIVERY_STATUS_MAX_ATTEMPTS", 5))  # volcados fallidos antes de pasar una fila al fichero
+    DELIVERY_STATUS_SPILL_PATH = os.getenv("DELIVERY_STATUS_SPILL_PATH", "./delivery_status.spill.jsonl")
+    DELIVERY_STATS_RETENTION_DAYS = int(os.getenv("DELIVERY_STATS_RETENTION_DAYS", 14))
+    
+    # Feed de cambios (SSE) para el panel de administración
+    CHANGE_FEED_HISTORY = int(os.getenv("CHANGE_FEED_HISTORY", 5000))  # eventos recientes para reanudar
+    CHANGE_FEED_SUBSCRIBER_BUFFER = int(os.getenv("CHANGE_FEED_SUBSCRIBER_BUFFER", 500))
+    CHANGE_FEED_MAX_SUBSCRIBERS = int(os.getenv("CHANGE_FEED_MAX_SUBSCRIBERS", 50))
+    CHANGE_FEED_HEARTBEAT = float(os.getenv("CHANGE_FEED_HEARTBEAT", 15))  # segundos
+    
+    # Historial de conversaciones con escritura diferida (en bloque)
+    CONVERSATION_LOG_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_LOG_FLUSH_INTERVAL", 0.5))  # segundos
+    CONVERSATION_LOG_MAX_BUFFER = int(os.getenv("CONVERSATION_LOG_MAX_BUFFER", 200))
+    CONVERSATION_LOG_SPILL_PATH = os.getenv("CONVERSATION_LOG_SPILL_PATH", "./conversation_log.spill.jsonl")
+    CONVERSATION_LOG_MAX_ATTEMPTS = int(os.getenv("CONVERSATION_LOG_MAX_ATTEMPTS", 5))  # volcados fallidos antes de pasar una fila al fichero
+    
+    # Caché en memoria del contexto reciente por número
+    CONTEXT_CACHE_TURNS = int(os.getenv("CONTEXT_CACHE_TURNS", 10))
+    CONTEXT_CACHE_MAX_PHONES = int(os.getenv("CONTEXT_CACHE_MAX_PHONES", 10000))
+    CONTEXT_CACHE_MAX_BYTES = int(os.getenv("CONTEXT_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    
+    # Retención: el historial con más de N días pasa a segmentos comprimidos (0 = desactivado)
+    CONVERSATION_RETENTION_DAYS = int(os.getenv("CONVERSATION_RETENTION_DAYS", 0))
+    CONVERSATION_ARCHIVE_SEGMENT_ROWS = int(os.getenv("CONVERSATION_ARCHIVE_SEGMENT_ROWS", 500))
+    CONVERSATION_COMPACTION_INTERVAL = float(os.getenv("CONVERSATION_COMPACTION_INTERVAL", 6 * 3600))  # segundos
     
     # Environment
     ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
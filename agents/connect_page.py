@@ -0,0 +1,243 @@
+"""
+Página de conexión a WhatsApp (/connect) con QR generado localmente
+
+El link wa.me, el PNG del QR y la página HTML solo dependen del número y del
+código de sandbox, así que se generan una vez y se guardan en memoria por
+(número, código). Cada recurso lleva un ETag (hash del contenido) para que el
+navegador revalide con 304. Si cambia cualquier TWILIO_* de la configuración
+se descarta todo lo generado.
+"""
+import hashlib
+import time
+from dataclasses import dataclass
+from html import escape
+from typing import Optional, Dict, Any, Tuple
+
+from config import config
+from qr_code import qr_png
+
+
+@dataclass
+class CachedResource:
+    body: bytes
+    etag: str
+    media_type: str
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """True si la cabecera If-None-Match ya incluye este ETag (comparación débil)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in tags)
+
+
+def _twilio_settings() -> Tuple[Tuple[str, Any], ...]:
+    return tuple(
+        (name, getattr(config, name))
+        for name in sorted(dir(config))
+        if name.startswith("TWILIO_")
+    )
+
+
+def build_connection_info(number: str, sandbox_code: str) -> Dict[str, Any]:
+    """Link directo de WhatsApp e instrucciones según sandbox o producción"""
+    # Extraer número del formato whatsapp:+1234567890
+    phone = number.replace("whatsapp:", "").replace("+", "")
+    
+    # Construir link de WhatsApp
+    if sandbox_code:
+        # Modo sandbox - necesita código de unión
+        whatsapp_link = f"https://wa.me/{phone}?text={sandbox_code.replace(' ', '%20')}"
+        instructions = f"1. Haz clic en el link o escanea el QR\n2. Envía el mensaje '{sandbox_code}'\n3. Una vez conectado, envía 'hola' para comenzar"
+    else:
+        # Modo producción - conexión directa
+        whatsapp_link = f"https://wa.me/{phone}?text=Hola"
+        instructions = "1. Haz clic en el link o escanea el QR\n2. Envía 'Hola' para comenzar\n3. Vincula tu cuenta de LovableGrowth"
+    
+    return {
+        "whatsapp_link": whatsapp_link,
+        "phone_number": f"+{phone}",
+        "sandbox_code": sandbox_code or None,
+        "is_sandbox": bool(sandbox_code),
+        "instructions": instructions,
+    }
+
+
+def _render_page(info: Dict[str, Any], qr_src: str) -> str:
+    return f"""
+    <!DOCTYPE html>
+    <html lang="es">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Conectar a LovableGrowth WhatsApp</title>
+        <style>
+            body {{
+                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+                display: flex;
+                flex-direction: column;
+                align-items: center;
+                justify-content: center;
+                min-height: 100vh;
+                margin: 0;
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                color: white;
+            }}
+            .container {{
+                background: white;
+                border-radius: 20px;
+                padding: 40px;
+                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
+                text-align: center;
+                max-width: 400px;
+            }}
+            h1 {{
+                color: #333;
+                margin-bottom: 10px;
+            }}
+            p {{
+                color: #666;
+                margin-bottom: 20px;
+            }}
+            .qr-container {{
+                background: #f5f5f5;
+                padding: 20px;
+                border-radius: 15px;
+                margin: 20px 0;
+            }}
+            .qr-container img {{
+                border-radius: 10px;
+            }}
+            .instructions {{
+                text-align: left;
+                background: #f0f7ff;
+                padding: 15px 20px;
+                border-radius: 10px;
+                color: #333;
+                font-size: 14px;
+                white-space: pre-line;
+            }}
+            .btn {{
+                display: inline-block;
+                background: #25D366;
+                color: white;
+                padding: 15px 30px;
+                border-radius: 30px;
+                text-decoration: none;
+                font-weight: bold;
+                margin-top: 20px;
+                transition: transform 0.2s;
+            }}
+            .btn:hover {{
+                transform: scale(1.05);
+            }}
+            .phone {{
+                color: #999;
+                font-size: 12px;
+                margin-top: 10px;
+            }}
+            .badge {{
+                display: inline-block;
+                background: {"#ffc107" if info["is_sandbox"] else "#28a745"};
+                color: {"#333" if info["is_sandbox"] else "white"};
+                padding: 5px 15px;
+                border-radius: 20px;
+                font-size: 12px;
+                margin-bottom: 15px;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>🎯 LovableGrowth</h1>
+            <span class="badge">{"🧪 Modo Sandbox" if info["is_sandbox"] else "✅ Producción"}</span>
+            <p>Gestiona tus goals desde WhatsApp</p>
+            
+            <div class="qr-container">
+                <img src="{escape(qr_src)}" alt="QR Code" width="200" height="200">
+            </div>
+            
+            <div class="instructions">{escape(info["instructions"])}</div>
+            
+            <a href="{escape(info["whatsapp_link"])}" class="btn" target="_blank">
+                📱 Abrir WhatsApp
+            </a>
+            
+            <p class="phone">Número: {escape(info["phone_number"])}</p>
+        </div>
+    </body>
+    </html>
+    """
+
+
+class ConnectPageCache:
+    """Info de conexión, PNG del QR y página HTML por (número, código de sandbox)"""
+
+    def __init__(self):
+        self._settings: Tuple[Tuple[str, Any], ...] = ()
+        self._entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._stats = {
+            "hits": 0,
+            "renders": 0,
+            "invalidations": 0,
+            "not_modified": 0,
+        }
+
+    def _entry(self) -> Dict[str, Any]:
+        settings = _twilio_settings()
+        if settings != self._settings:
+            if self._entries:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._settings = settings
+
+        key = (config.TWILIO_WHATSAPP_NUMBER, config.TWILIO_SANDBOX_CODE or "")
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._stats["hits"] += 1
+            return entry
+
+        start = time.perf_counter()
+        info = build_connection_info(*key)
+        png = qr_png(info["whatsapp_link"])
+        qr = CachedResource(png, _etag(png), "image/png")
+        # La versión en la URL cambia con el QR, así que el PNG puede cachearse sin miedo
+        html = _render_page(info, "/connect/qr.png?v=" + qr.etag.strip('"')).encode("utf-8")
+        entry = self._entries[key] = {
+            "info": {**info, "qr_code_url": "/connect/qr.png"},
+            "qr": qr,
+            "page": CachedResource(html, _etag(html), "text/html; charset=utf-8"),
+            "render_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        self._stats["renders"] += 1
+        return entry
+
+    def info(self) -> Dict[str, Any]:
+        return self._entry()["info"]
+
+    def qr(self) -> CachedResource:
+        return self._entry()["qr"]
+
+    def page(self) -> CachedResource:
+        return self._entry()["page"]
+
+    def record_not_modified(self):
+        self._stats["not_modified"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "max_age_s": config.CONNECT_CACHE_MAX_AGE,
+        }
+
+
+# Instancia global
+connect_page_cache = ConnectPageCache()
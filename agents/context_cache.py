@@ -0,0 +1,157 @@
+"""
+Caché en memoria del contexto reciente de cada número
+
+Guarda los últimos CONTEXT_CACHE_TURNS mensajes de cada número en un ring
+buffer. Se alimenta al escribir (`conversation_log` llama a `record`) y, la
+primera vez que se pide un número, se completa con la base de datos. A partir
+de ahí construir el contexto para Groq no hace ninguna lectura.
+
+Límites globales: número de teléfonos y bytes de texto guardados. Cuando se
+superan se expulsan los números que llevan más tiempo sin actividad (LRU).
+"""
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from config import config
+from database import get_recent_conversations_async
+
+# Los mensajes muy largos se recortan: solo sirven de contexto
+MAX_MESSAGE_CHARS = 1000
+
+
+@dataclass
+class Turn:
+    """Mensaje reciente (mismos atributos que ConversationHistoryDB)"""
+    direction: str
+    message: str
+    intent: Optional[str] = None
+    message_sid: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.utcnow)
+
+
+class _Entry:
+    __slots__ = ("turns", "loaded", "size")
+
+    def __init__(self, maxlen: int):
+        self.turns: deque = deque(maxlen=maxlen)
+        # True cuando ya se completó con la base de datos
+        self.loaded = False
+        self.size = 0
+
+
+class ConversationContextCache:
+    """Ring buffer de mensajes recientes por número, con expulsión LRU"""
+
+    def __init__(self, turns_per_phone: int = None, max_phones: int = None, max_bytes: int = None):
+        self.turns_per_phone = turns_per_phone or config.CONTEXT_CACHE_TURNS
+        self.max_phones = max_phones or config.CONTEXT_CACHE_MAX_PHONES
+        self.max_bytes = max_bytes or config.CONTEXT_CACHE_MAX_BYTES
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def record(
+        self,
+        phone_number: str,
+        message: str,
+        direction: str,
+        message_sid: str = None,
+        intent: str = None,
+        created_at: datetime = None
+    ):
+        """Añade un mensaje al buffer del número (llamado al escribir el historial)"""
+        entry = self._touch(phone_number)
+        turn = Turn(direction, (message or "")[:MAX_MESSAGE_CHARS], intent, message_sid, created_at or datetime.utcnow())
+        self._append(entry, turn)
+        self._evict()
+
+    def tag_intent(self, phone_number: str, message_sids: List[str], intent: str):
+        entry = self._entries.get(phone_number)
+        if entry is None:
+            return
+        sids = set(message_sids)
+        for turn in entry.turns:
+            if turn.message_sid in sids and turn.direction == "inbound":
+                turn.intent = intent
+
+    async def get_recent(self, phone_number: str, limit: int = 5) -> List[Turn]:
+        """Últimos mensajes del número, del más reciente al más antiguo"""
+        entry = self._entries.get(phone_number)
+        if entry is not None and entry.loaded:
+            self._entries.move_to_end(phone_number)
+            self._stats["hits"] += 1
+            return list(reversed(entry.turns))[:limit]
+
+        self._stats["misses"] += 1
+        rows = await get_recent_conversations_async(phone_number, limit=self.turns_per_phone)
+
+        # Lo registrado mientras tanto (o aún sin volcar) se mantiene detrás
+        entry = self._touch(phone_number)
+        seen = {(t.created_at, t.direction, t.message) for t in entry.turns}
+        merged = []
+        for row in reversed(rows):
+            turn = Turn(row.direction, (row.message or "")[:MAX_MESSAGE_CHARS], row.intent, row.message_sid, row.created_at)
+            if (turn.created_at, turn.direction, turn.message) not in seen:
+                merged.append(turn)
+        merged.extend(entry.turns)
+
+        self._bytes -= entry.size
+        entry.turns.clear()
+        entry.size = 0
+        for turn in merged:
+            self._append(entry, turn)
+        entry.loaded = True
+        self._evict()
+        return list(reversed(entry.turns))[:limit]
+
+    def forget(self, phone_number: str):
+        entry = self._entries.pop(phone_number, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _touch(self, phone_number: str) -> _Entry:
+        entry = self._entries.get(phone_number)
+        if entry is None:
+            entry = self._entries[phone_number] = _Entry(self.turns_per_phone)
+        else:
+            self._entries.move_to_end(phone_number)
+        return entry
+
+    def _append(self, entry: _Entry, turn: Turn):
+        if len(entry.turns) == entry.turns.maxlen:
+            dropped = entry.turns[0]
+            entry.size -= len(dropped.message)
+            self._bytes -= len(dropped.message)
+        entry.turns.append(turn)
+        entry.size += len(turn.message)
+        self._bytes += len(turn.message)
+
+    def _evict(self):
+        # Nunca se expulsa el número recién usado (el último)
+        while len(self._entries) > 1 and (len(self._entries) > self.max_phones or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            "phones": len(self._entries),
+            "max_phones": self.max_phones,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "turns_per_phone": self.turns_per_phone,
+        }
+
+
+# Instancia global
+context_cache = ConversationContextCache()
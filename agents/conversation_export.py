@@ -0,0 +1,99 @@
+"""
+Exportación en streaming del historial de conversaciones (NDJSON o CSV)
+
+Las filas se leen por bloques de EXPORT_CHUNK_SIZE con un cursor sobre `id`
+(cada bloque en su propia sesión) y se escriben a la respuesta según llegan:
+la memoria usada no depende del tamaño de la exportación.
+"""
+import csv
+import io
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Dict, Any, List, AsyncIterator
+
+from sqlalchemy import select, or_
+
+from config import config
+from database import AsyncSessionLocal, ConversationHistoryDB
+
+EXPORT_COLUMNS = ["id", "phone_number", "direction", "message", "intent", "message_sid", "created_at"]
+
+
+@dataclass
+class ExportFilters:
+    phone_number: Optional[str] = None
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None  # exclusivo
+    direction: Optional[str] = None
+    intent: Optional[str] = None
+
+    def apply(self, query):
+        table = ConversationHistoryDB
+        if self.phone_number:
+            query = query.where(table.phone_number == self.phone_number)
+        if self.start:
+            query = query.where(table.created_at >= self.start)
+        if self.end:
+            query = query.where(table.created_at < self.end)
+        if self.direction:
+            query = query.where(table.direction == self.direction)
+        if self.intent:
+            # Los turnos con varias acciones guardan "A+B": vale cualquiera de ellas
+            query = query.where(or_(
+                table.intent == self.intent,
+                table.intent.like(f"{self.intent}+%"),
+                table.intent.like(f"%+{self.intent}"),
+                table.intent.like(f"%+{self.intent}+%"),
+            ))
+        return query
+
+
+def _row_to_dict(row) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "phone_number": row.phone_number,
+        "direction": row.direction,
+        "message": row.message,
+        "intent": row.intent,
+        "message_sid": row.message_sid,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+async def iter_conversation_chunks(filters: ExportFilters, chunk_size: int = None) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Bloques de filas del historial en orden de id"""
+    chunk_size = chunk_size or config.EXPORT_CHUNK_SIZE
+    columns = [getattr(ConversationHistoryDB, name) for name in EXPORT_COLUMNS]
+    last_id = 0
+    while True:
+        query = filters.apply(
+            select(*columns)
+            .where(ConversationHistoryDB.id > last_id)
+            .order_by(ConversationHistoryDB.id)
+            .limit(chunk_size)
+        )
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(query)).all()
+        if rows:
+            yield [_row_to_dict(row) for row in rows]
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1].id
+
+
+async def export_ndjson(filters: ExportFilters) -> AsyncIterator[str]:
+    async for chunk in iter_conversation_chunks(filters):
+        yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk)
+
+
+async def export_csv(filters: ExportFilters) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    async for chunk in iter_conversation_chunks(filters):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
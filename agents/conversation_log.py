@@ -0,0 +1,254 @@
+"""
+Escritura diferida (write-behind) del historial de conversaciones
+
+Los mensajes se acumulan en memoria y se insertan en bloque cada
+CONVERSATION_LOG_FLUSH_INTERVAL segundos o cuando el buffer llega a
+CONVERSATION_LOG_MAX_BUFFER filas: una transacción por lote en lugar de un
+commit por fila.
+
+Cada fila se identifica por (teléfono, MessageSid o hash del contenido,
+dirección); un mismo mensaje registrado dos veces antes del volcado se guarda
+una sola vez. El intent de un mensaje entrante se añade después con
+`tag_intent` (la fila la escribe el webhook, el intent se conoce al procesarla).
+
+Al apagar se vuelca todo; si la base de datos no está disponible, las filas
+se guardan en un fichero JSONL que se reinserta en el siguiente arranque. Una
+fila que falla en CONVERSATION_LOG_MAX_ATTEMPTS volcados seguidos (p. ej. una
+fila inválida que tumba todo su lote) también pasa al fichero, para que no
+bloquee los volcados siguientes ni haga crecer el buffer sin límite.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Tuple
+
+from sqlalchemy import insert, update, bindparam
+
+from config import config
+from change_feed import change_feed
+from context_cache import context_cache
+from database import AsyncSessionLocal, ConversationHistoryDB
+
+logger = logging.getLogger(__name__)
+
+
+def _dedupe_key(phone_number: str, message: str, direction: str, message_sid: str = None) -> Tuple[str, str, str]:
+    ref = message_sid or "h:" + hashlib.sha1((message or "").encode("utf-8")).hexdigest()
+    return (phone_number, ref, direction)
+
+
+class ConversationLogWriter:
+    """Buffer del historial con volcado periódico en bloque"""
+
+    def __init__(self, flush_interval: float = None, max_buffer: int = None, spill_path: str = None,
+                 max_attempts: int = None):
+        self.flush_interval = flush_interval or config.CONVERSATION_LOG_FLUSH_INTERVAL
+        self.max_buffer = max_buffer or config.CONVERSATION_LOG_MAX_BUFFER
+        self.spill_path = spill_path or config.CONVERSATION_LOG_SPILL_PATH
+        self.max_attempts = max_attempts or config.CONVERSATION_LOG_MAX_ATTEMPTS
+
+        # Filas pendientes, en orden de llegada (los dict conservan el orden)
+        self._rows: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        # Intents para filas ya volcadas: message_sid -> intent
+        self._intents: Dict[str, str] = {}
+        # Volcados fallidos de cada fila (clave de _rows) o intent (message_sid) pendiente
+        self._attempts: Dict[Any, int] = {}
+
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {
+            "logged": 0,
+            "deduped": 0,
+            "flushes": 0,
+            "rows_written": 0,
+            "intent_updates": 0,
+            "failed_flushes": 0,
+            "spilled": 0,
+            "diverted": 0,
+        }
+
+    async def start(self):
+        """Reinserta lo que quedó en el fichero de respaldo y arranca el volcado periódico"""
+        self._load_spill()
+        if self._rows or self._intents:
+            await self.flush()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detiene el volcado periódico y vuelca todo lo pendiente"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not await self.flush():
+            self._spill()
+
+    def log(
+        self,
+        phone_number: str,
+        message: str,
+        direction: str,
+        message_sid: str = None,
+        intent: str = None
+    ):
+        """Registra un mensaje (no bloquea; se escribe en el próximo volcado)"""
+        key = _dedupe_key(phone_number, message, direction, message_sid)
+        existing = self._rows.get(key)
+        if existing is not None:
+            self._stats["deduped"] += 1
+            if intent and not existing["intent"]:
+                existing["intent"] = intent
+            return
+
+        row = self._rows[key] = {
+            "phone_number": phone_number,
+            "message_sid": message_sid or None,
+            "direction": direction,
+            "message": message,
+            "intent": intent,
+            "created_at": datetime.utcnow(),
+        }
+        context_cache.record(phone_number, message, direction, row["message_sid"], intent, row["created_at"])
+        self._stats["logged"] += 1
+        if len(self._rows) >= self.max_buffer:
+            self._wakeup.set()
+
+    def tag_intent(self, phone_number: str, message_sids: List[str], intent: str):
+        """Asigna el intent a mensajes entrantes ya registrados por su MessageSid"""
+        context_cache.tag_intent(phone_number, message_sids, intent)
+        for sid in message_sids:
+            if not sid:
+                continue
+            row = self._rows.get((phone_number, sid, "inbound"))
+            if row is not None:
+                row["intent"] = intent
+            else:
+                self._intents[sid] = intent
+
+    async def flush(self) -> bool:
+        """Escribe el buffer en una sola transacción. Devuelve False si falló."""
+        async with self._lock:
+            if not self._rows and not self._intents:
+                return True
+            rows, self._rows = self._rows, {}
+            intents, self._intents = self._intents, {}
+
+            try:
+                async with AsyncSessionLocal() as db:
+                    table = ConversationHistoryDB.__table__
+                    if rows:
+                        await db.execute(insert(table), list(rows.values()))
+                    if intents:
+                        await db.execute(
+                            update(table)
+                            .where(table.c.message_sid == bindparam("sid"))
+                            .where(table.c.direction == "inbound")
+                            .values(intent=bindparam("new_intent")),
+                            [{"sid": sid, "new_intent": intent} for sid, intent in intents.items()]
+                        )
+                    await db.commit()
+            except Exception as e:
+                self._stats["failed_flushes"] += 1
+                stuck_rows = {key: rows.pop(key) for key in self._exhausted(rows)}
+                stuck_intents = {sid: intents.pop(sid) for sid in self._exhausted(intents)}
+                # Devolver al buffer (delante de lo que llegó mientras tanto)
+                rows.update(self._rows)
+                self._rows = rows
+                intents.update(self._intents)
+                self._intents = intents
+                logger.error(f"❌ Error volcando historial ({len(rows)} filas pendientes): {str(e)}")
+                if stuck_rows or stuck_intents:
+                    self._stats["diverted"] += len(stuck_rows)
+                    self._write_spill(stuck_rows, stuck_intents)
+                return False
+
+            for key in list(rows) + list(intents):
+                self._attempts.pop(key, None)
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += len(rows)
+            self.publish(rows.values())
+            self._stats["intent_updates"] += len(intents)
+            return True
+
+    def publish(self, rows):
+        """Publica en el feed de cambios filas del historial ya escritas"""
+        for row in rows:
+            change_feed.publish("message", row["phone_number"], {
+                "direction": row["direction"],
+                "message": row["message"],
+                "message_sid": row["message_sid"],
+                "intent": row["intent"],
+                "created_at": row["created_at"].isoformat(),
+            })
+
+    def _exhausted(self, pending: Dict[Any, Any]) -> List[Any]:
+        """Cuenta un fallo más a cada clave; devuelve las que ya no se reintentan"""
+        exhausted = []
+        for key in pending:
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+            if self._attempts[key] >= self.max_attempts:
+                del self._attempts[key]
+                exhausted.append(key)
+        return exhausted
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _spill(self):
+        """Guarda en disco lo que no se pudo volcar a la base de datos"""
+        if not self._rows and not self._intents:
+            return
+        self._write_spill(self._rows, self._intents)
+        self._rows, self._intents = {}, {}
+        self._attempts.clear()
+
+    def _write_spill(self, rows: Dict[Tuple[str, str, str], Dict[str, Any]], intents: Dict[str, str]):
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for row in rows.values():
+                f.write(json.dumps({**row, "created_at": row["created_at"].isoformat()}, ensure_ascii=False) + "\n")
+            for sid, intent in intents.items():
+                f.write(json.dumps({"tag_sid": sid, "intent": intent}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._stats["spilled"] += len(rows)
+        logger.warning(f"⚠️ {len(rows)} filas del historial guardadas en {self.spill_path}")
+
+    def _load_spill(self):
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "tag_sid" in record:
+                    self._intents[record["tag_sid"]] = record["intent"]
+                    continue
+                record["created_at"] = datetime.fromisoformat(record["created_at"])
+                key = _dedupe_key(record["phone_number"], record["message"], record["direction"], record["message_sid"])
+                self._rows[key] = record
+        os.remove(self.spill_path)
+        logger.info(f"✅ {len(self._rows)} filas recuperadas de {self.spill_path}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "buffered": len(self._rows),
+            "pending_intents": len(self._intents),
+            "flush_interval_s": self.flush_interval,
+            "max_buffer": self.max_buffer,
+        }
+
+
+# Instancia global
+conversation_log = ConversationLogWriter()
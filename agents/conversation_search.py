@@ -0,0 +1,99 @@
+"""
+Búsqueda de texto completo en el historial de conversaciones (SQLite FTS5)
+
+La consulta del usuario se traduce a la sintaxis de FTS5 sin exponerla:
+- "frase exacta" entre comillas
+- prefijo con asterisco: `rev*`
+- el resto de palabras deben aparecer todas (AND)
+
+Los resultados se ordenan por relevancia (bm25) o por fecha, con un
+fragmento del mensaje en el que se marcan las coincidencias con [ ].
+El historial archivado (anterior a la retención) no está en el índice.
+"""
+import re
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import text
+
+from database import AsyncSessionLocal, CONVERSATION_FTS_TABLE
+
+_QUERY_TOKENS = re.compile(r'"([^"]*)"|(\S+)')
+# Caracteres con significado en FTS5 fuera de una cadena entre comillas
+_WORD_STRIP = re.compile(r'["()^:+{}\[\],]')
+
+SNIPPET_TOKENS = 12
+
+
+def build_match_query(query: str) -> str:
+    """Convierte la búsqueda del usuario en una expresión MATCH segura"""
+    terms: List[str] = []
+    for phrase, word in _QUERY_TOKENS.findall(query or ""):
+        if phrase:
+            phrase = phrase.strip()
+            if phrase:
+                terms.append('"' + phrase + '"')
+            continue
+        prefix = word.endswith("*")
+        word = _WORD_STRIP.sub(" ", word.rstrip("*")).strip()
+        # AND/OR/NOT/NEAR como palabras sueltas serían operadores
+        for part in word.split():
+            terms.append('"' + part + '"')
+        if prefix and terms and word:
+            terms[-1] += "*"
+    if not terms:
+        raise ValueError("Empty search query")
+    return " ".join(terms)
+
+
+async def search_conversations(
+    query: str,
+    phone_number: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    order: str = "rank",
+    limit: int = 20,
+    offset: int = 0
+) -> List[Dict[str, Any]]:
+    """Mensajes que coinciden con la búsqueda, con fragmento y puntuación"""
+    conditions = [f"{CONVERSATION_FTS_TABLE} MATCH :match"]
+    params: Dict[str, Any] = {"match": build_match_query(query), "limit": limit, "offset": offset}
+    if phone_number:
+        conditions.append("h.phone_number = :phone")
+        params["phone"] = phone_number
+    # Mismo formato de texto que usa SQLAlchemy para DateTime en SQLite
+    if start:
+        conditions.append("h.created_at >= :start")
+        params["start"] = start.strftime("%Y-%m-%d %H:%M:%S.%f")
+    if end:
+        conditions.append("h.created_at < :end")
+        params["end"] = end.strftime("%Y-%m-%d %H:%M:%S.%f")
+    order_by = "h.created_at DESC, h.id DESC" if order == "recent" else "score, h.id DESC"
+
+    sql = text(f"""
+        SELECT h.id, h.phone_number, h.direction, h.intent, h.message_sid, h.created_at,
+               snippet({CONVERSATION_FTS_TABLE}, 0, '[', ']', '…', {SNIPPET_TOKENS}) AS snippet,
+               bm25({CONVERSATION_FTS_TABLE}) AS score
+        FROM {CONVERSATION_FTS_TABLE}
+        JOIN conversation_history h ON h.id = {CONVERSATION_FTS_TABLE}.rowid
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {order_by}
+        LIMIT :limit OFFSET :offset
+    """)
+    async with AsyncSessionLocal() as db:
+        rows = (await db.execute(sql, params)).mappings().all()
+
+    return [
+        {
+            "id": row["id"],
+            "phone_number": row["phone_number"],
+            "direction": row["direction"],
+            "intent": row["intent"],
+            "message_sid": row["message_sid"],
+            "created_at": row["created_at"],
+            "snippet": row["snippet"],
+            # bm25 es negativo: cuanto menor, más relevante
+            "score": round(-row["score"], 4),
+        }
+        for row in rows
+    ]
@@ -1,10 +1,13 @@
 """
 Base de datos local para almacenar relaciones WhatsApp -> Usuario
 """
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text
+from sqlalchemy import create_engine, event, select, delete, literal, text, Index, Column, Integer, String, Boolean, DateTime, Text, LargeBinary
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.dialects import sqlite, postgresql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
 from config import config
 
 Base = declarative_base()
@@ -33,6 +36,159 @@ class ConversationHistoryDB(Base):
     message = Column(Text, nullable=False)
     intent = Column(String(50), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Historial reciente de un número: búsqueda por rango, sin ordenar en memoria
+        Index("ix_conversation_history_phone_created", "phone_number", "created_at"),
+        # Asignar el intent por MessageSid (conversation_log.tag_intent)
+        Index("ix_conversation_history_message_sid", "message_sid"),
+    )
+
+class BroadcastDB(Base):
+    """Envío masivo a usuarios verificados (progreso reanudable)"""
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message = Column(Text, nullable=False)
+    status = Column(String(20), nullable=False, default="pending")  # pending, running, cancelled, completed, failed
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    cursor = Column(Integer, default=0)  # último whatsapp_users.id procesado (keyset)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class BroadcastFailureDB(Base):
+    """Destinatarios de un broadcast a los que no se pudo enviar"""
+    __tablename__ = "broadcast_failures"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    broadcast_id = Column(Integer, nullable=False, index=True)
+    phone_number = Column(String(50), nullable=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class InboundTaskDB(Base):
+    """Mensajes entrantes pendientes de procesar en modo multiproceso (ver worker_processes.py)"""
+    __tablename__ = "inbound_queue"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    partition = Column(Integer, nullable=False)  # phone_partition(phone_number, INBOUND_PROCESSES)
+    phone_number = Column(String(50), nullable=False)
+    body = Column(Text, nullable=False)
+    message_sid = Column(String(100), nullable=True)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_inbound_queue_partition_id", "partition", "id"),
+        # Los workers leen por id creciente: no se reutilizan ids al vaciarse la cola
+        {"sqlite_autoincrement": True},
+    )
+
+class OutboundMessageDB(Base):
+    """Cola persistente de mensajes de WhatsApp pendientes de enviar"""
+    __tablename__ = "outbound_queue"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    phone_number = Column(String(50), nullable=False)
+    body = Column(Text, nullable=False)
+    source = Column(String(20), nullable=False, default="reply")  # reply, api, error
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    received_at = Column(DateTime, nullable=True)  # llegada del mensaje al que responde
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Cabeza de la cola de cada número (orden por destinatario)
+        Index("ix_outbound_queue_phone_id", "phone_number", "id"),
+    )
+
+class OutboundDeadLetterDB(Base):
+    """Mensajes que no se pudieron enviar (error definitivo o reintentos agotados)"""
+    __tablename__ = "outbound_dead_letters"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    phone_number = Column(String(50), nullable=False, index=True)
+    body = Column(Text, nullable=False)
+    source = Column(String(20), nullable=True)
+    attempts = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=True)  # cuando se encoló
+    failed_at = Column(DateTime, default=datetime.utcnow)
+
+class WebappOutboxDB(Base):
+    """Escrituras pendientes en la API de la webapp (se aplican en orden por número)"""
+    __tablename__ = "webapp_outbox"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    phone_number = Column(String(50), nullable=False)
+    auth_token = Column(Text, nullable=True)
+    operation = Column(String(50), nullable=False)  # create_goal, complete_goal, add_metric...
+    payload = Column(Text, nullable=False)  # JSON con los argumentos
+    idempotency_key = Column(String(64), unique=True, nullable=False)
+    status = Column(String(20), default="pending")  # pending, failed, unknown (puede que se aplicara)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_webapp_outbox_status_phone_id", "status", "phone_number", "id"),
+    )
+
+class MessageTimingDB(Base):
+    """Tiempos de un mensaje saliente hasta que Twilio lo acepta"""
+    __tablename__ = "message_timings"
+    
+    message_sid = Column(String(100), primary_key=True)
+    phone_number = Column(String(50), nullable=False)
+    source = Column(String(20), nullable=True)
+    received_at = Column(DateTime, nullable=True)  # mensaje entrante (solo respuestas)
+    queued_at = Column(DateTime, nullable=True)
+    accepted_at = Column(DateTime, nullable=False, index=True)  # Twilio devolvió el SID
+
+class MessageStatusDB(Base):
+    """Callbacks de estado de Twilio (sent, delivered, read, failed...)"""
+    __tablename__ = "message_statuses"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message_sid = Column(String(100), nullable=False)
+    phone_number = Column(String(50), nullable=True)  # "To" del callback
+    status = Column(String(20), nullable=False)
+    error_code = Column(String(20), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (
+        Index("ix_message_statuses_sid_status", "message_sid", "status"),
+    )
+
+class ProcessedMessageDB(Base):
+    """MessageSid de Twilio ya aceptados (idempotencia del webhook)"""
+    __tablename__ = "processed_messages"
+    
+    message_sid = Column(String(100), primary_key=True)  # índice único
+    phone_number = Column(String(50), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class ConversationArchiveDB(Base):
+    """Segmento comprimido de historial antiguo de un número (ver history_retention.py)"""
+    __tablename__ = "conversation_archive"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    phone_number = Column(String(50), nullable=False)
+    start_at = Column(DateTime, nullable=False)
+    end_at = Column(DateTime, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)  # JSON lines comprimido con zlib
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_conversation_archive_phone_end", "phone_number", "end_at"),
+    )
 
 class PendingActionDB(Base):
     """Acciones pendientes en conversaciones"""
@@ -45,13 +201,115 @@ class PendingActionDB(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     expires_at = Column(DateTime, nullable=True)
 
+# Driver async de cada esquema de DATABASE_URL sin driver explícito
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+def _async_url(url: str) -> str:
+    """sqlite:///x.db -> sqlite+aiosqlite:///x.db, postgresql://... -> postgresql+asyncpg://..."""
+    scheme, _, rest = url.partition(":")
+    if scheme in ASYNC_DRIVERS:
+        return f"{ASYNC_DRIVERS[scheme]}:{rest}"
+    if "+" in scheme:
+        # Driver indicado en la URL (p. ej. postgresql+asyncpg://)
+        return url
+    raise ValueError(
+        f"DATABASE_URL: no hay driver async para '{scheme}'; usa sqlite://, postgresql:// "
+        f"o indica el driver (esquema+driver://)"
+    )
+
+def phone_partition(phone_number: str, partitions: int) -> int:
+    """Partición estable de un número (igual en todos los procesos, a diferencia de hash())"""
+    return zlib.crc32(phone_number.encode("utf-8")) % partitions
+
+def _tune_sqlite(dbapi_connection, connection_record):
+    """WAL (lectores no bloquean al escritor) y espera en vez de 'database is locked'"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+    # Para que cada proceso worker filtre en SQL las colas de sus números
+    dbapi_connection.create_function("phone_partition", 2, phone_partition)
+
 # Crear engine y session
 engine = create_engine(config.DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine)
 
+# Engine async (aiosqlite) para el camino de los mensajes: las conexiones se
+# reutilizan desde el pool y las consultas no bloquean el event loop
+async_engine = create_async_engine(
+    _async_url(config.DATABASE_URL),
+    echo=False,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_POOL_SIZE,
+    pool_pre_ping=False,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+if config.DATABASE_URL.startswith("sqlite"):
+    event.listen(engine, "connect", _tune_sqlite)
+    event.listen(async_engine.sync_engine, "connect", _tune_sqlite)
+
+# Índice FTS5 de contenido externo sobre conversation_history.message: solo
+# guarda el índice invertido; el texto se lee de la tabla original por rowid.
+# Los triggers lo mantienen al día en cada INSERT/DELETE (también en bloque).
+CONVERSATION_FTS_TABLE = "conversation_fts"
+
+CONVERSATION_FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE {CONVERSATION_FTS_TABLE} USING fts5(
+        message,
+        content='conversation_history',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS conversation_fts_insert AFTER INSERT ON conversation_history BEGIN
+        INSERT INTO {CONVERSATION_FTS_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS conversation_fts_delete AFTER DELETE ON conversation_history BEGIN
+        INSERT INTO {CONVERSATION_FTS_TABLE}({CONVERSATION_FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS conversation_fts_update AFTER UPDATE OF message ON conversation_history BEGIN
+        INSERT INTO {CONVERSATION_FTS_TABLE}({CONVERSATION_FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO {CONVERSATION_FTS_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+]
+
+def init_search_index():
+    """Crea el índice de búsqueda (solo SQLite) y lo rellena con el historial existente"""
+    if not config.DATABASE_URL.startswith("sqlite"):
+        return
+    with engine.begin() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {"name": CONVERSATION_FTS_TABLE}
+        ).first()
+        if exists:
+            return
+        for statement in CONVERSATION_FTS_DDL:
+            conn.execute(text(statement))
+        conn.execute(text(f"INSERT INTO {CONVERSATION_FTS_TABLE}({CONVERSATION_FTS_TABLE}) VALUES ('rebuild')"))
+
 def init_db():
     """Inicializa la base de datos creando las tablas"""
     Base.metadata.create_all(bind=engine)
+    # create_all no añade índices nuevos a tablas que ya existen
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    init_search_index()
+
+async def init_async_db():
+    """Abre el pool async por adelantado (las tablas ya las crea init_db)"""
+    async with async_engine.connect():
+        pass
+
+async def close_async_db():
+    """Cierra las conexiones del pool async"""
+    await async_engine.dispose()
 
 def get_db():
     """Obtiene una sesión de base de datos"""
@@ -137,27 +395,38 @@ def get_pending_action(phone_number: str) -> PendingActionDB | None:
     """Obtiene la acción pendiente para un usuario"""
     db = SessionLocal()
     try:
-        return db.query(PendingActionDB).filter(
+        action = db.query(PendingActionDB).filter(
             PendingActionDB.phone_number == phone_number
         ).first()
+        return None if is_pending_action_expired(action) else action
     finally:
         db.close()
 
+def _pending_action_upsert(phone_number: str, action_type: str, action_data: str = None):
+    """INSERT ... ON CONFLICT (phone_number) DO UPDATE: reemplaza la acción en una sola sentencia"""
+    now = datetime.utcnow()
+    values = {
+        "phone_number": phone_number,
+        "action_type": action_type,
+        "action_data": action_data,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=config.PENDING_ACTION_TTL),
+    }
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    stmt = insert(PendingActionDB).values(**values)
+    return stmt.on_conflict_do_update(
+        index_elements=[PendingActionDB.phone_number],
+        set_={k: stmt.excluded[k] for k in ("action_type", "action_data", "created_at", "expires_at")}
+    )
+
+def is_pending_action_expired(action: PendingActionDB | None) -> bool:
+    return action is not None and action.expires_at is not None and action.expires_at < datetime.utcnow()
+
 def set_pending_action(phone_number: str, action_type: str, action_data: str = None):
     """Establece una acción pendiente"""
     db = SessionLocal()
     try:
-        # Eliminar acción anterior si existe
-        db.query(PendingActionDB).filter(
-            PendingActionDB.phone_number == phone_number
-        ).delete()
-        
-        action = PendingActionDB(
-            phone_number=phone_number,
-            action_type=action_type,
-            action_data=action_data
-        )
-        db.add(action)
+        db.execute(_pending_action_upsert(phone_number, action_type, action_data))
         db.commit()
     finally:
         db.close()
@@ -182,3 +451,134 @@ def get_recent_conversations(phone_number: str, limit: int = 10):
         ).order_by(ConversationHistoryDB.created_at.desc()).limit(limit).all()
     finally:
         db.close()
+
+
+# ============================================
+# VERSIONES ASYNC (sin bloquear el event loop)
+# ============================================
+
+async def get_whatsapp_user_async(phone_number: str) -> WhatsAppUserDB | None:
+    """Obtiene un usuario de WhatsApp por número de teléfono"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(WhatsAppUserDB).where(WhatsAppUserDB.phone_number == phone_number).limit(1)
+        )
+        return result.scalars().first()
+
+async def create_or_update_whatsapp_user_async(
+    phone_number: str, 
+    user_id: int = None, 
+    auth_token: str = None,
+    email: str = None,
+    is_verified: bool = False
+) -> WhatsAppUserDB:
+    """Crea o actualiza un usuario de WhatsApp"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(WhatsAppUserDB).where(WhatsAppUserDB.phone_number == phone_number).limit(1)
+        )
+        user = result.scalars().first()
+        
+        if user:
+            if user_id is not None:
+                user.user_id = user_id
+            if auth_token is not None:
+                user.auth_token = auth_token
+            if email is not None:
+                user.email = email
+            user.is_verified = is_verified
+            user.updated_at = datetime.utcnow()
+        else:
+            user = WhatsAppUserDB(
+                phone_number=phone_number,
+                user_id=user_id,
+                auth_token=auth_token,
+                email=email,
+                is_verified=is_verified
+            )
+            db.add(user)
+        
+        await db.commit()
+        await db.refresh(user)
+        return user
+
+async def save_conversation_async(
+    phone_number: str, 
+    message: str, 
+    direction: str,
+    message_sid: str = None,
+    intent: str = None
+):
+    """Guarda un mensaje en el historial"""
+    async with AsyncSessionLocal() as db:
+        db.add(ConversationHistoryDB(
+            phone_number=phone_number,
+            message_sid=message_sid,
+            direction=direction,
+            message=message,
+            intent=intent
+        ))
+        await db.commit()
+
+async def get_user_and_pending_async(phone_number: str) -> tuple:
+    """Usuario y acción pendiente (no caducada) de un número en una sola consulta"""
+    phone = select(literal(phone_number).label("phone_number")).subquery()
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(WhatsAppUserDB, PendingActionDB)
+            .select_from(phone)
+            .outerjoin(WhatsAppUserDB, WhatsAppUserDB.phone_number == phone.c.phone_number)
+            .outerjoin(PendingActionDB, PendingActionDB.phone_number == phone.c.phone_number)
+        )
+        user, pending = result.one()
+        if is_pending_action_expired(pending):
+            pending = None
+        return user, pending
+
+async def claim_message_sid_async(message_sid: str, phone_number: str) -> bool:
+    """Registra el MessageSid. Devuelve False si ya estaba (reintento de Twilio)."""
+    insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            insert(ProcessedMessageDB)
+            .values(message_sid=message_sid, phone_number=phone_number, created_at=datetime.utcnow())
+            .on_conflict_do_nothing(index_elements=[ProcessedMessageDB.message_sid])
+        )
+        await db.commit()
+        return result.rowcount == 1
+
+async def get_pending_action_async(phone_number: str) -> PendingActionDB | None:
+    """Obtiene la acción pendiente para un usuario"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(PendingActionDB).where(PendingActionDB.phone_number == phone_number).limit(1)
+        )
+        action = result.scalars().first()
+        return None if is_pending_action_expired(action) else action
+
+async def set_pending_action_async(phone_number: str, action_type: str, action_data: str = None):
+    """Establece una acción pendiente"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            _pending_action_upsert(phone_number, action_type, action_data).returning(PendingActionDB)
+        )
+        action = result.scalars().one()
+        await db.commit()
+        return action
+
+async def clear_pending_action_async(phone_number: str):
+    """Elimina la acción pendiente"""
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(PendingActionDB).where(PendingActionDB.phone_number == phone_number))
+        await db.commit()
+
+async def get_recent_conversations_async(phone_number: str, limit: int = 10):
+    """Obtiene las conversaciones recientes de un usuario"""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(ConversationHistoryDB)
+            .where(ConversationHistoryDB.phone_number == phone_number)
+            .order_by(ConversationHistoryDB.created_at.desc())
+            .limit(limit)
+        )
+        return result.scalars().all()
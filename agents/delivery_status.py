@@ -0,0 +1,343 @@
+"""
+Estados de entrega de Twilio y latencia de extremo a extremo por mensaje
+
+Cada mensaje saliente deja sus tiempos en `message_timings` cuando Twilio
+devuelve el SID (llegada del mensaje al que responde, encolado y aceptación).
+Los callbacks de `/webhook/whatsapp/status` (sent, delivered, read, failed...)
+se guardan en `message_statuses`. Ambos se acumulan en memoria y se insertan
+en bloque, igual que el historial.
+
+El informe une las dos tablas por MessageSid y reparte la latencia por tramos:
+
+    recibido → encolado → aceptado por Twilio → sent → delivered → read
+
+Los callbacks pendientes de volcar se pierden si el proceso cae: son
+métricas, no estado. Si la base de datos falla al apagar, o una fila falla en
+DELIVERY_STATUS_MAX_ATTEMPTS volcados seguidos (y así no bloquea a las
+demás), se guarda en un fichero JSONL que se reinserta al arrancar.
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import select, insert, delete, func, case
+
+from change_feed import change_feed
+from config import config
+from database import SessionLocal, AsyncSessionLocal, MessageTimingDB, MessageStatusDB
+
+logger = logging.getLogger(__name__)
+
+# Límites superiores de los buckets de los histogramas (ms); el último es abierto
+HISTOGRAM_BUCKETS_MS = [250, 500, 1000, 2000, 5000, 10000, 30000, 60000, 300000]
+
+# Mensajes como máximo que entran en un informe
+MAX_REPORT_ROWS = 50000
+
+FAILED_STATUSES = ("failed", "undelivered")
+
+# Columnas de fecha de las filas que se guardan en el fichero de respaldo
+DATETIME_FIELDS = ("received_at", "queued_at", "accepted_at", "created_at")
+
+# Tramo -> (marca inicial, marca final)
+STAGES = {
+    "processing": ("received_at", "queued_at"),
+    "outbound_queue": ("queued_at", "accepted_at"),
+    "twilio_to_whatsapp": ("accepted_at", "sent_at"),
+    "delivery": ("sent_at", "delivered_at"),
+    "read": ("delivered_at", "read_at"),
+    "end_to_end": ("received_at", "delivered_at"),
+}
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * pct))
+    return round(values[index], 1)
+
+
+def _histogram(values: List[float]) -> Dict[str, Any]:
+    values = sorted(values)
+    counts = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+    bucket = 0
+    for value in values:
+        while bucket < len(HISTOGRAM_BUCKETS_MS) and value > HISTOGRAM_BUCKETS_MS[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    return {
+        "count": len(values),
+        "p50": _percentile(values, 0.50),
+        "p95": _percentile(values, 0.95),
+        "p99": _percentile(values, 0.99),
+        "max": round(values[-1], 1) if values else 0.0,
+        "buckets": [
+            {"le_ms": le, "count": count}
+            for le, count in zip(HISTOGRAM_BUCKETS_MS + [None], counts)
+        ],
+    }
+
+
+class DeliveryStatusTracker:
+    """Buffer de tiempos y callbacks de estado con volcado periódico en bloque"""
+
+    def __init__(self, flush_interval: float = None, max_buffer: int = None, spill_path: str = None,
+                 max_attempts: int = None):
+        self.flush_interval = flush_interval or config.DELIVERY_STATUS_FLUSH_INTERVAL
+        self.max_buffer = max_buffer or config.DELIVERY_STATUS_MAX_BUFFER
+        self.spill_path = spill_path or config.DELIVERY_STATUS_SPILL_PATH
+        self.max_attempts = max_attempts or config.DELIVERY_STATUS_MAX_ATTEMPTS
+
+        # sid -> fila
+        self._timings: Dict[str, Dict[str, Any]] = {}
+        # (sid, estado) -> fila; Twilio puede repetir un callback
+        self._statuses: Dict[tuple, Dict[str, Any]] = {}
+        # Volcados fallidos de cada fila pendiente (por su clave)
+        self._attempts: Dict[Any, int] = {}
+
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {
+            "accepted": 0,
+            "callbacks": 0,
+            "duplicate_callbacks": 0,
+            "flushes": 0,
+            "failed_flushes": 0,
+            "spilled": 0,
+        }
+
+    async def start(self):
+        self._load_spill()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not await self.flush():
+            self._write_spill(self._timings, self._statuses)
+            self._timings, self._statuses = {}, {}
+            self._attempts.clear()
+
+    def record_accepted(
+        self,
+        message_sid: str,
+        phone_number: str,
+        source: str = None,
+        received_at: datetime = None,
+        queued_at: datetime = None
+    ):
+        """Twilio aceptó un mensaje saliente (no bloquea)"""
+        if not message_sid:
+            return
+        self._timings[message_sid] = {
+            "message_sid": message_sid,
+            "phone_number": phone_number,
+            "source": source,
+            "received_at": received_at,
+            "queued_at": queued_at,
+            "accepted_at": datetime.utcnow(),
+        }
+        self._stats["accepted"] += 1
+        self._maybe_flush()
+
+    def record_status(self, message_sid: str, status: str, error_code: str = None, phone_number: str = None):
+        """Callback de estado de Twilio (no bloquea)"""
+        if not message_sid or not status:
+            return
+        key = (message_sid, status)
+        if key in self._statuses:
+            self._stats["duplicate_callbacks"] += 1
+            return
+        self._statuses[key] = {
+            "message_sid": message_sid,
+            "phone_number": phone_number or None,
+            "status": status,
+            "error_code": error_code or None,
+            "created_at": datetime.utcnow(),
+        }
+        self._stats["callbacks"] += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self._timings) + len(self._statuses) >= self.max_buffer:
+            self._wakeup.set()
+
+    async def flush(self) -> bool:
+        """Escribe el buffer en una sola transacción. Devuelve False si falló."""
+        async with self._lock:
+            if not self._timings and not self._statuses:
+                return True
+            timings, self._timings = self._timings, {}
+            statuses, self._statuses = self._statuses, {}
+
+            try:
+                async with AsyncSessionLocal() as db:
+                    if timings:
+                        await db.execute(insert(MessageTimingDB.__table__), list(timings.values()))
+                    if statuses:
+                        await db.execute(insert(MessageStatusDB.__table__), list(statuses.values()))
+                    await db.commit()
+            except Exception as e:
+                self._stats["failed_flushes"] += 1
+                stuck_timings = {sid: timings.pop(sid) for sid in self._exhausted(timings)}
+                stuck_statuses = {key: statuses.pop(key) for key in self._exhausted(statuses)}
+                timings.update(self._timings)
+                self._timings = timings
+                statuses.update(self._statuses)
+                self._statuses = statuses
+                logger.error(f"❌ Error volcando estados de entrega: {str(e)}")
+                if stuck_timings or stuck_statuses:
+                    self._write_spill(stuck_timings, stuck_statuses)
+                return False
+
+            for key in list(timings) + list(statuses):
+                self._attempts.pop(key, None)
+            self._stats["flushes"] += 1
+            for row in statuses.values():
+                change_feed.publish("delivery", row["phone_number"], {
+                    "message_sid": row["message_sid"],
+                    "status": row["status"],
+                    "error_code": row["error_code"],
+                })
+            return True
+
+    def _exhausted(self, pending: Dict[Any, Any]) -> List[Any]:
+        """Cuenta un fallo más a cada clave; devuelve las que ya no se reintentan"""
+        exhausted = []
+        for key in pending:
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+            if self._attempts[key] >= self.max_attempts:
+                del self._attempts[key]
+                exhausted.append(key)
+        return exhausted
+
+    def _write_spill(self, timings: Dict[str, Dict[str, Any]], statuses: Dict[tuple, Dict[str, Any]]):
+        """Guarda en disco filas que no se pudieron volcar a la base de datos"""
+        if not timings and not statuses:
+            return
+        with open(self.spill_path, "a", encoding="utf-8") as f:
+            for kind, rows in (("timing", timings), ("status", statuses)):
+                for row in rows.values():
+                    record = {
+                        key: value.isoformat() if key in DATETIME_FIELDS and value else value
+                        for key, value in row.items()
+                    }
+                    f.write(json.dumps({"kind": kind, **record}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._stats["spilled"] += len(timings) + len(statuses)
+        logger.warning(f"⚠️ {len(timings) + len(statuses)} estados de entrega guardados en {self.spill_path}")
+
+    def _load_spill(self):
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                kind = record.pop("kind")
+                for key in DATETIME_FIELDS:
+                    if record.get(key):
+                        record[key] = datetime.fromisoformat(record[key])
+                if kind == "timing":
+                    self._timings[record["message_sid"]] = record
+                else:
+                    self._statuses[(record["message_sid"], record["status"])] = record
+        os.remove(self.spill_path)
+        logger.info(f"✅ {len(self._timings) + len(self._statuses)} estados de entrega recuperados de {self.spill_path}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def report(self, minutes: int = 60) -> Dict[str, Any]:
+        """Histogramas de latencia por tramo de los mensajes aceptados en los últimos N minutos"""
+        since = datetime.utcnow() - timedelta(minutes=minutes)
+        status = MessageStatusDB.status
+        created_at = MessageStatusDB.created_at
+        statuses = (
+            select(
+                MessageStatusDB.message_sid.label("message_sid"),
+                func.min(case((status == "sent", created_at))).label("sent_at"),
+                func.min(case((status == "delivered", created_at))).label("delivered_at"),
+                func.min(case((status == "read", created_at))).label("read_at"),
+                func.min(case((status.in_(FAILED_STATUSES), created_at))).label("failed_at"),
+            )
+            .where(created_at >= since)
+            .group_by(MessageStatusDB.message_sid)
+            .subquery()
+        )
+        query = (
+            select(
+                MessageTimingDB.source,
+                MessageTimingDB.received_at,
+                MessageTimingDB.queued_at,
+                MessageTimingDB.accepted_at,
+                statuses.c.sent_at,
+                statuses.c.delivered_at,
+                statuses.c.read_at,
+                statuses.c.failed_at,
+            )
+            .outerjoin(statuses, statuses.c.message_sid == MessageTimingDB.message_sid)
+            .where(MessageTimingDB.accepted_at >= since)
+            .order_by(MessageTimingDB.accepted_at.desc())
+            .limit(MAX_REPORT_ROWS)
+        )
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(query)).mappings().all()
+
+        samples: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        outcomes = {"messages": len(rows), "sent": 0, "delivered": 0, "read": 0, "failed": 0, "no_callback": 0}
+        for row in rows:
+            for stage, (start_key, end_key) in STAGES.items():
+                start, end = row[start_key], row[end_key]
+                if start and end:
+                    samples[stage].append(max(0.0, (end - start).total_seconds() * 1000))
+            for key in ("sent", "delivered", "read", "failed"):
+                if row[f"{key}_at"]:
+                    outcomes[key] += 1
+            if not any(row[f"{key}_at"] for key in ("sent", "delivered", "read", "failed")):
+                outcomes["no_callback"] += 1
+
+        return {
+            "window_minutes": minutes,
+            "outcomes": outcomes,
+            "latency_ms": {stage: _histogram(values) for stage, values in samples.items()},
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "buffered": len(self._timings) + len(self._statuses),
+            "flush_interval_s": self.flush_interval,
+        }
+
+
+def prune_delivery_stats(retention_days: int = None) -> int:
+    """Borra tiempos y callbacks más antiguos que la retención"""
+    retention_days = config.DELIVERY_STATS_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    db = SessionLocal()
+    try:
+        deleted = db.execute(delete(MessageTimingDB).where(MessageTimingDB.accepted_at < cutoff)).rowcount
+        deleted += db.execute(delete(MessageStatusDB).where(MessageStatusDB.created_at < cutoff)).rowcount
+        db.commit()
+        return deleted
+    finally:
+        db.close()
+
+
+# Instancia global
+delivery_tracker = DeliveryStatusTracker()
@@ -0,0 +1,249 @@
+"""
+Retención y compactación del historial de conversaciones
+
+Con CONVERSATION_RETENTION_DAYS > 0 (por defecto no se archiva nada),
+`conversation_history` solo guarda los últimos CONVERSATION_RETENTION_DAYS
+días. Lo anterior se mueve, por número de teléfono, a segmentos comprimidos
+en `conversation_archive` (JSON lines + zlib, hasta
+CONVERSATION_ARCHIVE_SEGMENT_ROWS filas cada uno) y deja de servir para
+entrenar el router de intents y de aparecer en la búsqueda de texto completo.
+La compactación une segmentos pequeños del mismo número y deja el índice de
+búsqueda, el fichero WAL y las estadísticas del planificador al día. También
+se purgan los MessageSid de idempotencia que ya no pueden reintentarse y los
+tiempos y estados de entrega antiguos.
+
+El trabajo es por lotes y usa el engine sync, así que se ejecuta en un thread.
+"""
+import asyncio
+import json
+import logging
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import select, delete, text
+
+from config import config
+from database import SessionLocal, ConversationHistoryDB, ConversationArchiveDB, CONVERSATION_FTS_TABLE
+from idempotency import prune_processed_messages
+from delivery_status import prune_delivery_stats
+
+logger = logging.getLogger(__name__)
+
+
+def _pack(rows: List[Dict[str, Any]]) -> bytes:
+    lines = "\n".join(json.dumps(row, ensure_ascii=False) for row in rows)
+    return zlib.compress(lines.encode("utf-8"), 6)
+
+
+def _unpack(payload: bytes) -> List[Dict[str, Any]]:
+    data = zlib.decompress(payload).decode("utf-8")
+    return [json.loads(line) for line in data.split("\n") if line]
+
+
+def _row_to_dict(row: ConversationHistoryDB) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "message_sid": row.message_sid,
+        "direction": row.direction,
+        "message": row.message,
+        "intent": row.intent,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+def archive_old_conversations(retention_days: int = None, segment_rows: int = None) -> Dict[str, int]:
+    """Mueve el historial anterior al corte a segmentos comprimidos por número"""
+    retention_days = config.CONVERSATION_RETENTION_DAYS if retention_days is None else retention_days
+    segment_rows = segment_rows or config.CONVERSATION_ARCHIVE_SEGMENT_ROWS
+    result = {"phones": 0, "rows": 0, "segments": 0}
+    if retention_days <= 0:
+        return result
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    db = SessionLocal()
+    try:
+        phones = db.execute(
+            select(ConversationHistoryDB.phone_number)
+            .where(ConversationHistoryDB.created_at < cutoff)
+            .distinct()
+        ).scalars().all()
+
+        for phone in phones:
+            result["phones"] += 1
+            while True:
+                # Un segmento por transacción para no retener el lock de escritura
+                rows = db.execute(
+                    select(ConversationHistoryDB)
+                    .where(ConversationHistoryDB.phone_number == phone)
+                    .where(ConversationHistoryDB.created_at < cutoff)
+                    .order_by(ConversationHistoryDB.created_at, ConversationHistoryDB.id)
+                    .limit(segment_rows)
+                ).scalars().all()
+                if not rows:
+                    break
+
+                db.add(ConversationArchiveDB(
+                    phone_number=phone,
+                    start_at=rows[0].created_at,
+                    end_at=rows[-1].created_at,
+                    row_count=len(rows),
+                    payload=_pack([_row_to_dict(r) for r in rows])
+                ))
+                db.execute(delete(ConversationHistoryDB).where(
+                    ConversationHistoryDB.id.in_([r.id for r in rows])
+                ))
+                db.commit()
+                db.expunge_all()
+                result["rows"] += len(rows)
+                result["segments"] += 1
+                if len(rows) < segment_rows:
+                    break
+        return result
+    finally:
+        db.close()
+
+
+def compact_archive(segment_rows: int = None) -> Dict[str, int]:
+    """Une segmentos pequeños consecutivos del mismo número y optimiza SQLite"""
+    segment_rows = segment_rows or config.CONVERSATION_ARCHIVE_SEGMENT_ROWS
+    result = {"merged_segments": 0, "new_segments": 0}
+    db = SessionLocal()
+    try:
+        phones = db.execute(
+            select(ConversationArchiveDB.phone_number)
+            .where(ConversationArchiveDB.row_count < segment_rows)
+            .distinct()
+        ).scalars().all()
+
+        for phone in phones:
+            segments = db.execute(
+                select(ConversationArchiveDB)
+                .where(ConversationArchiveDB.phone_number == phone)
+                .order_by(ConversationArchiveDB.start_at, ConversationArchiveDB.id)
+            ).scalars().all()
+
+            groups, current, current_rows = [], [], 0
+            for segment in segments:
+                if current and current_rows + segment.row_count > segment_rows:
+                    groups.append(current)
+                    current, current_rows = [], 0
+                current.append(segment)
+                current_rows += segment.row_count
+            groups.append(current)
+
+            for group in groups:
+                if len(group) < 2:
+                    continue
+                rows = [row for segment in group for row in _unpack(segment.payload)]
+                db.add(ConversationArchiveDB(
+                    phone_number=phone,
+                    start_at=group[0].start_at,
+                    end_at=group[-1].end_at,
+                    row_count=len(rows),
+                    payload=_pack(rows)
+                ))
+                db.execute(delete(ConversationArchiveDB).where(
+                    ConversationArchiveDB.id.in_([segment.id for segment in group])
+                ))
+                db.commit()
+                result["merged_segments"] += len(group)
+                result["new_segments"] += 1
+            db.expunge_all()
+
+        if config.DATABASE_URL.startswith("sqlite"):
+            # Une los segmentos del índice de búsqueda (se fragmenta con cada inserción)
+            db.execute(text(f"INSERT INTO {CONVERSATION_FTS_TABLE}({CONVERSATION_FTS_TABLE}) VALUES ('optimize')"))
+            db.commit()
+            db.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+            db.execute(text("PRAGMA optimize"))
+        return result
+    finally:
+        db.close()
+
+
+def load_archived_conversations(phone_number: str, limit: int = 100) -> List[Dict[str, Any]]:
+    """Mensajes archivados de un número, del más reciente al más antiguo"""
+    db = SessionLocal()
+    try:
+        messages: List[Dict[str, Any]] = []
+        segments = db.execute(
+            select(ConversationArchiveDB)
+            .where(ConversationArchiveDB.phone_number == phone_number)
+            .order_by(ConversationArchiveDB.end_at.desc())
+        ).scalars()
+        for segment in segments:
+            messages.extend(reversed(_unpack(segment.payload)))
+            if len(messages) >= limit:
+                break
+        return messages[:limit]
+    finally:
+        db.close()
+
+
+class HistoryRetentionJob:
+    """Ejecuta archivado y compactación periódicamente en segundo plano"""
+
+    def __init__(self, interval: float = None):
+        self.interval = interval or config.CONVERSATION_COMPACTION_INTERVAL
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {
+            "runs": 0,
+            "archived_rows": 0,
+            "archived_segments": 0,
+            "merged_segments": 0,
+            "pruned_message_sids": 0,
+            "pruned_delivery_rows": 0,
+            "failed_runs": 0,
+            "last_run_ms": 0.0,
+            "last_run_at": None,
+        }
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run_once(self) -> Dict[str, int]:
+        start = time.perf_counter()
+        archived = await asyncio.to_thread(archive_old_conversations)
+        pruned = await asyncio.to_thread(prune_processed_messages)
+        pruned_delivery = await asyncio.to_thread(prune_delivery_stats)
+        compacted = await asyncio.to_thread(compact_archive)
+
+        self._stats["runs"] += 1
+        self._stats["archived_rows"] += archived["rows"]
+        self._stats["archived_segments"] += archived["segments"]
+        self._stats["merged_segments"] += compacted["merged_segments"]
+        self._stats["pruned_message_sids"] += pruned
+        self._stats["pruned_delivery_rows"] += pruned_delivery
+        self._stats["last_run_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        self._stats["last_run_at"] = datetime.utcnow().isoformat()
+        if archived["rows"]:
+            logger.info(f"🗄️ Historial archivado: {archived['rows']} filas de {archived['phones']} números")
+        return {**archived, **compacted}
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self._stats["failed_runs"] += 1
+                logger.error(f"❌ Error en retención del historial: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "retention_days": config.CONVERSATION_RETENTION_DAYS,
+            "interval_s": self.interval,
+        }
+
+
+# Instancia global
+retention_job = HistoryRetentionJob()
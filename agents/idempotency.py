@@ -0,0 +1,89 @@
+"""
+Idempotencia del webhook de Twilio por MessageSid
+
+Twilio reintenta el webhook si no recibe respuesta a tiempo. Cada MessageSid
+se acepta una sola vez: primero se busca en un conjunto en memoria (LRU) y,
+si no está, se registra en `processed_messages` (clave primaria = índice
+único), que cubre reinicios y varios procesos. Los duplicados se descartan
+antes de guardar o encolar nada.
+"""
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any
+
+from sqlalchemy import delete
+
+from config import config
+from database import SessionLocal, ProcessedMessageDB, claim_message_sid_async
+
+logger = logging.getLogger(__name__)
+
+
+class MessageIdempotencyStore:
+    """Conjunto de MessageSid vistos, en memoria y en SQLite"""
+
+    def __init__(self, memory_size: int = None):
+        self.memory_size = memory_size or config.IDEMPOTENCY_MEMORY_SIZE
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._stats = {
+            "accepted": 0,
+            "suppressed_memory": 0,
+            "suppressed_db": 0,
+            "store_errors": 0,
+        }
+
+    async def claim(self, message_sid: str, phone_number: str) -> bool:
+        """True si es la primera vez que llega este MessageSid"""
+        if not message_sid:
+            return True
+        if message_sid in self._seen:
+            self._seen.move_to_end(message_sid)
+            self._stats["suppressed_memory"] += 1
+            logger.info(f"🔁 Reintento de Twilio ignorado: {message_sid}")
+            return False
+
+        self._remember(message_sid)
+        try:
+            first = await claim_message_sid_async(message_sid, phone_number)
+        except Exception as e:
+            # Sin la BD, al menos la memoria evita duplicados en este proceso
+            self._stats["store_errors"] += 1
+            logger.error(f"❌ Error registrando MessageSid {message_sid}: {str(e)}")
+            first = True
+
+        if not first:
+            self._stats["suppressed_db"] += 1
+            logger.info(f"🔁 Reintento de Twilio ignorado (ya registrado): {message_sid}")
+            return False
+        self._stats["accepted"] += 1
+        return True
+
+    def _remember(self, message_sid: str):
+        self._seen[message_sid] = None
+        while len(self._seen) > self.memory_size:
+            self._seen.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "suppressed_retries": self._stats["suppressed_memory"] + self._stats["suppressed_db"],
+            "in_memory": len(self._seen),
+        }
+
+
+def prune_processed_messages(retention_days: int = None) -> int:
+    """Borra MessageSid más antiguos que la ventana de reintentos"""
+    retention_days = config.IDEMPOTENCY_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    db = SessionLocal()
+    try:
+        result = db.execute(delete(ProcessedMessageDB).where(ProcessedMessageDB.created_at < cutoff))
+        db.commit()
+        return result.rowcount
+    finally:
+        db.close()
+
+
+# Instancia global
+idempotency_store = MessageIdempotencyStore()
@@ -0,0 +1,451 @@
+"""
+Investor Index - Motor local de matching de inversores
+======================================================
+
+Indexa en memoria un dataset local de inversores (mismo esquema que la tabla
+`venture_capitals` de la webapp) y resuelve búsquedas por stage, industria,
+geografía y ticket sin llamar a Apify ni a OpenAI.
+
+- Los filtros se evalúan como bitsets (un int de Python por valor de faceta),
+  así que cada filtro es un AND sobre todo el dataset de una vez.
+- El ranking usa TF-IDF sobre la tesis (description, sectors, portfolio).
+- Apify queda solo para enriquecer los top-k elegidos, no para descubrir.
+"""
+
+import os
+import csv
+import json
+import math
+import re
+import heapq
+import unicodedata
+from bisect import bisect_right
+from typing import Dict, Any, List, Optional, Iterable
+
+
+# Columnas del dataset (ver migrations/0033_venture_capitals.sql)
+INVESTOR_FIELDS = [
+    "id", "name", "country", "geography", "stage", "sectors",
+    "min_ticket_usd", "max_ticket_usd", "typical_equity_pct",
+    "website", "contact_email", "linkedin", "description", "portfolio_examples",
+]
+
+# Sinónimos para normalizar lo que llega de los agentes / usuarios
+STAGE_ALIASES = {
+    "preseed": "pre-seed",
+    "pre seed": "pre-seed",
+    "pre-semilla": "pre-seed",
+    "semilla": "seed",
+    "series a": "series-a",
+    "series_a": "series-a",
+    "serie a": "series-a",
+    "series b": "series-b",
+    "series_b": "series-b",
+    "serie b": "series-b",
+    "scale": "growth",
+    "crecimiento": "growth",
+}
+
+SECTOR_ALIASES = {
+    "ai": "ai",
+    "ia": "ai",
+    "inteligencia artificial": "ai",
+    "healthtech": "health",
+    "salud": "health",
+    "edtech": "edtech",
+    "educacion": "edtech",
+    "ecommerce": "consumer",
+    "e-commerce": "consumer",
+    "deep tech": "deeptech",
+}
+
+GEOGRAPHY_ALIASES = {
+    "espana": "spain",
+    "latinoamerica": "latam",
+    "latin america": "latam",
+    "eeuu": "usa",
+    "estados unidos": "usa",
+    "us": "usa",
+    "europa": "europe",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = {
+    "de", "la", "el", "en", "y", "a", "los", "las", "del", "con", "por", "para",
+    "un", "una", "que", "se", "su", "sus", "es", "al", "lo", "muy", "the", "and",
+    "of", "in", "for", "to", "with", "on", "n",
+}
+
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin acentos"""
+    text = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokeniza texto libre para el índice de tesis"""
+    return [t for t in _TOKEN_RE.findall(_fold(text)) if t not in STOPWORDS and len(t) > 1]
+
+
+def _split_list(value: Any) -> List[str]:
+    """Convierte 'seed,series-a' o ['seed', 'series-a'] en valores normalizados"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [_fold(str(v)).strip() for v in value if str(v).strip()]
+
+
+def _normalize(value: str, aliases: Dict[str, str]) -> str:
+    folded = _fold(value).strip()
+    return aliases.get(folded, folded)
+
+
+def _to_int(value: Any) -> int:
+    try:
+        return int(float(value or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+# "500k", "$1.5M", "2 millones", "1.000.000 usd" (euros se toman como dólares)
+_AMOUNT_RE = re.compile(
+    r"([$€]\s*)?(\d+(?:[.,]\d+)*)\s*(k|mm|m|mil|millones|millon|millions|million|usd|eur|euros|dolares)?(?![a-z0-9])"
+)
+_AMOUNT_MULTIPLIERS = {"k": 1e3, "mil": 1e3, "m": 1e6, "mm": 1e6, "millon": 1e6, "millones": 1e6, "million": 1e6, "millions": 1e6}
+
+
+def parse_ticket(value: Any, require_unit: bool = False) -> Optional[int]:
+    """
+    Ticket en USD a partir de un número o de texto libre. None si no hay
+    importe. Con `require_unit` solo cuentan los importes con unidad o moneda
+    (para no confundir "2 socios" con un ticket).
+    """
+    if isinstance(value, (int, float)):
+        return int(value) if value > 0 else None
+    for match in _AMOUNT_RE.finditer(_fold(str(value or ""))):
+        currency, number, unit = match.groups()
+        if require_unit and not (currency or unit):
+            continue
+        if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", number):
+            number = re.sub(r"[.,]", "", number)
+        try:
+            amount = float(number.replace(",", "."))
+        except ValueError:
+            continue
+        amount *= _AMOUNT_MULTIPLIERS.get(unit or "", 1)
+        if amount >= 1:
+            return int(amount)
+    return None
+
+
+class InvestorIndex:
+    """
+    Índice en memoria de inversores con filtros por bitset y ranking TF-IDF
+    """
+
+    def __init__(self, investors: Iterable[Dict[str, Any]]):
+        self.investors: List[Dict[str, Any]] = []
+        self.all_mask = 0
+
+        # valor de faceta -> bitset de inversores
+        self.stage_bits: Dict[str, int] = {}
+        self.sector_bits: Dict[str, int] = {}
+        self.geo_bits: Dict[str, int] = {}
+
+        # término -> {posición: tf}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_norms: List[float] = []
+
+        for investor in investors:
+            self._add(investor)
+
+        self._build_ticket_masks()
+        self._build_idf()
+
+    # ------------------------------------------------------------------
+    # Construcción
+    # ------------------------------------------------------------------
+
+    def _add(self, raw: Dict[str, Any]):
+        pos = len(self.investors)
+        bit = 1 << pos
+
+        investor = {field: raw.get(field) for field in INVESTOR_FIELDS}
+        investor["id"] = raw.get("id", pos + 1)
+        investor["min_ticket_usd"] = _to_int(raw.get("min_ticket_usd"))
+        investor["max_ticket_usd"] = _to_int(raw.get("max_ticket_usd"))
+        self.investors.append(investor)
+        self.all_mask |= bit
+
+        for stage in _split_list(raw.get("stage")):
+            key = STAGE_ALIASES.get(stage, stage)
+            self.stage_bits[key] = self.stage_bits.get(key, 0) | bit
+        for sector in _split_list(raw.get("sectors")):
+            key = SECTOR_ALIASES.get(sector, sector)
+            self.sector_bits[key] = self.sector_bits.get(key, 0) | bit
+        geos = _split_list(raw.get("geography")) + _split_list(raw.get("country"))
+        for geo in geos:
+            key = GEOGRAPHY_ALIASES.get(geo, geo)
+            self.geo_bits[key] = self.geo_bits.get(key, 0) | bit
+
+        text = " ".join(str(raw.get(f) or "") for f in ("name", "sectors", "description", "portfolio_examples"))
+        tf: Dict[str, int] = {}
+        for token in tokenize(text):
+            tf[token] = tf.get(token, 0) + 1
+        for token, count in tf.items():
+            self.postings.setdefault(token, {})[pos] = count
+
+    def _build_ticket_masks(self):
+        """
+        Prefijos acumulados de bitsets ordenados por min/max ticket.
+
+        Con ellos "min_ticket <= t" y "max_ticket >= t" son un bisect + lookup.
+        Un max_ticket de 0 significa "sin dato" y no excluye al inversor.
+        """
+        by_min = sorted(range(len(self.investors)), key=lambda i: self.investors[i]["min_ticket_usd"])
+        self.min_values = [self.investors[i]["min_ticket_usd"] for i in by_min]
+        self.min_prefix = [0]
+        for i in by_min:
+            self.min_prefix.append(self.min_prefix[-1] | (1 << i))
+
+        by_max = sorted(range(len(self.investors)), key=lambda i: self.investors[i]["max_ticket_usd"], reverse=True)
+        self.max_values_desc = [-self.investors[i]["max_ticket_usd"] for i in by_max]
+        self.max_prefix = [0]
+        for i in by_max:
+            self.max_prefix.append(self.max_prefix[-1] | (1 << i))
+
+        self.unknown_max_mask = 0
+        for i, inv in enumerate(self.investors):
+            if not inv["max_ticket_usd"]:
+                self.unknown_max_mask |= 1 << i
+
+    def _build_idf(self):
+        n = max(len(self.investors), 1)
+        self.idf = {
+            term: math.log(1 + n / len(docs))
+            for term, docs in self.postings.items()
+        }
+        norms = [0.0] * len(self.investors)
+        for term, docs in self.postings.items():
+            idf = self.idf[term]
+            for pos, tf in docs.items():
+                norms[pos] += (tf * idf) ** 2
+        self.doc_norms = [math.sqrt(v) or 1.0 for v in norms]
+
+    # ------------------------------------------------------------------
+    # Consulta
+    # ------------------------------------------------------------------
+
+    def _facet_mask(self, bits: Dict[str, int], values: List[str], aliases: Dict[str, str]) -> int:
+        mask = 0
+        for value in values:
+            mask |= bits.get(_normalize(value, aliases), 0)
+        return mask
+
+    def filter_mask(
+        self,
+        stage: Any = None,
+        industry: Any = None,
+        geography: Any = None,
+        ticket_usd: Optional[int] = None
+    ) -> int:
+        """Bitset de inversores que cumplen todos los filtros dados"""
+        mask = self.all_mask
+
+        if stage:
+            mask &= self._facet_mask(self.stage_bits, _split_list(stage), STAGE_ALIASES)
+        if industry:
+            mask &= self._facet_mask(self.sector_bits, _split_list(industry), SECTOR_ALIASES)
+        if geography:
+            geo_mask = self._facet_mask(self.geo_bits, _split_list(geography), GEOGRAPHY_ALIASES)
+            # Los fondos "Global" invierten en cualquier geografía
+            mask &= geo_mask | self.geo_bits.get("global", 0)
+        if ticket_usd:
+            min_ok = self.min_prefix[bisect_right(self.min_values, ticket_usd)]
+            max_ok = self.max_prefix[bisect_right(self.max_values_desc, -ticket_usd)]
+            mask &= min_ok & (max_ok | self.unknown_max_mask)
+
+        return mask
+
+    def _thesis_scores(self, mask: int, query: str) -> Dict[int, float]:
+        """Similitud coseno TF-IDF entre la query y la tesis de cada candidato"""
+        terms: Dict[str, int] = {}
+        for token in tokenize(query):
+            if token in self.idf:
+                terms[token] = terms.get(token, 0) + 1
+
+        scores: Dict[int, float] = {}
+        for term, qtf in terms.items():
+            weight = qtf * self.idf[term] ** 2
+            for pos, tf in self.postings[term].items():
+                if mask >> pos & 1:
+                    scores[pos] = scores.get(pos, 0.0) + tf * weight
+        return {pos: s / self.doc_norms[pos] for pos, s in scores.items()}
+
+    def search(
+        self,
+        query: str = "",
+        stage: Any = None,
+        industry: Any = None,
+        geography: Any = None,
+        ticket_usd: Optional[int] = None,
+        top_k: int = 10
+    ) -> List[Dict[str, Any]]:
+        """
+        Devuelve los top_k inversores que pasan los filtros, ordenados por
+        relevancia de tesis (empates por posición en el dataset).
+        """
+        mask = self.filter_mask(stage, industry, geography, ticket_usd)
+        if not mask:
+            return []
+
+        scores = self._thesis_scores(mask, query) if query else {}
+
+        if len(scores) >= top_k:
+            ranked = heapq.nsmallest(top_k, scores, key=lambda pos: (-scores[pos], pos))
+        else:
+            ranked = sorted(scores, key=lambda pos: (-scores[pos], pos))
+            seen = set(ranked)
+            pos = 0
+            rest = mask
+            while rest and len(ranked) < top_k:
+                if rest & 1 and pos not in seen:
+                    ranked.append(pos)
+                rest >>= 1
+                pos += 1
+
+        return [
+            {**self.investors[pos], "relevance": round(scores.get(pos, 0.0), 4)}
+            for pos in ranked
+        ]
+
+    def __len__(self) -> int:
+        return len(self.investors)
+
+
+# ----------------------------------------------------------------------
+# Carga del dataset
+# ----------------------------------------------------------------------
+
+def load_investors(path: str) -> List[Dict[str, Any]]:
+    """Carga inversores desde un CSV o JSON con las columnas de venture_capitals"""
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return data.get("investors", []) if isinstance(data, dict) else data
+
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+_index_instance: Optional[InvestorIndex] = None
+
+
+def get_investor_index() -> Optional[InvestorIndex]:
+    """
+    Get or create singleton index from INVESTOR_DATASET_PATH.
+    Returns None if no dataset is available.
+    """
+    global _index_instance
+    if _index_instance is None:
+        path = os.getenv("INVESTOR_DATASET_PATH", "./investors.csv")
+        if not os.path.exists(path):
+            print(f"⚠️ Investor dataset not found at {path}")
+            return None
+        try:
+            _index_instance = InvestorIndex(load_investors(path))
+            print(f"✅ Investor index loaded with {len(_index_instance)} investors")
+        except Exception as e:
+            print(f"❌ Error loading investor dataset: {e}")
+            return None
+    return _index_instance
+
+
+def _profile_key(url: str) -> str:
+    """linkedin.com/in/slug sin esquema, www, parámetros ni barra final"""
+    url = _fold(url or "").split("?")[0].split("#")[0].rstrip("/")
+    return re.sub(r"^(https?://)?([a-z]{2,3}\.)?(www\.)?", "", url)
+
+
+def _contains_tokens(text: str, tokens: List[str]) -> bool:
+    """True si `tokens` aparece como secuencia de palabras completas en `text`"""
+    words = _TOKEN_RE.findall(_fold(text))
+    n = len(tokens)
+    return any(words[i:i + n] == tokens for i in range(len(words) - n + 1))
+
+
+def _match_profile(inv: Dict[str, Any], items: List[tuple]) -> Optional[tuple]:
+    """
+    Perfil de Apify de un inversor: por URL si el inversor tiene LinkedIn; si
+    no, el nombre completo como palabras enteras ("Fund 1" no casa con
+    "Fund 10 Partner").
+    """
+    if inv.get("linkedin"):
+        key = _profile_key(inv["linkedin"])
+        return next(
+            ((i, item) for i, item in items if _profile_key(item.get("url") or item.get("profileUrl")) == key),
+            None
+        )
+    tokens = _TOKEN_RE.findall(_fold(inv.get("name") or ""))
+    if not tokens:
+        return None
+    return next(
+        ((i, item) for i, item in items
+         if _contains_tokens(item.get("fullName", ""), tokens) or _contains_tokens(item.get("headline", ""), tokens)),
+        None
+    )
+
+
+def enrich_with_apify(apify_client, investors: List[Dict[str, Any]], max_results: int = 1) -> List[Dict[str, Any]]:
+    """
+    Enriquece solo los inversores elegidos con su perfil de LinkedIn vía Apify.
+
+    Si el inversor ya tiene URL de LinkedIn se scrapea directamente; si no,
+    se busca por nombre. Un fallo de Apify no invalida el resultado local.
+    """
+    if not investors:
+        return investors
+
+    search_urls = []
+    for inv in investors:
+        if inv.get("linkedin"):
+            search_urls.append(inv["linkedin"])
+        else:
+            keywords = f"{inv.get('name', '')} venture capital".replace(" ", "%20")
+            search_urls.append(f"https://www.linkedin.com/search/results/people/?keywords={keywords}")
+
+    try:
+        run = apify_client.actor("apify/linkedin-profile-scraper").call(run_input={
+            "searchUrls": search_urls,
+            "maxResults": max_results * len(investors),
+            "minDelay": 2,
+            "maxDelay": 4
+        })
+        items = list(apify_client.dataset(run["defaultDatasetId"]).iterate_items())
+    except Exception as e:
+        print(f"⚠️ Apify enrichment failed, returning local data only: {e}")
+        return investors
+
+    enriched = []
+    # Cada perfil se asigna como mucho a un inversor
+    unused = list(enumerate(items))
+    for inv in investors:
+        match = _match_profile(inv, unused)
+        if match:
+            unused.remove(match)
+            profile = match[1]
+            inv = {
+                **inv,
+                "linkedin_profile": {
+                    "name": profile.get("fullName", ""),
+                    "headline": profile.get("headline", ""),
+                    "location": profile.get("location", ""),
+                    "profile_url": profile.get("url", ""),
+                    "connections": profile.get("connectionsCount", 0)
+                }
+            }
+        enriched.append(inv)
+    return enriched
@@ -21,6 +21,9 @@ from apify_client import ApifyClient
 # OpenAI para análisis
 import openai
 
+# Índice local de inversores
+from investor_index import get_investor_index, enrich_with_apify, parse_ticket
+
 
 @dataclass
 class LinkedInConnectorConfig:
@@ -28,6 +31,7 @@ class LinkedInConnectorConfig:
     openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
     openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
     apify_api_token: str = os.getenv("APIFY_API_TOKEN", "")
+    enrich_top_n: int = int(os.getenv("INVESTOR_ENRICH_TOP_N", "5"))
     
     def __post_init__(self):
         if not self.openai_api_key:
@@ -177,8 +181,8 @@ class LinkedInConnectorTeam:
             # Check if user wants to search - trigger Apify search
             if any(keyword in message.lower() for keyword in ["busca", "encuentra", "search", "find", "quiero", "necesito"]):
                 if any(keyword in message.lower() for keyword in ["inversor", "investor", "inversionista", "capital", "funding"]):
-                    # Extract search intent and trigger Apify search
-                    search_results = self._search_linkedin_with_apify(message, "investor")
+                    # Extract search intent: local index first, Apify discovery only as fallback
+                    search_results = self._search_local_investors(message) or self._search_linkedin_with_apify(message, "investor")
                     if search_results:
                         response_text += f"\n\n🔍 **Perfiles encontrados en LinkedIn:**\n{search_results}"
             
@@ -198,6 +202,31 @@ class LinkedInConnectorTeam:
                 "timestamp": datetime.now().isoformat()
             }
     
+    def _search_local_investors(self, query: str, top_k: int = 5) -> str:
+        """
+        Busca inversores en el índice local a partir del mensaje libre
+        
+        Returns:
+            String con resultados formateados, vacío si no hay índice o resultados
+        """
+        index = get_investor_index()
+        if index is None:
+            return ""
+        
+        results = index.search(query=query, top_k=top_k)
+        results = [r for r in results if r["relevance"] > 0]
+        if not results:
+            return ""
+        
+        return "\n\n".join([
+            f"**{r['name']}**\n"
+            f"📋 {r.get('description') or ''}\n"
+            f"📍 {r.get('geography') or r.get('country') or ''}\n"
+            f"🚀 {r.get('stage') or ''}\n"
+            f"🔗 {r.get('linkedin') or r.get('website') or ''}"
+            for r in results
+        ])
+    
     def _search_linkedin_with_apify(self, query: str, search_type: str = "investor") -> str:
         """
         Busca perfiles en LinkedIn usando Apify
@@ -269,14 +298,37 @@ class LinkedInConnectorTeam:
         self,
         startup_description: str,
         funding_stage: str,
-        industry: str,
+        industry: str = "",
         location: str = "",
-        max_results: int = 20
+        max_results: int = 20,
+        ticket: Any = None
     ) -> Dict[str, Any]:
-        """Encuentra inversores relevantes usando Apify"""
-        print(f"\n🔍 Buscando inversores para: {industry} | {funding_stage}")
+        """
+        Encuentra inversores relevantes.
+        
+        Si hay dataset local de inversores se filtra y rankea ahí (también por
+        `ticket`, el importe en USD o texto como "500k"), y Apify solo enriquece
+        los primeros resultados. Sin dataset se descubre vía Apify. Sin
+        `industry` no se filtra por sector.
+        """
+        print(f"\n🔍 Buscando inversores para: {industry or 'cualquier sector'} | {funding_stage}")
         
         try:
+            index = get_investor_index()
+            if index is not None:
+                candidates = index.search(
+                    query=f"{startup_description} {industry}",
+                    stage=funding_stage,
+                    industry=industry or None,
+                    geography=location or None,
+                    ticket_usd=parse_ticket(ticket),
+                    top_k=max_results
+                )
+                if candidates:
+                    return self._rank_local_investors(candidates, startup_description, funding_stage, industry or "Technology")
+                print("⚠️ No local investors matched, falling back to Apify discovery")
+            
+            industry = industry or "Technology"
             # Build LinkedIn search query
             search_keywords = f"{industry} {funding_stage} venture capital investor"
             if location:
@@ -323,6 +375,7 @@ class LinkedInConnectorTeam:
                 "profiles": profiles,
                 "analysis": analysis.content if hasattr(analysis, 'content') else str(analysis),
                 "total_found": len(profiles),
+                "source": "apify",
                 "timestamp": datetime.now().isoformat()
             }
         except Exception as e:
@@ -334,6 +387,53 @@ class LinkedInConnectorTeam:
                 "timestamp": datetime.now().isoformat()
             }
     
+    def _rank_local_investors(
+        self,
+        candidates: List[Dict[str, Any]],
+        startup_description: str,
+        funding_stage: str,
+        industry: str
+    ) -> Dict[str, Any]:
+        """Enriquece con Apify los mejores candidatos locales y los analiza"""
+        top_n = self.config.enrich_top_n
+        enriched = enrich_with_apify(self.apify_client, candidates[:top_n]) + candidates[top_n:]
+        
+        profiles = []
+        for inv in enriched:
+            linkedin = inv.get("linkedin_profile") or {}
+            profiles.append({
+                "name": inv.get("name", "Unknown"),
+                "headline": linkedin.get("headline") or inv.get("description") or "",
+                "location": linkedin.get("location") or inv.get("country") or "",
+                "industry": inv.get("sectors") or "",
+                "profile_url": linkedin.get("profile_url") or inv.get("linkedin") or inv.get("website") or "",
+                "connections": linkedin.get("connections", 0),
+                "description": inv.get("description") or "",
+                "stage": inv.get("stage") or "",
+                "geography": inv.get("geography") or "",
+                "min_ticket_usd": inv.get("min_ticket_usd", 0),
+                "max_ticket_usd": inv.get("max_ticket_usd", 0),
+                "relevance": inv.get("relevance", 0)
+            })
+        
+        analysis_prompt = (
+            f"Analyze these {len(profiles)} investor profiles for a {industry} startup at {funding_stage} stage.\n"
+            f"Startup: {startup_description}\n\n"
+            f"Profiles:\n{json.dumps(profiles, indent=2)}\n\n"
+            f"Rank them by relevance and provide compatibility scores (0-100)."
+        )
+        
+        analysis = self.investor_agent.run(analysis_prompt)
+        
+        return {
+            "task": "investor_search",
+            "profiles": profiles,
+            "analysis": analysis.content if hasattr(analysis, 'content') else str(analysis),
+            "total_found": len(profiles),
+            "source": "local_index",
+            "timestamp": datetime.now().isoformat()
+        }
+    
     def find_talent(
         self,
         role_description: str,
@@ -0,0 +1,232 @@
+"""
+Benchmark de carga del procesamiento de mensajes entrantes
+
+Mide cuántos mensajes por segundo pasan de la recepción (idempotencia,
+historial y encolado, como el webhook) a la respuesta aceptada por Twilio,
+con todo en el proceso web (0) y con N procesos worker particionados. Los
+mensajes seguidos de un mismo número se agrupan en un turno, así que hay
+menos respuestas que mensajes:
+
+    python load_benchmark.py --messages 5000 --phones 500 --processes 0 1 2 4
+
+Cada configuración corre en un subproceso con su propia base de datos
+temporal, contra un Twilio falso local y con un orquestador sintético que
+gasta --cpu-ms de CPU por turno (lo que cuestan JSON, contexto y prompt) sin
+llamar a Groq ni a la webapp.
+
+La columna "escala" compara con la primera configuración. Con N procesos
+worker hacen falta N + 1 núcleos libres (el proceso web también trabaja):
+con menos, los procesos compiten por la CPU y el modo multiproceso es más
+lento que el de un solo proceso.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen
+
+# Peticiones al webhook simultáneas
+WEBHOOK_CONCURRENCY = 32
+
+
+class SyntheticOrchestrator:
+    """Sustituye a ChatOrchestrator: lee el contexto y gasta CPU como un turno real"""
+
+    def __init__(self):
+        self.cpu_ms = float(os.getenv("BENCH_CPU_MS", 5))
+
+    async def process_burst(self, phone_number, messages, message_sids=None) -> str:
+        from context_cache import context_cache
+        recent = await context_cache.get_recent(phone_number, limit=10)
+        payload = {
+            "phone_number": phone_number,
+            "messages": messages,
+            "context": [getattr(turn, "message", "") for turn in recent],
+            "system": "Eres el asistente de LovableGrowth. " * 40,
+        }
+        deadline = time.process_time() + self.cpu_ms / 1000
+        while time.process_time() < deadline:
+            payload = json.loads(json.dumps(payload))
+        return f"✅ Recibido: {messages[-1]}"
+
+
+# Lo importan los procesos worker ("load_benchmark:orchestrator")
+orchestrator = SyntheticOrchestrator()
+
+
+class _FakeTwilio(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    accepted = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with _FakeTwilio.lock:
+            _FakeTwilio.accepted += 1
+            sid = f"SMbench{_FakeTwilio.accepted}"
+        self._reply(201, {"sid": sid, "status": "queued"})
+
+    def do_GET(self):
+        self._reply(200, {"accepted": _FakeTwilio.accepted})
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _accepted(twilio_url: str) -> int:
+    with urlopen(f"{twilio_url}/count") as response:
+        return json.loads(response.read())["accepted"]
+
+
+async def _outbound_depth() -> int:
+    from sqlalchemy import select, func
+    from database import AsyncSessionLocal, OutboundMessageDB
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(select(func.count()).select_from(OutboundMessageDB))).scalar()
+
+
+async def _run(processes: int, messages: int, phones: int, twilio_url: str) -> dict:
+    """Una configuración (dentro de su subproceso, con el entorno ya preparado)"""
+    from database import init_db, init_async_db, close_async_db
+    from conversation_log import conversation_log
+    from delivery_status import delivery_tracker
+    from idempotency import idempotency_store
+    from message_queue import InboundMessage
+    from outbound_queue import outbound_queue
+    from twilio_service import twilio_service
+    from worker_processes import PartitionedIntake
+
+    init_db()
+    await init_async_db()
+    await conversation_log.start()
+    await twilio_service.start()
+    await delivery_tracker.start()
+
+    intake = PartitionedIntake(processes, orchestrator="load_benchmark:orchestrator")
+    await outbound_queue.start(dispatch=not intake.multiprocess)
+    await intake.start()
+    if intake.multiprocess:
+        # Que los procesos hayan arrancado antes de medir
+        while not all("pid" in p for p in intake.stats()["partitions"]):
+            await asyncio.sleep(0.1)
+
+    # Lo mismo que hace el webhook, con WEBHOOK_CONCURRENCY peticiones a la vez
+    requests = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+    # Los mensajes de un mismo número se reciben en orden
+    phone_locks = [asyncio.Lock() for _ in range(phones)]
+
+    async def webhook(i: int):
+        phone = f"whatsapp:+34600{i % phones:06d}"
+        async with requests, phone_locks[i % phones]:
+            message = InboundMessage(phone, f"mensaje {i}", f"SMin{i}")
+            await idempotency_store.claim(message.message_sid, phone)
+            if not await intake.submit(message):
+                raise RuntimeError("Cola llena: sube INBOUND_DURABLE_QUEUE_MAX")
+
+    start = time.perf_counter()
+    await asyncio.gather(*[webhook(i) for i in range(messages)])
+    intake_s = time.perf_counter() - start
+
+    # Hasta que no queda nada por procesar ni por enviar
+    while True:
+        if intake.depth() == 0 and await _outbound_depth() == 0:
+            break
+        await asyncio.sleep(0.05)
+    total_s = time.perf_counter() - start
+    replies = await asyncio.to_thread(_accepted, twilio_url)
+
+    await intake.stop()
+    await outbound_queue.stop()
+    await delivery_tracker.stop()
+    await conversation_log.stop()
+    await twilio_service.aclose()
+    await close_async_db()
+    return {
+        "processes": processes,
+        "messages": messages,
+        "replies": replies,
+        "intake_per_s": round(messages / intake_s, 1),
+        "total_s": round(total_s, 2),
+        "throughput_per_s": round(messages / total_s, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--phones", type=int, default=500)
+    parser.add_argument("--processes", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--cpu-ms", type=float, default=5.0, help="CPU por turno del orquestador sintético")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--twilio-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        result = asyncio.run(_run(args.run, args.messages, args.phones, args.twilio_url))
+        print(json.dumps(result))
+        return
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeTwilio)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    twilio_url = f"http://127.0.0.1:{server.server_port}"
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print(f"Núcleos disponibles: {cores}")
+    if max(args.processes) + 1 > cores:
+        print(f"⚠️ Con {max(args.processes)} procesos worker hacen falta {max(args.processes) + 1} núcleos: "
+              f"la escala medida aquí no es representativa")
+    print(f"{'procesos':>8} {'recepción/s':>12} {'respuestas':>10} {'total (s)':>10} {'mensajes/s':>11} {'escala':>7}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for processes in args.processes:
+            _FakeTwilio.accepted = 0
+            env = {
+                **os.environ,
+                "DATABASE_URL": f"sqlite:///{tmp}/bench-{processes}.db",
+                "INBOUND_PROCESSES": str(processes),
+                "INBOUND_COALESCE_WINDOW": "0",
+                "INBOUND_QUEUE_MAXSIZE": str(args.messages),
+                "INBOUND_DURABLE_QUEUE_MAX": str(args.messages),
+                "OUTBOUND_QUEUE_MAX": str(args.messages * 2),
+                "TWILIO_SEND_RATE": "0",
+                "TWILIO_API_BASE_URL": twilio_url,
+                "TWILIO_ACCOUNT_SID": "ACbench",
+                "TWILIO_AUTH_TOKEN": "bench",
+                "TWILIO_STATUS_CALLBACK_URL": "",
+                "WORKER_STATS_INTERVAL": "0.2",
+                "BENCH_CPU_MS": str(args.cpu_ms),
+            }
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", str(processes), "--messages", str(args.messages),
+                 "--phones", str(args.phones), "--twilio-url", twilio_url],
+                env=env, capture_output=True, text=True
+            )
+            if output.returncode != 0:
+                print(output.stderr[-2000:], file=sys.stderr)
+                sys.exit(output.returncode)
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            baseline = baseline or result["throughput_per_s"]
+            print(
+                f"{processes:>8} {result['intake_per_s']:>12} {result['replies']:>10} "
+                f"{result['total_s']:>10} {result['throughput_per_s']:>11} "
+                f"{result['throughput_per_s'] / baseline:>6.2f}x"
+            )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
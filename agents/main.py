@@ -6,18 +6,47 @@ Este servidor expone endpoints para:
 2. API de administración para gestionar usuarios
 3. Health checks
 """
-from fastapi import FastAPI, Request, HTTPException, Form, BackgroundTasks
-from fastapi.responses import Response, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, Form, Query, Header
+from fastapi.responses import Response, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import asyncio
 import logging
 import uvicorn
 import os
+from datetime import datetime
+from typing import Optional, List
 
 from config import config
-from database import init_db, save_conversation
+from sqlalchemy import select, or_, and_
+from database import (
+    init_db,
+    init_async_db,
+    close_async_db,
+    AsyncSessionLocal,
+    WhatsAppUserDB,
+    ConversationHistoryDB
+)
 from twilio_service import twilio_service
-from agents import orchestrator
+from api_client import api_client
+from command_router import command_router
+from prefetch import prefetcher
+from conversation_log import conversation_log
+from context_cache import context_cache
+from user_state import user_state
+from idempotency import idempotency_store
+from broadcast import broadcast_engine
+from outbound_queue import outbound_queue
+from webapp_outbox import webapp_outbox
+from worker_processes import partitioned_intake, adopt_orphan_spills
+from delivery_status import delivery_tracker
+from connect_page import connect_page_cache, CachedResource, etag_matches
+from change_feed import change_feed
+from pagination import encode_cursor, decode_cursor
+from conversation_export import ExportFilters, export_ndjson, export_csv
+from conversation_search import search_conversations
+from history_retention import retention_job, load_archived_conversations
+from message_queue import InboundMessage, ERROR_MESSAGE
 
 # Configurar logging
 logging.basicConfig(
@@ -26,6 +55,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+EMPTY_TWIML = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
 # Lifecycle manager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -33,9 +64,40 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("🚀 Iniciando servidor de agentes WhatsApp...")
     init_db()
+    await init_async_db()
+    # Antes de reinsertar: ficheros de respaldo de procesos worker que ya no existen
+    for spill in (config.CONVERSATION_LOG_SPILL_PATH, config.DELIVERY_STATUS_SPILL_PATH):
+        adopt_orphan_spills(spill, partitioned_intake.partitions if partitioned_intake.multiprocess else 0)
+    await conversation_log.start()
+    await retention_job.start()
     logger.info("✅ Base de datos inicializada")
+    await api_client.start()
+    await twilio_service.start()
+    await delivery_tracker.start()
+    # En modo multiproceso envían y escriben en la webapp los procesos worker
+    await outbound_queue.start(dispatch=not partitioned_intake.multiprocess)
+    logger.info("✅ Clientes HTTP de la webapp y Twilio listos")
+    if not partitioned_intake.multiprocess:
+        if config.INBOUND_PROCESSES:
+            logger.warning("⚠️ INBOUND_PROCESSES requiere SQLite: los mensajes se procesan en este proceso")
+        await webapp_outbox.start()
+        trained = command_router.train_from_history()
+        logger.info(f"✅ Router de comandos entrenado con {trained} mensajes")
+    await partitioned_intake.start()
+    await broadcast_engine.start()
     yield
     # Shutdown
+    change_feed.close()
+    await broadcast_engine.stop()
+    await partitioned_intake.stop()
+    await webapp_outbox.stop()
+    await outbound_queue.stop()
+    await delivery_tracker.stop()
+    await conversation_log.stop()
+    await retention_job.stop()
+    await api_client.aclose()
+    await twilio_service.aclose()
+    await close_async_db()
     logger.info("👋 Servidor detenido")
 
 # Crear aplicación FastAPI
@@ -81,155 +143,69 @@ async def health_check():
         }
     }
 
+@app.get("/api/metrics")
+async def service_metrics():
+    """Métricas internas del servicio"""
+    return {
+        "webapp_http": api_client.pool_stats(),
+        "webapp_cache": api_client.cache_stats(),
+        "twilio": twilio_service.stats(),
+        "inbound_queue": partitioned_intake.stats(),
+        "command_router": command_router.stats(),
+        "prefetch": prefetcher.stats(),
+        "conversation_log": conversation_log.stats(),
+        "history_retention": retention_job.stats(),
+        "context_cache": context_cache.stats(),
+        "user_state": user_state.stats(),
+        "idempotency": idempotency_store.stats(),
+        "broadcast": broadcast_engine.stats(),
+        "outbound_queue": outbound_queue.stats(),
+        "webapp_outbox": webapp_outbox.stats(),
+        "delivery_status": delivery_tracker.stats(),
+        "connect_page": connect_page_cache.stats(),
+        "change_feed": change_feed.stats()
+    }
+
+@app.get("/api/metrics/latency")
+async def delivery_latency(minutes: int = 60):
+    """Histogramas de latencia por tramo (recibido → encolado → enviado → entregado → leído)"""
+    return await delivery_tracker.report(minutes)
+
+def _cached_response(request: Request, resource: CachedResource) -> Response:
+    """Respuesta con ETag y Cache-Control; 304 si el navegador ya la tiene"""
+    headers = {
+        "ETag": resource.etag,
+        "Cache-Control": f"public, max-age={config.CONNECT_CACHE_MAX_AGE}"
+    }
+    if etag_matches(request.headers.get("if-none-match"), resource.etag):
+        connect_page_cache.record_not_modified()
+        return Response(status_code=304, headers=headers)
+    return Response(content=resource.body, media_type=resource.media_type, headers=headers)
+
 @app.get("/connect")
 async def get_connection_info():
     """
     Obtiene la información de conexión para WhatsApp.
     Devuelve el link directo y el código de sandbox si está configurado.
     """
-    # Extraer número del formato whatsapp:+1234567890
-    phone = config.TWILIO_WHATSAPP_NUMBER.replace("whatsapp:", "").replace("+", "")
-    
-    # Construir link de WhatsApp
-    if config.TWILIO_SANDBOX_CODE:
-        # Modo sandbox - necesita código de unión
-        sandbox_code = config.TWILIO_SANDBOX_CODE.replace(" ", "%20")
-        whatsapp_link = f"https://wa.me/{phone}?text={sandbox_code}"
-        instructions = f"1. Haz clic en el link o escanea el QR\n2. Envía el mensaje '{config.TWILIO_SANDBOX_CODE}'\n3. Una vez conectado, envía 'hola' para comenzar"
-    else:
-        # Modo producción - conexión directa
-        whatsapp_link = f"https://wa.me/{phone}?text=Hola"
-        instructions = "1. Haz clic en el link o escanea el QR\n2. Envía 'Hola' para comenzar\n3. Vincula tu cuenta de LovableGrowth"
-    
-    return {
-        "whatsapp_link": whatsapp_link,
-        "phone_number": f"+{phone}",
-        "sandbox_code": config.TWILIO_SANDBOX_CODE or None,
-        "is_sandbox": bool(config.TWILIO_SANDBOX_CODE),
-        "instructions": instructions,
-        "qr_code_url": f"https://api.qrserver.com/v1/create-qr-code/?size=300x300&data={whatsapp_link}"
-    }
+    return connect_page_cache.info()
+
+@app.get("/connect/qr.png")
+async def get_qr_image(request: Request):
+    """PNG del QR de conexión, generado localmente"""
+    return _cached_response(request, connect_page_cache.qr())
 
 @app.get("/connect/qr")
-async def get_qr_code():
+async def get_qr_code(request: Request):
     """
     Devuelve una página HTML con el QR code para conectarse.
     Útil para compartir con usuarios.
     """
-    info = await get_connection_info()
-    
-    html = f"""
-    <!DOCTYPE html>
-    <html lang="es">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Conectar a LovableGrowth WhatsApp</title>
-        <style>
-            body {{
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-                display: flex;
-                flex-direction: column;
-                align-items: center;
-                justify-content: center;
-                min-height: 100vh;
-                margin: 0;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-            }}
-            .container {{
-                background: white;
-                border-radius: 20px;
-                padding: 40px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                text-align: center;
-                max-width: 400px;
-            }}
-            h1 {{
-                color: #333;
-                margin-bottom: 10px;
-            }}
-            p {{
-                color: #666;
-                margin-bottom: 20px;
-            }}
-            .qr-container {{
-                background: #f5f5f5;
-                padding: 20px;
-                border-radius: 15px;
-                margin: 20px 0;
-            }}
-            .qr-container img {{
-                border-radius: 10px;
-            }}
-            .instructions {{
-                text-align: left;
-                background: #f0f7ff;
-                padding: 15px 20px;
-                border-radius: 10px;
-                color: #333;
-                font-size: 14px;
-                white-space: pre-line;
-            }}
-            .btn {{
-                display: inline-block;
-                background: #25D366;
-                color: white;
-                padding: 15px 30px;
-                border-radius: 30px;
-                text-decoration: none;
-                font-weight: bold;
-                margin-top: 20px;
-                transition: transform 0.2s;
-            }}
-            .btn:hover {{
-                transform: scale(1.05);
-            }}
-            .phone {{
-                color: #999;
-                font-size: 12px;
-                margin-top: 10px;
-            }}
-            .badge {{
-                display: inline-block;
-                background: {"#ffc107" if info["is_sandbox"] else "#28a745"};
-                color: {"#333" if info["is_sandbox"] else "white"};
-                padding: 5px 15px;
-                border-radius: 20px;
-                font-size: 12px;
-                margin-bottom: 15px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🎯 LovableGrowth</h1>
-            <span class="badge">{"🧪 Modo Sandbox" if info["is_sandbox"] else "✅ Producción"}</span>
-            <p>Gestiona tus goals desde WhatsApp</p>
-            
-            <div class="qr-container">
-                <img src="{info["qr_code_url"]}" alt="QR Code" width="200" height="200">
-            </div>
-            
-            <div class="instructions">{info["instructions"]}</div>
-            
-            <a href="{info["whatsapp_link"]}" class="btn" target="_blank">
-                📱 Abrir WhatsApp
-            </a>
-            
-            <p class="phone">Número: {info["phone_number"]}</p>
-        </div>
-    </body>
-    </html>
-    """
-    
-    from fastapi.responses import HTMLResponse
-    return HTMLResponse(content=html)
+    return _cached_response(request, connect_page_cache.page())
 
 @app.post("/webhook/whatsapp")
 async def twilio_webhook(
     request: Request,
-    background_tasks: BackgroundTasks,
     From: str = Form(...),
     To: str = Form(...),
     Body: str = Form(...),
@@ -241,7 +217,8 @@ async def twilio_webhook(
     """
     Webhook para recibir mensajes de Twilio WhatsApp
     
-    Twilio envía POST con form-data cuando llega un mensaje
+    Twilio envía POST con form-data cuando llega un mensaje. Solo se guarda en
+    la cola durable: la respuesta se genera y envía desde los workers.
     """
     logger.info(f"📨 Mensaje recibido de {From}: {Body}")
     
@@ -250,171 +227,308 @@ async def twilio_webhook(
     # if not twilio_service.validate_request(str(request.url), dict(request.query_params), signature):
     #     raise HTTPException(status_code=403, detail="Invalid Twilio signature")
     
-    # Guardar mensaje entrante
-    save_conversation(
-        phone_number=From,
-        message=Body,
-        direction="inbound",
-        message_sid=MessageSid
-    )
+    # Reintento de Twilio de un mensaje ya aceptado: no se procesa otra vez
+    if not await idempotency_store.claim(MessageSid, From):
+        return Response(content=EMPTY_TWIML, media_type="application/xml")
     
-    try:
-        # Procesar mensaje con el orquestador de agentes
-        response_message = await orchestrator.process_message(From, Body)
-        
-        # Guardar respuesta
-        save_conversation(
-            phone_number=From,
-            message=response_message,
-            direction="outbound"
-        )
-        
-        # Enviar respuesta por WhatsApp en background
-        background_tasks.add_task(
-            twilio_service.send_message,
-            From,
-            response_message
-        )
-        
-        # Responder a Twilio con TwiML vacío
-        # (la respuesta se envía de forma asíncrona)
-        twiml = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
-        return Response(content=twiml, media_type="application/xml")
-        
-    except Exception as e:
-        logger.error(f"❌ Error procesando mensaje: {str(e)}")
-        
-        # Enviar mensaje de error al usuario
-        error_message = "❌ Hubo un error procesando tu mensaje. Por favor intenta de nuevo."
-        background_tasks.add_task(
-            twilio_service.send_message,
-            From,
-            error_message
-        )
-        
-        twiml = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
-        return Response(content=twiml, media_type="application/xml")
+    # Se responde a Twilio cuando el mensaje y su fila del historial ya están
+    # escritos: el MessageSid está reclamado y Twilio no lo reenviaría
+    accepted = await partitioned_intake.submit(InboundMessage(From, Body, MessageSid))
+    if not accepted:
+        await outbound_queue.enqueue(From, ERROR_MESSAGE, source="error")
+    
+    # Responder a Twilio con TwiML vacío
+    # (la respuesta se envía de forma asíncrona)
+    return Response(content=EMPTY_TWIML, media_type="application/xml")
 
 @app.post("/webhook/whatsapp/status")
 async def twilio_status_callback(request: Request):
     """
-    Callback para actualizaciones de estado de mensajes
+    Callback para actualizaciones de estado de mensajes (se guardan en bloque)
     """
     form_data = await request.form()
-    logger.info(f"📊 Status update: {dict(form_data)}")
+    logger.debug(f"📊 Status update: {dict(form_data)}")
+    delivery_tracker.record_status(
+        form_data.get("MessageSid"),
+        form_data.get("MessageStatus"),
+        form_data.get("ErrorCode"),
+        form_data.get("To")
+    )
     return {"status": "received"}
 
 # ============================================
 # API DE ADMINISTRACIÓN
 # ============================================
 
-@app.get("/api/users")
-async def list_users():
-    """Lista usuarios de WhatsApp registrados"""
-    from database import SessionLocal, WhatsAppUserDB
+@app.get("/api/feed")
+async def change_feed_stream(
+    phone: Optional[List[str]] = Query(default=None),
+    last_event_id: Optional[int] = Query(default=None),
+    last_event_id_header: Optional[str] = Header(default=None, alias="Last-Event-ID")
+):
+    """
+    Feed de cambios por Server-Sent Events: mensajes, autenticación y entregas.
     
-    db = SessionLocal()
+    `phone` (repetible) filtra por número; `Last-Event-ID` (o `last_event_id`)
+    reanuda desde el último evento recibido.
+    """
+    if change_feed.is_full():
+        raise HTTPException(status_code=503, detail="Too many feed subscribers")
+    
+    phones = [p if p.startswith("whatsapp:") else f"whatsapp:{p}" for p in phone] if phone else None
+    if last_event_id is None and last_event_id_header and last_event_id_header.isdigit():
+        last_event_id = int(last_event_id_header)
+    
+    return StreamingResponse(
+        change_feed.stream(phones, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _page_limit(limit: Optional[int]) -> int:
+    return max(1, min(limit or config.API_PAGE_SIZE, config.API_PAGE_MAX))
+
+def _decode_cursor(cursor: str, *types: type) -> list:
     try:
-        users = db.query(WhatsAppUserDB).all()
-        return {
-            "users": [
-                {
-                    "phone_number": u.phone_number,
-                    "email": u.email,
-                    "user_id": u.user_id,
-                    "is_verified": u.is_verified,
-                    "created_at": str(u.created_at) if u.created_at else None
-                }
-                for u in users
-            ]
-        }
-    finally:
-        db.close()
+        return decode_cursor(cursor, *types)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/users")
+async def list_users(cursor: Optional[str] = None, limit: Optional[int] = None):
+    """Lista usuarios de WhatsApp registrados (paginado; `next_cursor` da la página siguiente)"""
+    limit = _page_limit(limit)
+    query = select(WhatsAppUserDB).order_by(WhatsAppUserDB.id).limit(limit + 1)
+    if cursor:
+        (after_id,) = _decode_cursor(cursor, int)
+        query = query.where(WhatsAppUserDB.id > after_id)
+    
+    async with AsyncSessionLocal() as db:
+        users = (await db.execute(query)).scalars().all()
+    
+    has_more = len(users) > limit
+    users = users[:limit]
+    return {
+        "users": [
+            {
+                "phone_number": u.phone_number,
+                "email": u.email,
+                "user_id": u.user_id,
+                "is_verified": u.is_verified,
+                "created_at": str(u.created_at) if u.created_at else None
+            }
+            for u in users
+        ],
+        "next_cursor": encode_cursor(users[-1].id) if has_more else None
+    }
 
 @app.get("/api/conversations/{phone_number}")
-async def get_conversation_history(phone_number: str):
-    """Obtiene historial de conversación de un usuario"""
-    from database import SessionLocal, ConversationHistoryDB
+async def get_conversation_history(phone_number: str, cursor: Optional[str] = None, limit: Optional[int] = None):
+    """
+    Obtiene historial de conversación de un usuario.
     
+    Devuelve los mensajes más recientes en orden cronológico; `next_cursor`
+    da la página anterior (mensajes más antiguos).
+    """
     # Formatear número si es necesario
     if not phone_number.startswith("whatsapp:"):
         phone_number = f"whatsapp:{phone_number}"
     
-    db = SessionLocal()
+    limit = _page_limit(limit)
+    table = ConversationHistoryDB
+    query = (
+        select(table)
+        .where(table.phone_number == phone_number)
+        .order_by(table.created_at.desc(), table.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor:
+        before_at, before_id = _decode_cursor(cursor, datetime, int)
+        query = query.where(or_(
+            table.created_at < before_at,
+            and_(table.created_at == before_at, table.id < before_id)
+        ))
+    
+    async with AsyncSessionLocal() as db:
+        history = (await db.execute(query)).scalars().all()
+    
+    has_more = len(history) > limit
+    history = history[:limit]
+    return {
+        "phone_number": phone_number,
+        "messages": [
+            {
+                "id": h.id,
+                "direction": h.direction,
+                "message": h.message,
+                "intent": h.intent,
+                "created_at": str(h.created_at) if h.created_at else None
+            }
+            for h in reversed(history)
+        ],
+        "next_cursor": encode_cursor(history[-1].created_at, history[-1].id) if has_more else None
+    }
+
+@app.get("/api/export/conversations")
+async def export_conversations(
+    format: str = "ndjson",
+    phone: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    direction: Optional[str] = None,
+    intent: Optional[str] = None
+):
+    """
+    Exporta el historial en streaming (NDJSON o CSV), con filtros por número,
+    rango de fechas [start, end), dirección e intent.
+    """
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    if direction and direction not in ("inbound", "outbound"):
+        raise HTTPException(status_code=400, detail="direction must be inbound or outbound")
+    if phone and not phone.startswith("whatsapp:"):
+        phone = f"whatsapp:{phone}"
+    
+    filters = ExportFilters(phone_number=phone, start=start, end=end, direction=direction, intent=intent)
+    if format == "csv":
+        body, media_type = export_csv(filters), "text/csv; charset=utf-8"
+    else:
+        body, media_type = export_ndjson(filters), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="conversations.{format}"'}
+    )
+
+@app.get("/api/search")
+async def search_messages(
+    q: str,
+    phone: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    order: str = "rank",
+    limit: int = 20,
+    offset: int = 0
+):
+    """
+    Búsqueda de texto en el historial: palabras (todas), "frases exactas" y
+    prefijos (`rev*`), con filtros por número y fechas [start, end).
+    `order` = rank (relevancia) o recent.
+    """
+    if not config.DATABASE_URL.startswith("sqlite"):
+        raise HTTPException(status_code=501, detail="Search requires SQLite FTS5")
+    if order not in ("rank", "recent"):
+        raise HTTPException(status_code=400, detail="order must be rank or recent")
+    if phone and not phone.startswith("whatsapp:"):
+        phone = f"whatsapp:{phone}"
+    
     try:
-        history = db.query(ConversationHistoryDB).filter(
-            ConversationHistoryDB.phone_number == phone_number
-        ).order_by(ConversationHistoryDB.created_at.desc()).limit(50).all()
-        
-        return {
-            "phone_number": phone_number,
-            "messages": [
-                {
-                    "direction": h.direction,
-                    "message": h.message,
-                    "intent": h.intent,
-                    "created_at": str(h.created_at) if h.created_at else None
-                }
-                for h in reversed(history)
-            ]
-        }
-    finally:
-        db.close()
+        results = await search_conversations(
+            q, phone, start, end, order,
+            limit=_page_limit(limit),
+            offset=max(0, offset)
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"query": q, "results": results}
+
+@app.get("/api/conversations/{phone_number}/archive")
+async def get_archived_conversations(phone_number: str, limit: int = 100):
+    """Historial archivado (más antiguo que la retención) de un usuario"""
+    if not phone_number.startswith("whatsapp:"):
+        phone_number = f"whatsapp:{phone_number}"
+    
+    messages = await asyncio.to_thread(load_archived_conversations, phone_number, limit)
+    return {"phone_number": phone_number, "messages": messages}
 
 @app.post("/api/send-message")
-async def send_message_api(
-    phone_number: str,
-    message: str,
-    background_tasks: BackgroundTasks
-):
+async def send_message_api(phone_number: str, message: str):
     """Envía un mensaje proactivo a un usuario"""
     # Formatear número
     if not phone_number.startswith("whatsapp:"):
         phone_number = f"whatsapp:+{phone_number}" if not phone_number.startswith("+") else f"whatsapp:{phone_number}"
     
-    background_tasks.add_task(
-        twilio_service.send_message,
-        phone_number,
-        message
-    )
-    
-    save_conversation(
-        phone_number=phone_number,
-        message=message,
-        direction="outbound"
-    )
+    if outbound_queue.is_full():
+        raise HTTPException(status_code=503, detail="Outbound queue is full, try again later")
     
-    return {"status": "queued", "phone_number": phone_number}
+    # Se registra en el historial cuando Twilio confirma el envío
+    queued_id = await outbound_queue.enqueue(phone_number, message, source="api")
+    return {"status": "queued", "phone_number": phone_number, "queued_id": queued_id}
+
+@app.get("/api/outbound/dead-letters")
+async def list_outbound_dead_letters(limit: int = 100):
+    """Mensajes salientes que no se pudieron entregar"""
+    return {"dead_letters": await outbound_queue.dead_letters(limit)}
+
+@app.post("/api/outbound/dead-letters/{dead_letter_id}/retry")
+async def retry_outbound_dead_letter(dead_letter_id: int):
+    """Vuelve a encolar un mensaje saliente descartado"""
+    queued_id = await outbound_queue.retry_dead_letter(dead_letter_id)
+    if queued_id is None:
+        raise HTTPException(status_code=404, detail="Dead letter not found")
+    return {"status": "queued", "queued_id": queued_id}
+
+@app.get("/api/webapp-outbox")
+async def list_webapp_outbox(status: Optional[str] = None, phone: Optional[str] = None, limit: int = 100):
+    """Escrituras en la webapp pendientes, fallidas o sin confirmar, en el orden en que se aplicarán"""
+    if status and status not in ("pending", "failed", "unknown"):
+        raise HTTPException(status_code=400, detail="status must be 'pending', 'failed' or 'unknown'")
+    return {
+        "pending": await webapp_outbox.count("pending"),
+        "entries": await webapp_outbox.entries(status, phone, _page_limit(limit))
+    }
+
+@app.post("/api/webapp-outbox/{outbox_id}/retry")
+async def retry_webapp_outbox(outbox_id: int):
+    """Vuelve a poner en cola una escritura fallida o sin confirmar"""
+    entry = await webapp_outbox.retry(outbox_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Outbox entry not found")
+    return entry
+
+@app.post("/api/webapp-outbox/{outbox_id}/discard")
+async def discard_webapp_outbox(outbox_id: int):
+    """Descarta una escritura fallida o sin confirmar (p. ej. ya aparece en la webapp)"""
+    entry = await webapp_outbox.discard(outbox_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Outbox entry not found")
+    return entry
 
 @app.post("/api/broadcast")
-async def broadcast_message(
-    message: str,
-    background_tasks: BackgroundTasks
-):
-    """Envía un mensaje a todos los usuarios verificados"""
-    from database import SessionLocal, WhatsAppUserDB
-    
-    db = SessionLocal()
-    try:
-        users = db.query(WhatsAppUserDB).filter(
-            WhatsAppUserDB.is_verified == True
-        ).all()
-        
-        for user in users:
-            background_tasks.add_task(
-                twilio_service.send_message,
-                user.phone_number,
-                message
-            )
-            save_conversation(
-                phone_number=user.phone_number,
-                message=message,
-                direction="outbound"
-            )
-        
-        return {"status": "queued", "recipients": len(users)}
-    finally:
-        db.close()
+async def broadcast_message(message: str):
+    """Envía un mensaje a todos los usuarios verificados (en segundo plano, con límite de ritmo)"""
+    broadcast = await broadcast_engine.create(message)
+    return {"status": "queued", "broadcast_id": broadcast["id"], "recipients": broadcast["total"]}
+
+@app.get("/api/broadcasts")
+async def list_broadcasts(limit: int = 20):
+    """Broadcasts recientes con su progreso"""
+    return {"broadcasts": await broadcast_engine.recent(limit)}
+
+@app.get("/api/broadcast/{broadcast_id}")
+async def get_broadcast(broadcast_id: int):
+    """Progreso de un broadcast y sus primeros fallos"""
+    broadcast = await broadcast_engine.get(broadcast_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    broadcast["failures"] = await broadcast_engine.failures(broadcast_id)
+    return broadcast
+
+@app.post("/api/broadcast/{broadcast_id}/cancel")
+async def cancel_broadcast(broadcast_id: int):
+    """Cancela un broadcast en curso"""
+    broadcast = await broadcast_engine.cancel(broadcast_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return broadcast
+
+@app.post("/api/broadcast/{broadcast_id}/resume")
+async def resume_broadcast(broadcast_id: int):
+    """Reanuda un broadcast fallido o interrumpido desde donde se quedó"""
+    broadcast = await broadcast_engine.resume(broadcast_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return broadcast
 
 # ============================================
 # PUNTO DE ENTRADA
@@ -0,0 +1,190 @@
+"""
+Cola de mensajes entrantes de WhatsApp
+
+El webhook de Twilio solo guarda el mensaje en la cola durable
+(`worker_processes`); un pool de workers asyncio lo procesa con el orquestador y deja la respuesta en la cola saliente
+(`outbound_queue`), que la envía por Twilio. Así el LLM y la API de la webapp
+quedan fuera del timeout del webhook.
+
+Cada número de teléfono se procesa en serie (nunca hay dos turnos del mismo
+número en vuelo) y los mensajes que llegan dentro de una ventana corta se
+agrupan en un solo turno. Números distintos se procesan en paralelo.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from config import config
+from outbound_queue import outbound_queue
+
+logger = logging.getLogger(__name__)
+
+ERROR_MESSAGE = "❌ Hubo un error procesando tu mensaje. Por favor intenta de nuevo."
+
+# Número de latencias recientes que se guardan para los percentiles
+LATENCY_WINDOW = 1000
+
+
+@dataclass
+class InboundMessage:
+    """Mensaje entrante pendiente de procesar"""
+    phone_number: str
+    body: str
+    message_sid: str = ""
+    received_at: float = field(default_factory=time.monotonic)
+    received_utc: datetime = field(default_factory=datetime.utcnow)
+    # id en la cola durable
+    queue_id: Optional[int] = None
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct))
+    return round(ordered[index], 1)
+
+
+class MessageWorkerPool:
+    """Pool de workers que procesa mensajes entrantes en segundo plano"""
+
+    def __init__(self, orchestrator, workers: int = None, maxsize: int = None, coalesce_window: float = None):
+        self.orchestrator = orchestrator
+        self.num_workers = workers or config.INBOUND_WORKERS
+        self.maxsize = maxsize or config.INBOUND_QUEUE_MAXSIZE
+        self.coalesce_window = config.INBOUND_COALESCE_WINDOW if coalesce_window is None else coalesce_window
+
+        # Cola de números listos para procesar; los mensajes esperan en _pending
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[str, List[InboundMessage]] = {}
+        self._pending_count = 0
+        # Números con un turno programado, encolado o en proceso
+        self._active: set = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        self._workers: List[asyncio.Task] = []
+        self._latencies_ms = deque(maxlen=LATENCY_WINDOW)
+        self._stats = {
+            "enqueued": 0,
+            "processed": 0,
+            "coalesced": 0,
+            "turns": 0,
+            "failed": 0,
+            "rejected": 0,
+        }
+
+    async def start(self):
+        """Arranca los workers (llamado desde el lifespan de la app)"""
+        for i in range(self.num_workers):
+            self._workers.append(asyncio.create_task(self._worker(i)))
+        logger.info(f"✅ {self.num_workers} workers de mensajes iniciados")
+
+    async def stop(self, timeout: float = 10.0):
+        """Espera a que se procesen los mensajes pendientes (con límite) y detiene los workers"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Cola no vaciada al apagar: {self._pending_count} mensajes pendientes")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def is_full(self) -> bool:
+        return self._pending_count >= self.maxsize
+
+    def submit(self, message: InboundMessage) -> bool:
+        """Encola un mensaje sin bloquear. Devuelve False si la cola está llena."""
+        if self.is_full():
+            self._stats["rejected"] += 1
+            logger.error(f"❌ Cola llena, mensaje de {message.phone_number} rechazado")
+            return False
+
+        self._pending.setdefault(message.phone_number, []).append(message)
+        self._pending_count += 1
+        self._stats["enqueued"] += 1
+
+        if message.phone_number not in self._active:
+            self._active.add(message.phone_number)
+            self._idle.clear()
+            self._schedule(message.phone_number)
+        return True
+
+    def _schedule(self, phone_number: str):
+        """Marca el número como listo cuando termine la ventana de agrupación"""
+        if self.coalesce_window > 0:
+            asyncio.get_running_loop().call_later(self.coalesce_window, self.queue.put_nowait, phone_number)
+        else:
+            self.queue.put_nowait(phone_number)
+
+    async def _worker(self, worker_id: int):
+        while True:
+            phone_number = await self.queue.get()
+            batch = self._pending.pop(phone_number, [])
+            self._pending_count -= len(batch)
+            try:
+                if batch:
+                    await self._handle(phone_number, batch)
+            except Exception as e:
+                logger.error(f"❌ Worker {worker_id} error inesperado: {str(e)}")
+            finally:
+                self.queue.task_done()
+                # Si llegaron más mensajes mientras procesábamos, otro turno
+                if phone_number in self._pending:
+                    self._schedule(phone_number)
+                else:
+                    self._active.discard(phone_number)
+                    if not self._active:
+                        self._idle.set()
+
+    async def _handle(self, phone_number: str, batch: List[InboundMessage]):
+        """Procesa un turno (uno o varios mensajes) y encola la respuesta por WhatsApp"""
+        self._stats["turns"] += 1
+        # El usuario espera desde el primer mensaje del turno
+        received_utc = min(m.received_utc for m in batch)
+        if len(batch) > 1:
+            self._stats["coalesced"] += len(batch) - 1
+
+        try:
+            response_message = await self.orchestrator.process_burst(
+                phone_number,
+                [m.body for m in batch],
+                [m.message_sid for m in batch],
+                logged=True
+            )
+        except Exception as e:
+            logger.error(f"❌ Error procesando mensaje: {str(e)}")
+            self._stats["failed"] += len(batch)
+            await outbound_queue.enqueue(phone_number, ERROR_MESSAGE, source="error", received_at=received_utc)
+            return
+
+        # Se registra en el historial cuando Twilio confirma el envío
+        await outbound_queue.enqueue(phone_number, response_message, received_at=received_utc)
+
+        now = time.monotonic()
+        self._stats["processed"] += len(batch)
+        for message in batch:
+            self._latencies_ms.append((now - message.received_at) * 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        """Profundidad de cola y latencia de respuesta (recepción → respuesta encolada)"""
+        latencies = list(self._latencies_ms)
+        return {
+            **self._stats,
+            "workers": len(self._workers),
+            "queue_depth": self._pending_count,
+            "queue_maxsize": self.maxsize,
+            "active_phones": len(self._active),
+            "coalesce_window_s": self.coalesce_window,
+            "reply_latency_ms": {
+                "p50": _percentile(latencies, 0.50),
+                "p95": _percentile(latencies, 0.95),
+                "p99": _percentile(latencies, 0.99),
+                "samples": len(latencies),
+            },
+        }
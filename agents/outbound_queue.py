@@ -0,0 +1,330 @@
+"""
+Cola persistente de mensajes salientes de WhatsApp
+
+Las respuestas y los envíos puntuales se guardan en `outbound_queue` antes de
+llamar a Twilio, así que sobreviven a caídas y reinicios. Un dispatcher elige
+la cabeza de la cola de cada número (el mensaje más antiguo) y la reparte a un
+pool de workers; un número nunca tiene dos envíos en vuelo, de modo que los
+mensajes llegan en el orden en que se encolaron. Todos los envíos pasan por
+el token bucket de la cuenta de Twilio (`twilio_bucket`, el mismo que usan
+los broadcasts).
+
+Los fallos temporales se reintentan con espera exponencial. Los definitivos
+(4xx de Twilio) o los que agotan OUTBOUND_MAX_ATTEMPTS pasan a
+`outbound_dead_letters`, desde donde se pueden reencolar a mano. También los
+ambiguos (timeout después de enviar la petición): puede que Twilio sí
+aceptara el mensaje, y como no hay SID no se puede cruzar con los callbacks
+de estado, así que se decide a mano en vez de arriesgar un duplicado. Si algo
+falla después de que Twilio acepte un mensaje, su SID queda en memoria y el
+reintento (con la misma espera) solo termina de sacarlo de la cola.
+
+En modo multiproceso cada proceso worker envía solo a los números de su
+partición y el proceso web únicamente encola.
+"""
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import select, insert, update, delete, func
+
+from config import config
+from conversation_log import conversation_log
+from database import AsyncSessionLocal, OutboundMessageDB, OutboundDeadLetterDB
+from delivery_status import delivery_tracker
+from rate_limit import TokenBucket, twilio_bucket
+from twilio_service import twilio_service
+
+logger = logging.getLogger(__name__)
+
+# Error de los dead letters que puede que Twilio sí aceptara
+UNCONFIRMED_PREFIX = "Sin confirmar (revisar en Twilio antes de reencolar): "
+
+
+def _dead_letter_to_dict(row: OutboundDeadLetterDB) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "phone_number": row.phone_number,
+        "message": row.body,
+        "source": row.source,
+        "attempts": row.attempts,
+        "error": row.last_error,
+        "created_at": str(row.created_at) if row.created_at else None,
+        "failed_at": str(row.failed_at) if row.failed_at else None,
+    }
+
+
+class OutboundQueue:
+    """Envía los mensajes encolados en SQLite con orden por número y reintentos"""
+
+    def __init__(self, workers: int = None, rate: float = None, max_attempts: int = None, max_depth: int = None):
+        self.num_workers = workers or config.OUTBOUND_WORKERS
+        self.bucket = twilio_bucket if rate is None else TokenBucket(rate, config.TWILIO_SEND_BURST)
+        self.max_attempts = max_attempts or config.OUTBOUND_MAX_ATTEMPTS
+        self.max_depth = max_depth or config.OUTBOUND_QUEUE_MAX
+
+        self._ready: asyncio.Queue = asyncio.Queue()
+        # Números con un envío repartido o en vuelo
+        self._inflight: set = set()
+        # id de fila -> SID de los mensajes que Twilio aceptó y aún siguen en la cola
+        self._accepted: Dict[int, str] = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+        self._depth = 0
+        # (índice, total) en los procesos worker del modo multiproceso
+        self.partition: Optional[tuple] = None
+        self._stats = {
+            "enqueued": 0,
+            "sent": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+            "unconfirmed": 0,
+            "requeued": 0,
+        }
+
+    def set_partition(self, index: int, total: int):
+        """Solo envía a los números de la partición `index` (antes de start)"""
+        self.partition = (index, total)
+
+    def _in_partition(self, query):
+        if self.partition is None:
+            return query
+        index, total = self.partition
+        return query.where(func.phone_partition(OutboundMessageDB.phone_number, total) == index)
+
+    async def _count(self) -> int:
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(
+                self._in_partition(select(func.count()).select_from(OutboundMessageDB))
+            )).scalar()
+
+    async def start(self, dispatch: bool = True):
+        """
+        Arranca el dispatcher y los workers; retoma lo que quedó en la cola.
+
+        Con `dispatch=False` (proceso web en modo multiproceso) no se envía nada:
+        solo se encola y se recuenta la profundidad, que vacían los workers.
+        """
+        self._depth = await self._count()
+        if not dispatch:
+            self._dispatcher = asyncio.create_task(self._track_depth())
+            return
+        if self._depth:
+            logger.info(f"📤 Retomando {self._depth} mensajes salientes pendientes")
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        for i in range(self.num_workers):
+            self._workers.append(asyncio.create_task(self._worker(i)))
+
+    async def stop(self, timeout: float = 10.0):
+        """Deja de repartir y espera a los envíos en vuelo; el resto sigue en la BD"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        # Lo repartido pero no empezado vuelve a la BD tal cual
+        while not self._ready.empty():
+            self._ready.get_nowait()
+            self._ready.task_done()
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Envíos salientes sin terminar al apagar")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._inflight.clear()
+
+    def is_full(self) -> bool:
+        return self._depth >= self.max_depth
+
+    async def enqueue(self, phone_number: str, message: str, source: str = "reply", received_at: datetime = None) -> int:
+        """
+        Guarda el mensaje en la cola y despierta al dispatcher. `received_at` es
+        la llegada del mensaje al que se responde (para medir la latencia).
+        """
+        async with AsyncSessionLocal() as db:
+            row = OutboundMessageDB(phone_number=phone_number, body=message, source=source, received_at=received_at)
+            db.add(row)
+            await db.commit()
+        self._depth += 1
+        self._stats["enqueued"] += 1
+        self._wakeup.set()
+        return row.id
+
+    async def dead_letters(self, limit: int = 100) -> List[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(OutboundDeadLetterDB).order_by(OutboundDeadLetterDB.id.desc()).limit(limit)
+            )).scalars().all()
+            return [_dead_letter_to_dict(row) for row in rows]
+
+    async def retry_dead_letter(self, dead_letter_id: int) -> Optional[int]:
+        """Vuelve a encolar un mensaje muerto (al final de la cola de su número)"""
+        async with AsyncSessionLocal() as db:
+            row = await db.get(OutboundDeadLetterDB, dead_letter_id)
+            if row is None:
+                return None
+            message = OutboundMessageDB(phone_number=row.phone_number, body=row.body, source=row.source or "reply")
+            db.add(message)
+            await db.delete(row)
+            await db.commit()
+        self._depth += 1
+        self._stats["requeued"] += 1
+        self._wakeup.set()
+        return message.id
+
+    async def _track_depth(self):
+        while True:
+            await asyncio.sleep(1.0)
+            try:
+                self._depth = await self._count()
+            except Exception as e:
+                logger.error(f"❌ Error contando la cola saliente: {str(e)}")
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                rows = await self._next_batch()
+            except Exception as e:
+                logger.error(f"❌ Error leyendo la cola saliente: {str(e)}")
+                rows = []
+            for row in rows:
+                self._inflight.add(row.phone_number)
+                self._ready.put_nowait(row)
+
+            if not rows or self._ready.qsize() >= self.num_workers:
+                # Esperar a un encolado, a un envío terminado o al próximo reintento
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _next_batch(self) -> List[OutboundMessageDB]:
+        """Cabezas de cola (mensaje más antiguo de cada número) ya vencidas"""
+        heads = (
+            select(func.min(OutboundMessageDB.id))
+            .group_by(OutboundMessageDB.phone_number)
+        )
+        query = (
+            select(OutboundMessageDB)
+            .where(OutboundMessageDB.id.in_(heads))
+            .where(OutboundMessageDB.next_attempt_at <= datetime.utcnow())
+            .order_by(OutboundMessageDB.next_attempt_at, OutboundMessageDB.id)
+            .limit(self.num_workers * 2)
+        )
+        if self._inflight:
+            query = query.where(OutboundMessageDB.phone_number.notin_(self._inflight))
+        async with AsyncSessionLocal() as db:
+            return list((await db.execute(self._in_partition(query))).scalars().all())
+
+    async def _worker(self, worker_id: int):
+        while True:
+            row = await self._ready.get()
+            try:
+                await self._deliver(row)
+            except Exception as e:
+                # El mensaje sigue en la BD: se reintenta con la misma espera que un fallo temporal
+                logger.error(f"❌ Worker saliente {worker_id} error inesperado: {str(e)}")
+                try:
+                    await self._retry_later(row, (row.attempts or 0) + 1, str(e))
+                except Exception as e:
+                    logger.error(f"❌ Error programando el reintento de {row.phone_number}: {str(e)}")
+            finally:
+                self._inflight.discard(row.phone_number)
+                self._ready.task_done()
+                self._wakeup.set()
+
+    async def _deliver(self, row: OutboundMessageDB):
+        sid = self._accepted.get(row.id)
+        if sid is None:
+            await self.bucket.acquire()
+            # Los reintentos se programan aquí, no dentro del servicio de Twilio
+            result = await twilio_service.send(row.phone_number, row.body, max_retries=0)
+            if result.sid:
+                # Antes que nada: si lo que sigue falla, el reintento no lo reenvía
+                sid = self._accepted[row.id] = result.sid
+
+        if sid:
+            async with AsyncSessionLocal() as db:
+                await db.execute(delete(OutboundMessageDB).where(OutboundMessageDB.id == row.id))
+                await db.commit()
+            del self._accepted[row.id]
+            self._depth -= 1
+            self._stats["sent"] += 1
+            conversation_log.log(
+                phone_number=row.phone_number,
+                message=row.body,
+                direction="outbound",
+                message_sid=sid
+            )
+            delivery_tracker.record_accepted(
+                sid,
+                row.phone_number,
+                source=row.source,
+                received_at=row.received_at,
+                queued_at=row.created_at
+            )
+            return
+
+        attempts = (row.attempts or 0) + 1
+        if not result.retryable and not result.permanent:
+            self._stats["unconfirmed"] += 1
+            await self._dead_letter(row, attempts, f"{UNCONFIRMED_PREFIX}{result.error}")
+            return
+        if result.permanent or attempts >= self.max_attempts:
+            await self._dead_letter(row, attempts, result.error)
+            return
+        await self._retry_later(row, attempts, result.error)
+
+    async def _retry_later(self, row: OutboundMessageDB, attempts: int, error: Optional[str]):
+        """Aplaza la fila con espera exponencial (con jitter)"""
+        delay = min(config.OUTBOUND_RETRY_MAX, config.OUTBOUND_RETRY_BASE * (2 ** (attempts - 1)))
+        delay *= random.uniform(0.5, 1.0)
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(OutboundMessageDB)
+                .where(OutboundMessageDB.id == row.id)
+                .values(
+                    attempts=attempts,
+                    last_error=error,
+                    next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+                )
+            )
+            await db.commit()
+        self._stats["retried"] += 1
+
+    async def _dead_letter(self, row: OutboundMessageDB, attempts: int, error: Optional[str]):
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(OutboundDeadLetterDB.__table__).values(
+                phone_number=row.phone_number,
+                body=row.body,
+                source=row.source,
+                attempts=attempts,
+                last_error=error,
+                created_at=row.created_at,
+                failed_at=datetime.utcnow()
+            ))
+            await db.execute(delete(OutboundMessageDB).where(OutboundMessageDB.id == row.id))
+            await db.commit()
+        self._depth -= 1
+        self._stats["dead_lettered"] += 1
+        logger.error(f"☠️ Mensaje a {row.phone_number} descartado tras {attempts} intentos: {error}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "inflight_phones": len(self._inflight),
+            "workers": len(self._workers),
+            "rate_per_s": self.bucket.rate,
+            "partition": list(self.partition) if self.partition else None,
+        }
+
+
+# Instancia global
+outbound_queue = OutboundQueue()
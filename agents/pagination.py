@@ -0,0 +1,40 @@
+"""
+Cursores opacos para paginación keyset (por clave, sin OFFSET)
+
+El cursor guarda los valores de la clave de orden de la última fila devuelta;
+la página siguiente empieza justo después. Así cada página cuesta lo mismo
+aunque la tabla crezca, y las inserciones no desplazan filas entre páginas.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Type
+
+
+def encode_cursor(*values: Any) -> str:
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, *types: Type) -> List[Any]:
+    """Valores del cursor con los tipos indicados (int, str o datetime); ValueError si no es válido"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    return [_coerce(value, kind) for value, kind in zip(values, types)]
+
+
+def _coerce(value: Any, kind: Type) -> Any:
+    # El cursor llega del cliente: un valor de otro tipo no debe llegar a la consulta
+    if kind is datetime:
+        try:
+            return datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+    if type(value) is not kind:
+        raise ValueError("Invalid cursor")
+    return value
@@ -0,0 +1,127 @@
+"""
+Prefetch especulativo de datos de la webapp
+
+Mientras Groq analiza la intención, se lanza en paralelo la lectura que
+probablemente necesitará la acción (goals, leaderboard o métricas), según
+palabras clave del mensaje y las acciones recientes del usuario. Cuando se
+conoce la intención, el resultado se usa o se descarta.
+"""
+import asyncio
+import logging
+from collections import Counter
+from typing import Optional, Dict, Any, List
+
+from api_client import api_client
+from command_router import normalize
+
+logger = logging.getLogger(__name__)
+
+# Señales baratas en el texto (normalizado, sin acentos)
+KEYWORDS = {
+    "goals": ["goal", "objetivo", "meta", "complet", "termine", "hecho", "logre"],
+    "leaderboard": ["ranking", "leaderboard", "posicion", "puesto", "clasificacion"],
+    "metrics": ["metrica", "historial", "estadistica", "crecimiento", "evolucion"],
+}
+
+# Qué lectura usa cada acción de _execute_action
+ACTION_FETCH = {
+    "LIST_GOALS": "goals",
+    "COMPLETE_GOAL": "goals",
+    "VIEW_LEADERBOARD": "leaderboard",
+    "VIEW_METRICS": "metrics",
+}
+
+
+class Prefetch:
+    """Lectura especulativa en curso"""
+
+    def __init__(self, kind: str, task: asyncio.Task):
+        self.kind = kind
+        self.task = task
+        self.used = False
+
+    async def take(self) -> Dict[str, Any]:
+        self.used = True
+        return await self.task
+
+
+class SpeculativePrefetcher:
+    """Predice y lanza la lectura probable; lleva la tasa de aciertos"""
+
+    def __init__(self):
+        self._stats = {
+            "started": 0,
+            "hits": 0,
+            "wasted": 0,
+            "failed": 0,
+        }
+        self._by_kind: Dict[str, Dict[str, int]] = {}
+
+    def predict(self, message: str, recent_intents: List[str]) -> Optional[str]:
+        """Devuelve el tipo de lectura más probable o None"""
+        text = normalize(message)
+        for kind, words in KEYWORDS.items():
+            if any(word in text for word in words):
+                return kind
+
+        kinds = [ACTION_FETCH[i] for i in recent_intents if i in ACTION_FETCH]
+        if kinds:
+            return Counter(kinds).most_common(1)[0][0]
+        return None
+
+    def start(self, message: str, recent_intents: List[str], auth_token: str, user_id: int = None) -> Optional[Prefetch]:
+        kind = self.predict(message, recent_intents)
+        if kind is None:
+            return None
+
+        if kind == "goals":
+            coro = api_client.get_goals(auth_token)
+        elif kind == "leaderboard":
+            coro = api_client.get_leaderboard(auth_token, user_id)
+        else:
+            coro = api_client.get_metrics_history(auth_token)
+
+        self._stats["started"] += 1
+        self._kind_stats(kind)["started"] += 1
+        return Prefetch(kind, asyncio.create_task(coro))
+
+    async def fetch(self, prefetch: Optional[Prefetch], kind: str, fetch, *args) -> Dict[str, Any]:
+        """Usa el resultado especulado si coincide; si no (o si falló), hace la lectura normal"""
+        if prefetch is not None and prefetch.kind == kind and not prefetch.used:
+            try:
+                result = await prefetch.take()
+                self._stats["hits"] += 1
+                self._kind_stats(kind)["hits"] += 1
+                return result
+            except Exception as e:
+                self._stats["failed"] += 1
+                logger.warning(f"⚠️ Prefetch de {kind} falló, reintentando: {str(e)}")
+        return await fetch(*args)
+
+    def finish(self, prefetch: Optional[Prefetch]):
+        """Descarta un prefetch no usado"""
+        if prefetch is None or prefetch.used:
+            return
+        self._stats["wasted"] += 1
+        self._kind_stats(prefetch.kind)["wasted"] += 1
+        if prefetch.task.done():
+            # Recoger la excepción para que asyncio no la reporte
+            if not prefetch.task.cancelled():
+                prefetch.task.exception()
+        else:
+            prefetch.task.cancel()
+
+    def _kind_stats(self, kind: str) -> Dict[str, int]:
+        return self._by_kind.setdefault(kind, {"started": 0, "hits": 0, "wasted": 0})
+
+    def stats(self) -> Dict[str, Any]:
+        started = self._stats["started"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / started, 3) if started else 0.0,
+            "by_kind": {k: dict(v) for k, v in self._by_kind.items()},
+        }
+
+
+# Instancia global
+prefetcher = SpeculativePrefetcher()
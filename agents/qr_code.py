@@ -0,0 +1,23 @@
+"""
+Generación local de códigos QR (PNG con Pillow)
+
+El QR lo codifica el paquete `qrcode` (modo byte, nivel de corrección M, la
+versión más pequeña en la que cabe el texto) y se dibuja con Pillow, sin
+depender de un servicio externo.
+"""
+import io
+
+import qrcode
+from qrcode.constants import ERROR_CORRECT_M
+from qrcode.image.pil import PilImage
+
+
+def qr_png(text: str, box_size: int = 8, border: int = 4) -> bytes:
+    """PNG en blanco y negro del QR"""
+    qr = qrcode.QRCode(error_correction=ERROR_CORRECT_M, box_size=box_size, border=border)
+    qr.add_data(text.encode("utf-8"))
+    qr.make(fit=True)
+    image = qr.make_image(image_factory=PilImage)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
@@ -0,0 +1,59 @@
+"""
+Limitador de ritmo (token bucket) para envíos a Twilio
+
+`twilio_bucket` es el ritmo de la cuenta (TWILIO_SEND_RATE): lo comparten la
+cola saliente y los broadcasts, así que entre los dos nunca lo superan. En
+modo multiproceso se reparte entre los procesos que envían.
+"""
+import asyncio
+import time
+
+from config import config
+
+
+class TokenBucket:
+    """
+    Permite `rate` operaciones por segundo con ráfagas de hasta `burst`.
+
+    Los que esperan se atienden en orden de llegada.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate: float, burst: int = None):
+        """Cambia el ritmo (y la ráfaga) sin perder los tokens acumulados"""
+        self._refill()
+        self.rate = rate
+        if burst is not None:
+            self.burst = max(1, burst)
+            self._tokens = min(self._tokens, self.burst)
+
+    async def acquire(self):
+        """Espera hasta que haya un token disponible y lo consume"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+def split_twilio_rate(senders: int):
+    """Deja en este proceso su parte del ritmo de la cuenta (`senders` procesos envían)"""
+    twilio_bucket.set_rate(config.TWILIO_SEND_RATE / senders, config.TWILIO_SEND_BURST // senders)
+
+
+# Instancia global
+twilio_bucket = TokenBucket(config.TWILIO_SEND_RATE, config.TWILIO_SEND_BURST)
@@ -0,0 +1,17 @@
+"""
+Los módulos de agents/ se importan por nombre (como en main.py), sin paquete.
+Los tests que usan la base de datos escriben en una SQLite temporal.
+"""
+import os
+import sys
+import tempfile
+
+# Antes de importar config/database
+_tmp = tempfile.mkdtemp(prefix="agents-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/agents.db")
+os.environ.setdefault("CONVERSATION_LOG_SPILL_PATH", f"{_tmp}/conversation_log.spill.jsonl")
+os.environ.setdefault("DELIVERY_STATUS_SPILL_PATH", f"{_tmp}/delivery_status.spill.jsonl")
+# agents.py crea los clientes de Groq al importarse; los tests no llaman a la API
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+"""
+Leaderboard compartido: is_current_user se calcula para cada usuario y quien
+queda fuera de la lista recibe el current_user que la API calcula para su
+token (una petición por TTL), no el de otro usuario
+"""
+import asyncio
+
+from api_client import WebAppAPIClient
+
+TOP = [
+    {"user_id": 1, "name": "Ana", "rank": 1, "score": 90},
+    {"user_id": 2, "name": "Luis", "rank": 2, "score": 80},
+]
+CURRENT = {"token-1": TOP[0], "token-2": TOP[1], "token-7": {"user_id": 7, "name": "Eva", "rank": 57, "score": 3}}
+
+
+def _client(monkeypatch):
+    client = WebAppAPIClient(base_url="http://webapp.test")
+    client.requests = []
+
+    async def get_json(path, auth_token):
+        client.requests.append(auth_token)
+        return {"leaderboard": TOP, "current_user": CURRENT[auth_token]}
+
+    monkeypatch.setattr(client, "_get_json", get_json)
+    return client
+
+
+def test_current_user_from_shared_slice(monkeypatch):
+    client = _client(monkeypatch)
+
+    async def scenario():
+        return await client.get_leaderboard("token-1", 1), await client.get_leaderboard("token-2", 2)
+
+    first, second = asyncio.run(scenario())
+    assert first["current_user"]["user_id"] == 1
+    assert second["current_user"]["user_id"] == 2
+    assert [e["is_current_user"] for e in second["leaderboard"]] == [False, True]
+    assert client.requests == ["token-1"]
+
+
+def test_current_user_outside_slice_is_fetched_per_token(monkeypatch):
+    client = _client(monkeypatch)
+
+    async def scenario():
+        await client.get_leaderboard("token-1", 1)
+        return [await client.get_leaderboard("token-7", 7) for _ in range(2)]
+
+    first, second = asyncio.run(scenario())
+    assert first["current_user"]["rank"] == 57
+    assert second["current_user"]["rank"] == 57
+    assert not any(e["is_current_user"] for e in first["leaderboard"])
+    assert client.requests == ["token-1", "token-7"]
+
+    client.invalidate_leaderboard()
+    asyncio.run(client.get_leaderboard("token-7", 7))
+    assert client.requests == ["token-1", "token-7", "token-7"]
@@ -0,0 +1,80 @@
+"""
+Broadcasts: los reintentos ante 429/5xx vuelven a pasar por el token bucket y
+los fallos guardan el error que devolvió Twilio
+"""
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+import broadcast as broadcast_module
+from broadcast import BroadcastEngine
+from database import init_db, close_async_db, AsyncSessionLocal, BroadcastFailureDB
+from twilio_service import SendResult, TwilioWhatsAppService
+
+
+class _CountingBucket:
+    def __init__(self):
+        self.acquired = 0
+
+    async def acquire(self):
+        self.acquired += 1
+
+
+class _ScriptedTwilio(TwilioWhatsAppService):
+    """send() devuelve los resultados del guion, en orden, y anota max_retries"""
+
+    def __init__(self, results):
+        super().__init__(account_sid="AC123", auth_token="token", max_retries=2)
+        self.results = results
+        self.calls = []
+
+    async def send(self, to_number, message, max_retries=None):
+        self.calls.append(max_retries)
+        return self.results.pop(0)
+
+
+@pytest.fixture
+def engine():
+    init_db()
+    engine = BroadcastEngine()
+    engine.bucket = _CountingBucket()
+    return engine
+
+
+def test_retries_go_through_the_bucket(engine, monkeypatch):
+    twilio = _ScriptedTwilio([
+        SendResult(error="HTTP 429", retryable=True, retry_after=0),
+        SendResult(sid="SM1"),
+    ])
+    monkeypatch.setattr(broadcast_module, "twilio_service", twilio)
+
+    result = asyncio.run(engine._send("+34600000004", "hola"))
+    assert result.sid == "SM1"
+    assert twilio.calls == [0, 0]
+    assert engine.bucket.acquired == 2
+
+
+def test_gives_up_after_max_retries(engine, monkeypatch):
+    twilio = _ScriptedTwilio([SendResult(error="HTTP 503", retryable=True, retry_after=0)] * 3)
+    monkeypatch.setattr(broadcast_module, "twilio_service", twilio)
+
+    result = asyncio.run(engine._send("+34600000004", "hola"))
+    assert result.sid is None
+    assert engine.bucket.acquired == 3
+
+
+def test_failure_keeps_twilio_error(engine):
+    async def scenario():
+        try:
+            await engine._save_page(9001, 1, "hola", [
+                ("whatsapp:+34600000005", SendResult(error="HTTP 400: número inválido", permanent=True)),
+            ])
+            async with AsyncSessionLocal() as db:
+                return (await db.execute(
+                    select(BroadcastFailureDB.error).where(BroadcastFailureDB.broadcast_id == 9001)
+                )).scalars().all()
+        finally:
+            await close_async_db()
+
+    assert asyncio.run(scenario()) == ["HTTP 400: número inválido"]
@@ -0,0 +1,179 @@
+"""
+Índice local de inversores: los filtros por bitset dan lo mismo que un
+filtrado ingenuo fila a fila, el ticket se interpreta y se aplica, y el
+enriquecimiento con Apify asigna cada perfil a su inversor; búsqueda más
+enriquecimiento (con un actor de Apify falso) cabe en el presupuesto de 50 ms
+"""
+import random
+import time
+
+import pytest
+
+from investor_index import InvestorIndex, enrich_with_apify, parse_ticket, _fold, _split_list
+
+STAGES = ["pre-seed", "seed", "series-a", "series-b", "growth"]
+SECTORS = ["AI", "SaaS", "Fintech", "Health", "EdTech", "B2B", "B2C", "Marketplace", "DeepTech", "Consumer"]
+GEOS = ["Spain", "LatAm", "USA", "Europe", "Global"]
+WORDS = ["b2b", "saas", "retention", "marketplace", "founders", "europe", "ai", "infra",
+         "payments", "health", "latam", "consumer", "climate", "developer", "tools"]
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    rng = random.Random(7)
+    investors = []
+    for i in range(2000):
+        lo = rng.choice([0, 25000, 100000, 500000, 1000000])
+        investors.append({
+            "id": i + 1,
+            "name": f"Fund {i}",
+            "country": rng.choice(GEOS),
+            "geography": ",".join(rng.sample(GEOS, 2)),
+            "stage": ",".join(rng.sample(STAGES, 2)),
+            "sectors": ",".join(rng.sample(SECTORS, 3)),
+            "min_ticket_usd": lo,
+            "max_ticket_usd": lo * rng.choice([0, 2, 5, 10]),
+            "description": " ".join(rng.choices(WORDS, k=12)),
+        })
+    return investors
+
+
+@pytest.fixture(scope="module")
+def index(dataset):
+    return InvestorIndex(dataset)
+
+
+def _naive(dataset, stage, industry, geography, ticket):
+    out = set()
+    for inv in dataset:
+        if stage not in _split_list(inv["stage"]):
+            continue
+        if _fold(industry) not in _split_list(inv["sectors"]):
+            continue
+        inv_geos = _split_list(inv["geography"]) + _split_list(inv["country"])
+        if _fold(geography) not in inv_geos and "global" not in inv_geos:
+            continue
+        if inv["min_ticket_usd"] > ticket:
+            continue
+        if inv["max_ticket_usd"] and inv["max_ticket_usd"] < ticket:
+            continue
+        out.add(inv["id"])
+    return out
+
+
+def test_filters_match_naive_scan(dataset, index):
+    rng = random.Random(11)
+    for _ in range(200):
+        args = (rng.choice(STAGES), rng.choice(SECTORS), rng.choice(GEOS), rng.choice([50000, 300000, 2000000]))
+        results = index.search("b2b saas retention europe", *args, top_k=len(dataset))
+        assert {r["id"] for r in results} == _naive(dataset, *args), args
+
+
+def test_ticket_filter():
+    index = InvestorIndex([
+        {"id": 1, "name": "Small", "stage": "seed", "min_ticket_usd": 25000, "max_ticket_usd": 100000},
+        {"id": 2, "name": "Large", "stage": "seed", "min_ticket_usd": 1000000, "max_ticket_usd": 5000000},
+        # Sin máximo conocido: no se excluye por arriba
+        {"id": 3, "name": "Open", "stage": "seed", "min_ticket_usd": 50000, "max_ticket_usd": 0},
+    ])
+    assert {r["id"] for r in index.search(stage="seed", ticket_usd=80000)} == {1, 3}
+    assert {r["id"] for r in index.search(stage="seed", ticket_usd=2000000)} == {2, 3}
+    assert {r["id"] for r in index.search(stage="seed")} == {1, 2, 3}
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("500k", 500000),
+    ("$1.5M", 1500000),
+    ("1,5M", 1500000),
+    ("2 millones", 2000000),
+    ("levantar 300 mil euros", 300000),
+    ("1.000.000 usd", 1000000),
+    (250000, 250000),
+    ("250000", 250000),
+    (None, None),
+    ("", None),
+    (0, None),
+])
+def test_parse_ticket(value, expected):
+    assert parse_ticket(value) == expected
+
+
+def test_parse_ticket_requires_unit_in_free_text():
+    assert parse_ticket("busco 2 socios para una seed de 500k", require_unit=True) == 500000
+    assert parse_ticket("busco 2 socios", require_unit=True) is None
+
+
+class _StubApify:
+    """Cliente de Apify que devuelve siempre los mismos perfiles"""
+
+    def __init__(self, items):
+        self.items = items
+
+    def actor(self, _):
+        return self
+
+    def call(self, run_input):
+        return {"defaultDatasetId": "stub"}
+
+    def dataset(self, _):
+        return self
+
+    def iterate_items(self):
+        return iter(self.items)
+
+
+def test_enrich_matches_whole_name_tokens():
+    investors = [{"id": 1, "name": "Fund 1"}, {"id": 2, "name": "Fund 10"}]
+    items = [{"fullName": "Fund 10 Partner", "headline": "GP", "url": "https://linkedin.com/in/ten"}]
+    enriched = enrich_with_apify(_StubApify(items), investors)
+    assert "linkedin_profile" not in enriched[0]
+    assert enriched[1]["linkedin_profile"]["profile_url"] == "https://linkedin.com/in/ten"
+
+
+def test_enrich_matches_by_profile_url():
+    investors = [
+        {"id": 1, "name": "Acme Ventures", "linkedin": "https://www.linkedin.com/in/acme-gp/"},
+        {"id": 2, "name": "Acme", "linkedin": "https://linkedin.com/in/other"},
+    ]
+    items = [
+        {"fullName": "Jane Doe", "headline": "Partner at Acme", "url": "https://es.linkedin.com/in/acme-gp?trk=x"},
+    ]
+    enriched = enrich_with_apify(_StubApify(items), investors)
+    assert enriched[0]["linkedin_profile"]["name"] == "Jane Doe"
+    # El nombre coincide, pero su URL no: no se le asigna
+    assert "linkedin_profile" not in enriched[1]
+
+
+def test_search_and_enrich_latency_budget():
+    rng = random.Random(7)
+    investors = []
+    for i in range(5000):
+        lo = rng.choice([0, 25000, 100000, 500000, 1000000])
+        investors.append({
+            "id": i + 1,
+            "name": f"Fund {i}",
+            "country": rng.choice(GEOS),
+            "geography": ",".join(rng.sample(GEOS, 2)),
+            "stage": ",".join(rng.sample(STAGES, 2)),
+            "sectors": ",".join(rng.sample(SECTORS, 3)),
+            "min_ticket_usd": lo,
+            "max_ticket_usd": lo * rng.choice([0, 2, 5, 10]),
+            "description": " ".join(rng.choices(WORDS, k=12)),
+        })
+    index = InvestorIndex(investors)
+    apify = _StubApify([
+        {"fullName": f"Fund {i} Partner", "headline": "GP", "url": f"https://linkedin.com/in/fund-{i}"}
+        for i in range(0, 5000, 50)
+    ])
+
+    timings = []
+    for _ in range(200):
+        args = (rng.choice(STAGES), rng.choice(SECTORS), rng.choice(GEOS), rng.choice([50000, 300000, 2000000]))
+        t0 = time.perf_counter()
+        results = index.search("b2b saas retention europe", *args, top_k=20)
+        enrich_with_apify(apify, results[:5])
+        timings.append((time.perf_counter() - t0) * 1000)
+
+    timings.sort()
+    p50, p99 = timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+    assert p99 < 50, f"p50 {p50:.2f} ms | p99 {p99:.2f} ms"
@@ -0,0 +1,89 @@
+"""
+Llamadas a Groq bajo carga, con un AsyncGroq falso y lento: las de varios
+usuarios se solapan (no se serializan), nunca hay más de GROQ_MAX_CONCURRENCY
+a la vez y si tardan más de GROQ_TIMEOUT se responde con el mensaje de espera
+"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import agents as agents_module
+from config import config
+
+
+class _SlowAsyncGroq:
+    """chat.completions.create que tarda `delay` segundos y cuenta las llamadas simultáneas"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.inflight -= 1
+        content = json.dumps({"action": "LIST_GOALS", "params": {}})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def _agent(monkeypatch, client, concurrency, timeout):
+    monkeypatch.setattr(agents_module, "async_groq_client", client)
+    monkeypatch.setattr(config, "GROQ_MAX_CONCURRENCY", concurrency)
+    monkeypatch.setattr(config, "GROQ_TIMEOUT", timeout)
+    return agents_module.ConversationalAgent()
+
+
+def _parse_many(agent, count):
+    async def scenario():
+        start = time.perf_counter()
+        intents = await asyncio.gather(*[agent.parse_intent(f"mis goals {i}") for i in range(count)])
+        return intents, time.perf_counter() - start
+
+    return asyncio.run(scenario())
+
+
+def test_concurrent_calls_overlap_up_to_the_cap(monkeypatch):
+    client = _SlowAsyncGroq(delay=0.2)
+    agent = _agent(monkeypatch, client, concurrency=4, timeout=5)
+
+    intents, elapsed = _parse_many(agent, 16)
+
+    assert all(intent["action"] == "LIST_GOALS" for intent in intents)
+    assert client.calls == 16
+    assert client.max_inflight == 4
+    # 16 llamadas de 0,2 s en tandas de 4: ~0,8 s (en serie serían 3,2 s)
+    assert 0.75 <= elapsed < 1.6
+
+
+def test_timeout_falls_back_to_chat(monkeypatch):
+    client = _SlowAsyncGroq(delay=2.0)
+    agent = _agent(monkeypatch, client, concurrency=8, timeout=0.2)
+
+    intents, elapsed = _parse_many(agent, 8)
+
+    assert elapsed < 1.0
+    for intent in intents:
+        assert intent["action"] == "CHAT"
+        assert "tardando" in intent["response"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_cap_holds_under_timeouts(monkeypatch, concurrency):
+    # Las llamadas que agotan el timeout liberan su hueco para las siguientes
+    client = _SlowAsyncGroq(delay=0.5)
+    agent = _agent(monkeypatch, client, concurrency=concurrency, timeout=0.1)
+
+    _parse_many(agent, 6)
+
+    assert client.calls == 6
+    assert client.max_inflight == concurrency
@@ -0,0 +1,110 @@
+"""
+Orquestador: un mensaje que ya registró la cola de entrada no se vuelve a
+registrar (ni entra en su propio contexto) aunque llegue sin MessageSid, y un
+número de goal fuera de la lista se pregunta en lugar de resolverse después
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import agents as agents_module
+from agents import ChatOrchestrator
+from context_cache import ConversationContextCache
+
+PHONE = "whatsapp:+34600000003"
+
+
+class _FakeLog:
+    def __init__(self):
+        self.logged = []
+        self.tagged = []
+
+    def log(self, phone_number, message, direction, message_sid=None, intent=None):
+        self.logged.append((message, direction, intent))
+
+    def tag_intent(self, phone_number, message_sids, intent):
+        self.tagged.append((list(message_sids), intent))
+
+
+@pytest.fixture
+def orchestrator(monkeypatch):
+    user = SimpleNamespace(is_verified=True, auth_token="token", user_id=1)
+
+    async def get(phone_number):
+        return user, None
+
+    cache = ConversationContextCache()
+    log = _FakeLog()
+    monkeypatch.setattr(agents_module.user_state, "get", get)
+    monkeypatch.setattr(agents_module, "context_cache", cache)
+    monkeypatch.setattr(agents_module, "conversation_log", log)
+    monkeypatch.setattr(agents_module, "command_router", SimpleNamespace(match=lambda m: None, record_llm=lambda ms: None))
+    monkeypatch.setattr(agents_module, "prefetcher", SimpleNamespace(start=lambda *a: None, finish=lambda p: None))
+
+    orchestrator = ChatOrchestrator()
+    orchestrator.contexts = []
+
+    async def parse_intent(message, context=""):
+        orchestrator.contexts.append(context)
+        return {"action": "CHAT", "params": {}}
+
+    async def execute_action(action, params, *args):
+        return "ok"
+
+    monkeypatch.setattr(orchestrator.agent, "parse_intent", parse_intent)
+    monkeypatch.setattr(orchestrator, "_execute_action", execute_action)
+    return orchestrator, cache, log
+
+
+@pytest.mark.parametrize("sid", ["", "SM1"])
+def test_logged_message_is_only_tagged(orchestrator, sid):
+    orchestrator, cache, log = orchestrator
+    cache.record(PHONE, "¿Cuántos usuarios tienes?", "outbound")
+    # Lo registró la recepción, como hace la cola de entrada
+    cache.record(PHONE, "tengo 120", "inbound", sid or None)
+    cache._entries[PHONE].loaded = True
+
+    assert asyncio.run(orchestrator.process_burst(PHONE, ["tengo 120"], [sid], logged=True)) == "ok"
+    assert log.logged == []
+    assert log.tagged == [([sid], "CHAT")]
+    assert orchestrator.contexts == ["Asistente: ¿Cuántos usuarios tienes?"]
+
+
+def test_unlogged_message_is_logged(orchestrator):
+    orchestrator, cache, log = orchestrator
+    cache._entries.clear()
+    cache._touch(PHONE).loaded = True
+
+    asyncio.run(orchestrator.process_message(PHONE, "hola"))
+    assert log.logged == [("hola", "inbound", "CHAT")]
+    assert log.tagged == []
+
+
+def test_out_of_range_goal_index_asks_which_goal(monkeypatch):
+    goals = [
+        {"id": 10, "description": "Lanzar la beta", "status": "active"},
+        {"id": 11, "description": "Cerrar ronda", "status": "active"},
+    ]
+    completed = []
+
+    async def fetch(prefetch, key, loader, auth_token):
+        return {"goals": [g for g in goals if g["id"] not in completed]}
+
+    async def write(phone_number, auth_token, operation, payload):
+        completed.append(payload["goal_id"])
+        return ""
+
+    monkeypatch.setattr(agents_module, "prefetcher", SimpleNamespace(fetch=fetch))
+    orchestrator = ChatOrchestrator()
+    monkeypatch.setattr(orchestrator, "_write", write)
+
+    actions = [
+        {"action": "COMPLETE_GOAL", "params": {"goal_index": 1}},
+        {"action": "COMPLETE_GOAL", "params": {"goal_index": 3}},
+    ]
+    reply = asyncio.run(orchestrator._execute_actions(actions, "token", {}, 1, None, PHONE))
+    # El 3 no existía en la lista que vio el usuario: no se completa otro goal
+    assert completed == [10]
+    assert "¿Cuál goal completaste?" in reply
+    assert "1. Lanzar la beta\n2. Cerrar ronda" in reply
@@ -0,0 +1,78 @@
+"""
+Cola saliente: si algo falla después de que Twilio acepte un mensaje, el
+reintento llega tras la espera y no lo reenvía
+"""
+import asyncio
+import time
+
+import pytest
+
+import outbound_queue as outbound_module
+from config import config
+from database import init_db, close_async_db, AsyncSessionLocal
+from outbound_queue import OutboundQueue
+from twilio_service import SendResult
+
+
+class _FakeTwilio:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, to_number, message, max_retries=None):
+        self.sent.append((to_number, message, time.monotonic()))
+        return SendResult(sid=f"SM{len(self.sent)}")
+
+
+class _FakeLog:
+    def __init__(self):
+        self.logged = []
+
+    def log(self, phone_number, message, direction, message_sid=None, intent=None):
+        self.logged.append((phone_number, message_sid))
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    init_db()
+    twilio = _FakeTwilio()
+    log = _FakeLog()
+    failures = []
+
+    def session():
+        # La primera sesión después de un envío aceptado falla (BD bloqueada)
+        if twilio.sent and not failures:
+            failures.append(time.monotonic())
+            raise RuntimeError("database is locked")
+        return AsyncSessionLocal()
+
+    monkeypatch.setattr(outbound_module, "twilio_service", twilio)
+    monkeypatch.setattr(outbound_module, "conversation_log", log)
+    monkeypatch.setattr(outbound_module.delivery_tracker, "record_accepted", lambda *a, **k: None)
+    monkeypatch.setattr(outbound_module, "AsyncSessionLocal", session)
+    monkeypatch.setattr(config, "OUTBOUND_RETRY_BASE", 0.5)
+    return OutboundQueue(workers=2, rate=1000), twilio, log, failures
+
+
+def test_accepted_message_is_not_resent_after_unexpected_error(queue):
+    queue, twilio, log, failures = queue
+    phone = "whatsapp:+34600000006"
+
+    async def scenario():
+        await queue.start()
+        try:
+            await queue.enqueue(phone, "hola")
+            deadline = time.monotonic() + 5
+            while not log.logged:
+                assert time.monotonic() < deadline, "timeout"
+                await asyncio.sleep(0.02)
+            return time.monotonic(), await queue._count()
+        finally:
+            await queue.stop()
+            await close_async_db()
+
+    done_at, remaining = asyncio.run(scenario())
+    assert [message for _, message, _ in twilio.sent] == ["hola"]
+    assert log.logged == [(phone, "SM1")]
+    assert remaining == 0
+    # Con la espera de un fallo temporal (0.25-0.5 s), no al instante
+    assert done_at - failures[0] >= 0.2
@@ -0,0 +1,30 @@
+"""
+Cursores de paginación: ida y vuelta, y un cursor manipulado da ValueError
+(la API responde 400) en lugar de llegar a la consulta
+"""
+from datetime import datetime
+
+import pytest
+
+from pagination import encode_cursor, decode_cursor
+
+
+def test_round_trip():
+    at = datetime(2026, 1, 2, 3, 4, 5, 678)
+    assert decode_cursor(encode_cursor(at, 42), datetime, int) == [at, 42]
+    assert decode_cursor(encode_cursor(7), int) == [7]
+
+
+@pytest.mark.parametrize("cursor, types", [
+    ("no-es-base64!", (int,)),
+    (encode_cursor(1, 2), (int,)),
+    (encode_cursor("7"), (int,)),
+    (encode_cursor(True), (int,)),
+    (encode_cursor(1.5), (int,)),
+    (encode_cursor("ayer", 1), (datetime, int)),
+    (encode_cursor(None, 1), (datetime, int)),
+    (encode_cursor(datetime(2026, 1, 1), "1"), (datetime, int)),
+])
+def test_tampered_cursor(cursor, types):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, *types)
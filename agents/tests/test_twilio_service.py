@@ -0,0 +1,119 @@
+"""
+Envíos a Twilio contra un servidor HTTP falso local: reintentos con 429/5xx
+(respetando Retry-After), sin reintento en 400, timeout de lectura como fallo
+ambiguo que no se reenvía y límite de envíos simultáneos
+"""
+import asyncio
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from config import config
+from twilio_service import TwilioWhatsAppService
+
+
+class _FakeTwilio(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.requests.append(time.monotonic())
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            status, headers, delay = server.script.pop(0) if server.script else (201, {}, server.delay)
+        time.sleep(delay)
+        with server.lock:
+            server.inflight -= 1
+        body = json.dumps({"sid": f"SM{len(server.requests)}"} if status < 400 else {"message": "error"}).encode()
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente ya abandonó la petición (timeout)
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_twilio():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeTwilio)
+    server.lock = threading.Lock()
+    # (status, cabeceras, segundos de espera) de cada petición; después, 201
+    server.script = []
+    server.requests = []
+    server.inflight = 0
+    server.max_inflight = 0
+    server.delay = 0.0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _send(server, messages=1, **kwargs):
+    service = TwilioWhatsAppService(account_sid="AC123", auth_token="token", base_url=server.url, **kwargs)
+
+    async def scenario():
+        try:
+            return await asyncio.gather(*[service.send("+34600000000", f"hola {i}") for i in range(messages)])
+        finally:
+            await service.aclose()
+
+    return asyncio.run(scenario()), service
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_retries_honoring_retry_after(fake_twilio, status):
+    fake_twilio.script = [(status, {"Retry-After": "1"}, 0.0)]
+    (result,), service = _send(fake_twilio, max_retries=3)
+    assert result.sid == "SM2"
+    assert len(fake_twilio.requests) == 2
+    assert fake_twilio.requests[1] - fake_twilio.requests[0] >= 0.95
+    assert service.stats()["retries"] == 1
+
+
+def test_gives_up_after_max_retries(fake_twilio):
+    fake_twilio.script = [(503, {}, 0.0)] * 3
+    (result,), _ = _send(fake_twilio, max_retries=2)
+    assert result.sid is None
+    assert result.retryable and not result.permanent
+    assert len(fake_twilio.requests) == 3
+
+
+def test_no_retry_on_bad_request(fake_twilio):
+    fake_twilio.script = [(400, {}, 0.0)]
+    (result,), _ = _send(fake_twilio, max_retries=3)
+    assert result.sid is None
+    assert result.permanent and not result.retryable
+    assert len(fake_twilio.requests) == 1
+
+
+def test_read_timeout_is_ambiguous_and_not_resent(fake_twilio, monkeypatch):
+    monkeypatch.setattr(config, "TWILIO_TIMEOUT", 0.3)
+    fake_twilio.script = [(201, {}, 1.0)]
+    (result,), _ = _send(fake_twilio, max_retries=3)
+    assert result.sid is None
+    assert not result.retryable and not result.permanent
+    time.sleep(0.8)
+    assert len(fake_twilio.requests) == 1
+
+
+def test_concurrency_cap(fake_twilio):
+    fake_twilio.delay = 0.1
+    results, _ = _send(fake_twilio, messages=12, max_concurrency=3)
+    assert all(r.sid for r in results)
+    assert len(fake_twilio.requests) == 12
+    assert fake_twilio.max_inflight == 3
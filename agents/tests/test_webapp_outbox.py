@@ -0,0 +1,131 @@
+"""
+Outbox de la webapp: las escrituras de un número se aplican en el orden en
+que se pidieron, también cuando una espera su reintento o se reintenta a mano
+"""
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import webapp_outbox as outbox_module
+from config import config
+from database import init_db, close_async_db
+from webapp_outbox import WebappOutbox
+
+
+class _FakeWebapp:
+    """API de la webapp que anota cada llamada y falla según el guion"""
+
+    def __init__(self, failures):
+        # descripción o nombre de métrica -> excepciones a lanzar, en orden
+        self.failures = failures
+        self.calls = []
+        self.applied = []
+
+    async def _call(self, operation, label):
+        self.calls.append((operation, label))
+        if self.failures.get(label):
+            raise self.failures[label].pop(0)
+        self.applied.append((operation, label))
+        return {"ok": True}
+
+    async def create_goal(self, auth_token, description, idempotency_key=None):
+        return await self._call("create_goal", description)
+
+    async def add_metric(self, auth_token, metric_name, metric_value, idempotency_key=None, **_):
+        return await self._call("add_metric", metric_name)
+
+
+class _FakeOutbound:
+    def __init__(self):
+        self.sent = []
+
+    async def enqueue(self, phone_number, message, **_):
+        self.sent.append((phone_number, message))
+
+
+def _http_error(status):
+    request = httpx.Request("POST", "http://webapp.test/api")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+async def _until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        assert time.monotonic() < deadline, "timeout"
+        await asyncio.sleep(0.02)
+
+
+@pytest.fixture
+def fake_webapp(monkeypatch):
+    init_db()
+    webapp = _FakeWebapp({})
+    monkeypatch.setattr(outbox_module, "api_client", webapp)
+    monkeypatch.setattr(outbox_module, "outbound_queue", _FakeOutbound())
+    monkeypatch.setattr(config, "WEBAPP_OUTBOX_RETRY_BASE", 0.2)
+    return webapp
+
+
+def test_head_waiting_for_retry_blocks_later_writes(fake_webapp):
+    fake_webapp.failures["m1"] = [_http_error(503)]
+    phone = "whatsapp:+34600000001"
+
+    async def scenario():
+        outbox = WebappOutbox(workers=4, confirm_wait=0)
+        await outbox.start()
+        try:
+            for name in ("m1", "m2", "m3"):
+                await outbox.submit(phone, "token", "add_metric", {"metric_name": name, "metric_value": 1})
+
+            async def drained():
+                return len(fake_webapp.applied) == 3
+            await _until(drained)
+        finally:
+            await outbox.stop()
+            await close_async_db()
+
+    asyncio.run(scenario())
+    assert fake_webapp.calls[0] == ("add_metric", "m1")
+    assert [label for _, label in fake_webapp.applied] == ["m1", "m2", "m3"]
+
+
+def test_retry_requeues_at_the_tail(fake_webapp):
+    fake_webapp.failures["goal A"] = [httpx.ReadTimeout("timeout")]
+    fake_webapp.failures["mrr"] = [_http_error(503)]
+    phone = "whatsapp:+34600000002"
+
+    async def scenario():
+        outbox = WebappOutbox(workers=4, confirm_wait=0)
+        await outbox.start()
+        try:
+            await outbox.submit(phone, "token", "create_goal", {"description": "goal A"})
+
+            async def parked():
+                return bool(await outbox.entries("unknown", phone))
+            await _until(parked)
+            (unknown,) = await outbox.entries("unknown", phone)
+
+            # Las escrituras posteriores no esperan a la que quedó sin confirmar
+            await outbox.submit(phone, "token", "add_metric", {"metric_name": "mrr", "metric_value": 10})
+            await outbox.submit(phone, "token", "add_metric", {"metric_name": "arr", "metric_value": 120})
+
+            async def metric_failed():
+                return ("add_metric", "mrr") in fake_webapp.calls
+            await _until(metric_failed)
+
+            # "mrr" espera su reintento: el reintento manual no se le adelanta
+            retried = await outbox.retry(unknown["id"])
+
+            async def drained():
+                return len(fake_webapp.applied) == 3 and not await outbox.entries(phone_number=phone)
+            await _until(drained)
+            return unknown, retried
+        finally:
+            await outbox.stop()
+            await close_async_db()
+
+    unknown, retried = asyncio.run(scenario())
+    assert retried["status"] == "pending"
+    assert retried["idempotency_key"] == unknown["idempotency_key"]
+    assert fake_webapp.applied == [("add_metric", "mrr"), ("add_metric", "arr"), ("create_goal", "goal A")]
@@ -1,21 +1,183 @@
 """
 Servicio de Twilio WhatsApp para enviar y recibir mensajes
 """
-from twilio.rest import Client
 from twilio.request_validator import RequestValidator
 from config import config
-from typing import Optional
+from typing import Optional, Dict, Any
+from dataclasses import dataclass
+import asyncio
 import logging
+import random
+import time
+import httpx
 
 logger = logging.getLogger(__name__)
 
+# 429 (límite de ritmo) y 5xx se reintentan
+RETRYABLE_STATUS = {429}
+
+
+@dataclass
+class SendResult:
+    """
+    Resultado de un envío: SID si salió bien; si no, el error y si es
+    definitivo. Un fallo ni reintentable ni definitivo es ambiguo: puede que
+    Twilio lo recibiera y reenviarlo lo duplique.
+    """
+    sid: Optional[str] = None
+    error: Optional[str] = None
+    permanent: bool = False
+    retryable: bool = False
+    # Segundos del Retry-After de Twilio, si lo mandó
+    retry_after: Optional[float] = None
+
+# Plantillas de mensajes predefinidos
+TEMPLATES = {
+    "welcome": "🎯 ¡Bienvenido a LovableGrowth!\n\nSoy tu asistente de goals. Puedo ayudarte a:\n\n📋 Ver tus goals: 'mis goals'\n✅ Completar goal: 'completar [número]'\n➕ Añadir goal: 'nuevo goal [descripción]'\n📊 Ver métricas: 'mis métricas'\n🏆 Ver leaderboard: 'leaderboard'\n\n¿En qué te puedo ayudar?",
+    
+    "auth_required": "🔐 Para continuar, necesito verificar tu cuenta.\n\nPor favor, envía tu email registrado en LovableGrowth:",
+    
+    "auth_password": "📧 Email recibido: {email}\n\nAhora envía tu contraseña:",
+    
+    "auth_success": "✅ ¡Autenticación exitosa!\n\nHola {name}, ahora puedes gestionar tus goals desde WhatsApp.\n\n¿Qué te gustaría hacer?",
+    
+    "auth_failed": "❌ No se pudo verificar tu cuenta. Por favor verifica tus credenciales e intenta de nuevo.\n\nEnvía 'login' para reintentar.",
+    
+    "goals_list": "📋 *Tus Goals Actuales:*\n\n{goals_text}\n\n✅ Para completar: 'completar [número]'\n➕ Para añadir: 'nuevo goal [descripción]'",
+    
+    "goal_added": "✅ Goal añadido correctamente:\n\n📌 \"{description}\"\n\n¡Sigue así! 💪",
+    
+    "goal_completed": "🎉 ¡Felicitaciones!\n\nHas completado el goal:\n📌 \"{description}\"\n\n¡Tu posición en el leaderboard puede haber cambiado! Envía 'leaderboard' para ver.",
+    
+    "metrics_added": "📊 Métrica registrada:\n\n{metric_name}: {metric_value}\nFecha: {date}\n\n¡Sigue creciendo! 📈",
+    
+    "leaderboard": "🏆 *LEADERBOARD*\n\n{leaderboard_text}\n\n¡Sigue completando goals para subir! 💪",
+    
+    "error": "❌ Hubo un error procesando tu solicitud. Por favor intenta de nuevo.\n\nSi el problema persiste, contacta soporte.",
+    
+    "unknown_command": "🤔 No entendí tu mensaje.\n\nPuedes usar:\n• 'mis goals' - ver goals\n• 'completar [#]' - completar goal\n• 'nuevo goal [desc]' - crear goal\n• 'mis métricas' - ver métricas\n• 'leaderboard' - ver ranking\n• 'ayuda' - ver opciones",
+    
+    "help": "📚 *COMANDOS DISPONIBLES:*\n\n📋 *Goals:*\n• mis goals - ver tus goals\n• nuevo goal [descripción] - crear goal\n• completar [número] - marcar como completado\n\n📊 *Métricas:*\n• mis métricas - ver historial\n• usuarios [número] - registrar usuarios\n• revenue [número] - registrar ingresos\n\n🏆 *Ranking:*\n• leaderboard - ver posiciones\n\n⚙️ *Cuenta:*\n• login - iniciar sesión\n• estado - ver tu estado\n• ayuda - ver este mensaje"
+}
+
 class TwilioWhatsAppService:
-    """Servicio para manejar mensajes de WhatsApp vía Twilio"""
+    """
+    Servicio para manejar mensajes de WhatsApp vía Twilio
+
+    Envía con un httpx.AsyncClient persistente contra la API REST de Twilio
+    (sin bloquear el event loop), limita los envíos simultáneos y reintenta
+    con backoff ante 429/5xx y errores de conexión.
+    """
+    
+    def __init__(
+        self,
+        account_sid: str = None,
+        auth_token: str = None,
+        from_number: str = None,
+        base_url: str = None,
+        max_concurrency: int = None,
+        max_retries: int = None
+    ):
+        self.account_sid = account_sid or config.TWILIO_ACCOUNT_SID
+        self.auth_token = auth_token or config.TWILIO_AUTH_TOKEN
+        self.validator = RequestValidator(self.auth_token)
+        self.from_number = from_number or config.TWILIO_WHATSAPP_NUMBER
+        self.base_url = (base_url or config.TWILIO_API_BASE_URL).rstrip("/")
+        self.max_retries = config.TWILIO_MAX_RETRIES if max_retries is None else max_retries
+        self.limits = httpx.Limits(
+            max_connections=max_concurrency or config.TWILIO_MAX_CONCURRENCY,
+            max_keepalive_connections=max_concurrency or config.TWILIO_MAX_CONCURRENCY,
+            keepalive_expiry=60.0
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency or config.TWILIO_MAX_CONCURRENCY)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._stats = {
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "total_latency_ms": 0.0,
+        }
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Devuelve el cliente compartido, creándolo si hace falta"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=(self.account_sid or "", self.auth_token or ""),
+                limits=self.limits,
+                timeout=httpx.Timeout(config.TWILIO_TIMEOUT, connect=5.0)
+            )
+        return self._client
+    
+    async def start(self):
+        """Abre el pool (llamado desde el lifespan de la app)"""
+        self._get_client()
+    
+    async def aclose(self):
+        """Cierra el pool y sus conexiones keep-alive"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+    
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Retry-After si Twilio lo manda; si no, exponencial con full jitter"""
+        if retry_after is not None:
+            return min(retry_after, 30.0)
+        return random.uniform(0, min(8.0, 0.5 * (2 ** attempt)))
     
-    def __init__(self):
-        self.client = Client(config.TWILIO_ACCOUNT_SID, config.TWILIO_AUTH_TOKEN)
-        self.validator = RequestValidator(config.TWILIO_AUTH_TOKEN)
-        self.from_number = config.TWILIO_WHATSAPP_NUMBER
+    async def send(self, to_number: str, message: str, max_retries: int = None) -> SendResult:
+        """
+        Envía un mensaje y devuelve el resultado detallado (SID o error, y si
+        el error es definitivo). `max_retries=0` deja los reintentos al que llama.
+        """
+        # Asegurar formato correcto
+        if not to_number.startswith("whatsapp:"):
+            to_number = f"whatsapp:{to_number}"
+        max_retries = self.max_retries if max_retries is None else max_retries
+        
+        path = f"/2010-04-01/Accounts/{self.account_sid}/Messages.json"
+        data = {"From": self.from_number, "To": to_number, "Body": message}
+        if config.TWILIO_STATUS_CALLBACK_URL:
+            data["StatusCallback"] = config.TWILIO_STATUS_CALLBACK_URL
+        
+        async with self._semaphore:
+            client = self._get_client()
+            attempt = 0
+            while True:
+                start = time.perf_counter()
+                retry_after = None
+                try:
+                    response = await client.post(path, data=data)
+                    self._stats["total_latency_ms"] += (time.perf_counter() - start) * 1000
+                    if response.status_code < 400:
+                        sid = response.json().get("sid")
+                        self._stats["sent"] += 1
+                        logger.info(f"Mensaje enviado a {to_number}: {sid}")
+                        return SendResult(sid=sid)
+                    retryable = response.status_code in RETRYABLE_STATUS or response.status_code >= 500
+                    # Otros 4xx (número inválido, sin permiso...) no se arreglan reintentando
+                    permanent = not retryable
+                    error = f"HTTP {response.status_code}: {response.text[:200]}"
+                    header = response.headers.get("Retry-After")
+                    if header and header.isdigit():
+                        retry_after = float(header)
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    # La petición no llegó a Twilio: reintentar no duplica el mensaje
+                    retryable, permanent = True, False
+                    error = str(e) or e.__class__.__name__
+                except Exception as e:
+                    # Puede que Twilio sí lo recibiera: no se reintenta aquí
+                    retryable, permanent = False, False
+                    error = str(e) or e.__class__.__name__
+                
+                if not retryable or attempt >= max_retries:
+                    self._stats["failed"] += 1
+                    logger.error(f"Error enviando mensaje a {to_number}: {error}")
+                    return SendResult(error=error, permanent=permanent, retryable=retryable, retry_after=retry_after)
+                
+                self._stats["retries"] += 1
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+                attempt += 1
     
     async def send_message(self, to_number: str, message: str) -> Optional[str]:
         """
@@ -28,23 +190,19 @@ class TwilioWhatsAppService:
         Returns:
             Message SID si fue exitoso, None si hubo error
         """
-        try:
-            # Asegurar formato correcto
-            if not to_number.startswith("whatsapp:"):
-                to_number = f"whatsapp:{to_number}"
-            
-            response = self.client.messages.create(
-                body=message,
-                from_=self.from_number,
-                to=to_number
-            )
-            
-            logger.info(f"Mensaje enviado a {to_number}: {response.sid}")
-            return response.sid
-            
-        except Exception as e:
-            logger.error(f"Error enviando mensaje a {to_number}: {str(e)}")
-            return None
+        result = await self.send(to_number, message)
+        return result.sid
+    
+    def stats(self) -> Dict[str, Any]:
+        """Envíos, reintentos y latencia media de la API de Twilio"""
+        attempts = self._stats["sent"] + self._stats["failed"] + self._stats["retries"]
+        return {
+            "sent": self._stats["sent"],
+            "failed": self._stats["failed"],
+            "retries": self._stats["retries"],
+            "max_concurrency": self.limits.max_connections,
+            "avg_latency_ms": round(self._stats["total_latency_ms"] / attempts, 2) if attempts else 0.0,
+        }
     
     def validate_request(self, url: str, params: dict, signature: str) -> bool:
         """
@@ -64,35 +222,7 @@ class TwilioWhatsAppService:
         """
         Envía un mensaje usando una plantilla predefinida
         """
-        templates = {
-            "welcome": "🎯 ¡Bienvenido a LovableGrowth!\n\nSoy tu asistente de goals. Puedo ayudarte a:\n\n📋 Ver tus goals: 'mis goals'\n✅ Completar goal: 'completar [número]'\n➕ Añadir goal: 'nuevo goal [descripción]'\n📊 Ver métricas: 'mis métricas'\n🏆 Ver leaderboard: 'leaderboard'\n\n¿En qué te puedo ayudar?",
-            
-            "auth_required": "🔐 Para continuar, necesito verificar tu cuenta.\n\nPor favor, envía tu email registrado en LovableGrowth:",
-            
-            "auth_password": "📧 Email recibido: {email}\n\nAhora envía tu contraseña:",
-            
-            "auth_success": "✅ ¡Autenticación exitosa!\n\nHola {name}, ahora puedes gestionar tus goals desde WhatsApp.\n\n¿Qué te gustaría hacer?",
-            
-            "auth_failed": "❌ No se pudo verificar tu cuenta. Por favor verifica tus credenciales e intenta de nuevo.\n\nEnvía 'login' para reintentar.",
-            
-            "goals_list": "📋 *Tus Goals Actuales:*\n\n{goals_text}\n\n✅ Para completar: 'completar [número]'\n➕ Para añadir: 'nuevo goal [descripción]'",
-            
-            "goal_added": "✅ Goal añadido correctamente:\n\n📌 \"{description}\"\n\n¡Sigue así! 💪",
-            
-            "goal_completed": "🎉 ¡Felicitaciones!\n\nHas completado el goal:\n📌 \"{description}\"\n\n¡Tu posición en el leaderboard puede haber cambiado! Envía 'leaderboard' para ver.",
-            
-            "metrics_added": "📊 Métrica registrada:\n\n{metric_name}: {metric_value}\nFecha: {date}\n\n¡Sigue creciendo! 📈",
-            
-            "leaderboard": "🏆 *LEADERBOARD*\n\n{leaderboard_text}\n\n¡Sigue completando goals para subir! 💪",
-            
-            "error": "❌ Hubo un error procesando tu solicitud. Por favor intenta de nuevo.\n\nSi el problema persiste, contacta soporte.",
-            
-            "unknown_command": "🤔 No entendí tu mensaje.\n\nPuedes usar:\n• 'mis goals' - ver goals\n• 'completar [#]' - completar goal\n• 'nuevo goal [desc]' - crear goal\n• 'mis métricas' - ver métricas\n• 'leaderboard' - ver ranking\n• 'ayuda' - ver opciones",
-            
-            "help": "📚 *COMANDOS DISPONIBLES:*\n\n📋 *Goals:*\n• mis goals - ver tus goals\n• nuevo goal [descripción] - crear goal\n• completar [número] - marcar como completado\n\n📊 *Métricas:*\n• mis métricas - ver historial\n• usuarios [número] - registrar usuarios\n• revenue [número] - registrar ingresos\n\n🏆 *Ranking:*\n• leaderboard - ver posiciones\n\n⚙️ *Cuenta:*\n• login - iniciar sesión\n• estado - ver tu estado\n• ayuda - ver este mensaje"
-        }
-        
-        template = templates.get(template_name, templates["error"])
+        template = TEMPLATES.get(template_name, TEMPLATES["error"])
         message = template.format(**kwargs) if kwargs else template
         
         return await self.send_message(to_number, message)
@@ -0,0 +1,125 @@
+"""
+Caché write-through del estado de cada número (usuario + acción pendiente)
+
+Cada turno necesita saber si el número está vinculado y si hay un flujo de
+login en curso. La primera vez se obtiene con una sola consulta
+(`get_user_and_pending_async`); después se sirve de memoria. Todas las
+escrituras pasan por aquí, así que la caché se actualiza a la vez que la
+base de datos. El TTL solo cubre cambios hechos por fuera del servicio.
+
+Las acciones pendientes caducan con su `expires_at`, sin barridos.
+"""
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+
+from change_feed import change_feed
+from config import config
+from database import (
+    WhatsAppUserDB,
+    PendingActionDB,
+    get_user_and_pending_async,
+    create_or_update_whatsapp_user_async,
+    set_pending_action_async,
+    clear_pending_action_async,
+    is_pending_action_expired,
+)
+
+
+class UserStateCache:
+    """Usuario y acción pendiente por número, con TTL y expulsión LRU"""
+
+    def __init__(self, ttl: float = None, max_entries: int = None):
+        self.ttl = config.USER_STATE_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or config.USER_STATE_CACHE_MAX
+        # phone -> (cargado_en, usuario, acción pendiente)
+        self._entries: "OrderedDict[str, Tuple[float, Optional[WhatsAppUserDB], Optional[PendingActionDB]]]" = OrderedDict()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired_pending": 0,
+        }
+
+    async def get(self, phone_number: str) -> Tuple[Optional[WhatsAppUserDB], Optional[PendingActionDB]]:
+        """Devuelve (usuario, acción pendiente vigente)"""
+        entry = self._entries.get(phone_number)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(phone_number)
+            self._stats["hits"] += 1
+            _, user, pending = entry
+            if is_pending_action_expired(pending):
+                self._stats["expired_pending"] += 1
+                pending = None
+                self._store(phone_number, user, None)
+            return user, pending
+
+        self._stats["misses"] += 1
+        user, pending = await get_user_and_pending_async(phone_number)
+        self._store(phone_number, user, pending)
+        return user, pending
+
+    async def get_user(self, phone_number: str) -> Optional[WhatsAppUserDB]:
+        user, _ = await self.get(phone_number)
+        return user
+
+    async def save_user(self, phone_number: str, **fields) -> WhatsAppUserDB:
+        user = await create_or_update_whatsapp_user_async(phone_number, **fields)
+        self._update(phone_number, user=user)
+        change_feed.publish("auth", phone_number, {
+            "is_verified": user.is_verified,
+            "email": user.email,
+            "user_id": user.user_id,
+        })
+        return user
+
+    async def set_pending(self, phone_number: str, action_type: str, action_data: str = None) -> PendingActionDB:
+        pending = await set_pending_action_async(phone_number, action_type, action_data)
+        self._update(phone_number, pending=pending)
+        change_feed.publish("auth", phone_number, {"pending_action": action_type})
+        return pending
+
+    async def clear_pending(self, phone_number: str):
+        await clear_pending_action_async(phone_number)
+        self._update(phone_number, pending=None)
+        change_feed.publish("auth", phone_number, {"pending_action": None})
+
+    def invalidate(self, phone_number: str = None):
+        """Olvida un número (o todos) tras un cambio hecho por fuera de esta caché"""
+        if phone_number is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(phone_number, None)
+
+    _KEEP = object()
+
+    def _update(self, phone_number: str, user=_KEEP, pending=_KEEP):
+        entry = self._entries.get(phone_number)
+        if entry is None:
+            # Sin el resto del estado no se puede cachear: la próxima lectura irá a la BD
+            return
+        _, cached_user, cached_pending = entry
+        self._store(
+            phone_number,
+            cached_user if user is self._KEEP else user,
+            cached_pending if pending is self._KEEP else pending
+        )
+
+    def _store(self, phone_number: str, user, pending):
+        self._entries[phone_number] = (time.monotonic(), user, pending)
+        self._entries.move_to_end(phone_number)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl,
+        }
+
+
+# Instancia global
+user_state = UserStateCache()
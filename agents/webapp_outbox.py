@@ -0,0 +1,434 @@
+"""
+Outbox de escrituras en la API de la webapp
+
+Las acciones que escriben (crear/completar goal, métricas, logros) se guardan
+primero en `webapp_outbox` y después se aplican en segundo plano. El que las
+pide espera como mucho WEBAPP_OUTBOX_CONFIRM_WAIT segundos: si la webapp
+responde a tiempo, el usuario recibe la confirmación normal; si está lenta o
+caída, se le confirma igual y la escritura se reintenta con espera
+exponencial.
+
+Las escrituras de un mismo número se aplican de una en una y en el orden en
+que se pidieron (solo la más antigua de cada número está en vuelo). La webapp
+no deduplica (la cabecera Idempotency-Key se envía pero no la lee), así que
+solo se reintenta lo que no puede duplicarse: errores antes de enviar la
+petición (conexión), respuestas 5xx/429 y las operaciones idempotentes
+(completar un goal o cambiar su estado). Si una escritura que crea filas
+(goal, métrica, logro) falla sin saber si llegó (timeout de lectura, conexión
+cortada), no se repite: queda como "unknown" para revisarla a mano.
+
+Los errores definitivos (4xx) o los que agotan WEBAPP_OUTBOX_MAX_ATTEMPTS
+quedan como "failed". En los dos casos se avisa al usuario por WhatsApp y la
+escritura sale de la cola del número (las siguientes ya no la esperan); se
+puede reintentar, como una escritura nueva al final de la cola, o descartar
+desde la API de administración.
+
+En modo multiproceso cada proceso worker aplica solo las escrituras de los
+números de su partición (son los únicos que las crean).
+"""
+import asyncio
+import json
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+
+import httpx
+from sqlalchemy import select, update, delete, func
+
+from api_client import api_client
+from config import config
+from database import AsyncSessionLocal, WebappOutboxDB
+from outbound_queue import outbound_queue
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = {"create_goal", "complete_goal", "update_goal_status", "add_metric", "add_achievement"}
+
+# 4xx que sí tiene sentido reintentar
+RETRYABLE_CLIENT_STATUS = {408, 425, 429}
+
+# Operaciones que crean filas: repetirlas las duplica
+NON_IDEMPOTENT_OPERATIONS = {"create_goal", "add_metric", "add_achievement"}
+
+# Errores en los que la petición no llegó a enviarse
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class WebappWriteError(Exception):
+    """La webapp rechazó la escritura de forma definitiva"""
+
+
+def _describe(operation: str, payload: Dict[str, Any]) -> str:
+    if operation == "create_goal":
+        return f"el goal \"{payload.get('description')}\""
+    if operation in ("complete_goal", "update_goal_status"):
+        return "el cambio de tu goal"
+    if operation == "add_metric":
+        return f"la métrica {payload.get('metric_name')} ({payload.get('metric_value')})"
+    if operation == "add_achievement":
+        return f"el logro \"{payload.get('description')}\""
+    return operation
+
+
+def _to_dict(row: WebappOutboxDB) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "phone_number": row.phone_number,
+        "operation": row.operation,
+        "payload": json.loads(row.payload),
+        "idempotency_key": row.idempotency_key,
+        "status": row.status,
+        "attempts": row.attempts,
+        "last_error": row.last_error,
+        "next_attempt_at": str(row.next_attempt_at) if row.next_attempt_at else None,
+        "created_at": str(row.created_at) if row.created_at else None,
+    }
+
+
+class WebappOutbox:
+    """Aplica las escrituras guardadas en orden por número, con reintentos"""
+
+    def __init__(self, workers: int = None, confirm_wait: float = None, max_attempts: int = None):
+        self.num_workers = workers or config.WEBAPP_OUTBOX_WORKERS
+        self.confirm_wait = config.WEBAPP_OUTBOX_CONFIRM_WAIT if confirm_wait is None else confirm_wait
+        self.max_attempts = max_attempts or config.WEBAPP_OUTBOX_MAX_ATTEMPTS
+
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._inflight: set = set()
+        # phone -> escrituras pendientes
+        self._pending: Dict[str, int] = {}
+        # id -> future del que espera la confirmación
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._workers: List[asyncio.Task] = []
+        # (índice, total) en los procesos worker del modo multiproceso
+        self.partition: Optional[tuple] = None
+        self._stats = {
+            "submitted": 0,
+            "applied": 0,
+            "confirmed_pending": 0,
+            "retried": 0,
+            "failed": 0,
+            "unknown": 0,
+            "requeued": 0,
+            "discarded": 0,
+        }
+
+    def set_partition(self, index: int, total: int):
+        """Solo aplica las escrituras de los números de la partición `index` (antes de start)"""
+        self.partition = (index, total)
+
+    def _in_partition(self, query):
+        if self.partition is None:
+            return query
+        index, total = self.partition
+        return query.where(func.phone_partition(WebappOutboxDB.phone_number, total) == index)
+
+    async def start(self):
+        """Arranca el dispatcher y los workers; retoma lo que quedó pendiente"""
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(self._in_partition(
+                select(WebappOutboxDB.phone_number, func.count())
+                .where(WebappOutboxDB.status == "pending")
+                .group_by(WebappOutboxDB.phone_number)
+            ))).all()
+        self._pending = {phone: count for phone, count in rows}
+        if self._pending:
+            logger.info(f"📦 Retomando {sum(self._pending.values())} escrituras pendientes en la webapp")
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        for i in range(self.num_workers):
+            self._workers.append(asyncio.create_task(self._worker(i)))
+
+    async def stop(self, timeout: float = 10.0):
+        """Deja de repartir y espera a las escrituras en vuelo; el resto sigue en la BD"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        while not self._ready.empty():
+            self._ready.get_nowait()
+            self._ready.task_done()
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning("⚠️ Escrituras en la webapp sin terminar al apagar")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._inflight.clear()
+
+    def pending_count(self, phone_number: str) -> int:
+        return self._pending.get(phone_number, 0)
+
+    async def submit(self, phone_number: str, auth_token: str, operation: str, payload: Dict[str, Any]) -> bool:
+        """
+        Guarda la escritura y espera a que se aplique (como mucho `confirm_wait`).
+
+        Devuelve True si ya está aplicada y False si sigue pendiente. Lanza
+        WebappWriteError si la webapp la rechazó durante la espera.
+        """
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown webapp operation: {operation}")
+        async with AsyncSessionLocal() as db:
+            row = WebappOutboxDB(
+                phone_number=phone_number,
+                auth_token=auth_token,
+                operation=operation,
+                payload=json.dumps(payload, ensure_ascii=False),
+                idempotency_key=uuid.uuid4().hex
+            )
+            db.add(row)
+            await db.commit()
+        self._pending[phone_number] = self._pending.get(phone_number, 0) + 1
+        self._stats["submitted"] += 1
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[row.id] = waiter
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.confirm_wait)
+            return True
+        except asyncio.TimeoutError:
+            self._stats["confirmed_pending"] += 1
+            return False
+        finally:
+            self._waiters.pop(row.id, None)
+
+    async def entries(self, status: str = None, phone_number: str = None, limit: int = 100) -> List[Dict[str, Any]]:
+        query = select(WebappOutboxDB).order_by(WebappOutboxDB.id).limit(limit)
+        if status:
+            query = query.where(WebappOutboxDB.status == status)
+        if phone_number:
+            query = query.where(WebappOutboxDB.phone_number == phone_number)
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(query)).scalars().all()
+            return [_to_dict(row) for row in rows]
+
+    async def count(self, status: str = "pending") -> int:
+        """Escrituras con ese estado en la BD (de todos los procesos)"""
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(
+                select(func.count()).select_from(WebappOutboxDB).where(WebappOutboxDB.status == status)
+            )).scalar()
+
+    async def retry(self, outbox_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Vuelve a poner en cola una escritura fallida o sin confirmar.
+
+        Entra al final de la cola del número, con un id nuevo: las escrituras
+        posteriores que ya se aplicaron no quedan por detrás de ella.
+        """
+        async with AsyncSessionLocal() as db:
+            row = await db.get(WebappOutboxDB, outbox_id)
+            if row is None:
+                return None
+            if row.status not in ("failed", "unknown"):
+                return _to_dict(row)
+            requeued = WebappOutboxDB(
+                phone_number=row.phone_number,
+                auth_token=row.auth_token,
+                operation=row.operation,
+                payload=row.payload,
+                # La misma clave: es la misma escritura
+                idempotency_key=row.idempotency_key
+            )
+            await db.delete(row)
+            # Antes del INSERT: la clave de idempotencia es única
+            await db.flush()
+            db.add(requeued)
+            await db.commit()
+        self._pending[requeued.phone_number] = self._pending.get(requeued.phone_number, 0) + 1
+        self._stats["requeued"] += 1
+        self._wakeup.set()
+        return _to_dict(requeued)
+
+    async def discard(self, outbox_id: int) -> Optional[Dict[str, Any]]:
+        """Borra una escritura fallida o sin confirmar (p. ej. ya estaba en la webapp)"""
+        async with AsyncSessionLocal() as db:
+            row = await db.get(WebappOutboxDB, outbox_id)
+            if row is None:
+                return None
+            entry = _to_dict(row)
+            if row.status in ("failed", "unknown"):
+                await db.delete(row)
+                await db.commit()
+                self._stats["discarded"] += 1
+            return entry
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                rows = await self._next_batch()
+            except Exception as e:
+                logger.error(f"❌ Error leyendo el outbox de la webapp: {str(e)}")
+                rows = []
+            for row in rows:
+                self._inflight.add(row.phone_number)
+                self._ready.put_nowait(row)
+
+            if not rows or self._ready.qsize() >= self.num_workers:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _next_batch(self) -> List[WebappOutboxDB]:
+        """
+        Escritura más antigua pendiente de cada número, si ya toca: mientras
+        espera su reintento, las siguientes del número esperan detrás
+        """
+        heads = (
+            select(func.min(WebappOutboxDB.id))
+            .where(WebappOutboxDB.status == "pending")
+            .group_by(WebappOutboxDB.phone_number)
+        )
+        query = (
+            select(WebappOutboxDB)
+            .where(WebappOutboxDB.id.in_(heads))
+            .where(WebappOutboxDB.next_attempt_at <= datetime.utcnow())
+            .order_by(WebappOutboxDB.id)
+            .limit(self.num_workers * 2)
+        )
+        if self._inflight:
+            query = query.where(WebappOutboxDB.phone_number.notin_(self._inflight))
+        async with AsyncSessionLocal() as db:
+            return list((await db.execute(self._in_partition(query))).scalars().all())
+
+    async def _worker(self, worker_id: int):
+        while True:
+            row = await self._ready.get()
+            try:
+                await self._apply(row)
+            except Exception as e:
+                logger.error(f"❌ Worker del outbox {worker_id} error inesperado: {str(e)}")
+            finally:
+                self._inflight.discard(row.phone_number)
+                self._ready.task_done()
+                self._wakeup.set()
+
+    async def _apply(self, row: WebappOutboxDB):
+        payload = json.loads(row.payload)
+        method = getattr(api_client, row.operation)
+        error, permanent, ambiguous = None, False, False
+        try:
+            await method(row.auth_token, **payload, idempotency_key=row.idempotency_key)
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            error = f"HTTP {status}: {e.response.text[:200]}"
+            permanent = 400 <= status < 500 and status not in RETRYABLE_CLIENT_STATUS
+        except json.JSONDecodeError:
+            # Respuesta 2xx sin JSON: la escritura se hizo
+            pass
+        except NOT_SENT_ERRORS as e:
+            error = str(e) or e.__class__.__name__
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            # Puede que la webapp sí la recibiera
+            ambiguous = row.operation in NON_IDEMPOTENT_OPERATIONS
+
+        if error is None:
+            async with AsyncSessionLocal() as db:
+                await db.execute(delete(WebappOutboxDB).where(WebappOutboxDB.id == row.id))
+                await db.commit()
+            self._done(row.phone_number)
+            self._stats["applied"] += 1
+            self._resolve(row.id)
+            return
+
+        attempts = (row.attempts or 0) + 1
+        if ambiguous:
+            await self._park(row, payload, attempts, error)
+            return
+
+        if permanent or attempts >= self.max_attempts:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(WebappOutboxDB)
+                    .where(WebappOutboxDB.id == row.id)
+                    .values(status="failed", attempts=attempts, last_error=error)
+                )
+                await db.commit()
+            self._done(row.phone_number)
+            self._stats["failed"] += 1
+            logger.error(f"❌ Escritura {row.operation} de {row.phone_number} descartada tras {attempts} intentos: {error}")
+            if not self._resolve(row.id, WebappWriteError(error)):
+                # El usuario ya recibió la confirmación: avisarle
+                await outbound_queue.enqueue(
+                    row.phone_number,
+                    f"⚠️ No pude guardar {_describe(row.operation, payload)} en la webapp. ¿Puedes intentarlo de nuevo? 🙏",
+                    source="error"
+                )
+            return
+
+        delay = min(config.WEBAPP_OUTBOX_RETRY_MAX, config.WEBAPP_OUTBOX_RETRY_BASE * (2 ** (attempts - 1)))
+        delay *= random.uniform(0.5, 1.0)
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(WebappOutboxDB)
+                .where(WebappOutboxDB.id == row.id)
+                .values(
+                    attempts=attempts,
+                    last_error=error,
+                    next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+                )
+            )
+            await db.commit()
+        self._stats["retried"] += 1
+
+    async def _park(self, row: WebappOutboxDB, payload: Dict[str, Any], attempts: int, error: str):
+        """Deja la escritura como "unknown" para revisarla a mano en vez de repetirla"""
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(WebappOutboxDB)
+                .where(WebappOutboxDB.id == row.id)
+                .values(status="unknown", attempts=attempts, last_error=error)
+            )
+            await db.commit()
+        self._done(row.phone_number)
+        self._stats["unknown"] += 1
+        logger.warning(f"⚠️ Escritura {row.operation} de {row.phone_number} sin confirmar, queda para revisión: {error}")
+        # Si aún espera, recibe la nota de "pendiente"; el aviso llega después
+        await outbound_queue.enqueue(
+            row.phone_number,
+            f"⚠️ La webapp no respondió al guardar {_describe(row.operation, payload)}. "
+            f"Mira en el dashboard si aparece antes de repetirlo 🙏",
+            source="error"
+        )
+
+    def _done(self, phone_number: str):
+        remaining = self._pending.get(phone_number, 0) - 1
+        if remaining > 0:
+            self._pending[phone_number] = remaining
+        else:
+            self._pending.pop(phone_number, None)
+
+    def _resolve(self, outbox_id: int, error: Exception = None) -> bool:
+        """Despierta al que espera la confirmación. False si ya no espera nadie."""
+        waiter = self._waiters.get(outbox_id)
+        if waiter is None or waiter.done():
+            return False
+        if error is None:
+            waiter.set_result(True)
+        else:
+            waiter.set_exception(error)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "pending": sum(self._pending.values()),
+            "pending_phones": len(self._pending),
+            "inflight_phones": len(self._inflight),
+            "workers": len(self._workers),
+            "confirm_wait_s": self.confirm_wait,
+            "partition": list(self.partition) if self.partition else None,
+        }
+
+
+# Instancia global
+webapp_outbox = WebappOutbox()
@@ -0,0 +1,585 @@
+"""
+Cola durable de mensajes entrantes y modo multiproceso
+
+El webhook responde a Twilio cuando el mensaje ya está guardado en la cola
+durable `inbound_queue` junto con su fila del historial: si el proceso cae
+después, el mensaje se procesa al volver a arrancar (el MessageSid ya está
+reclamado y Twilio no lo reenviaría).
+
+Con INBOUND_PROCESSES = 0 (o sin SQLite) hay una sola partición y la consume
+el pool de workers del propio proceso web.
+
+Con INBOUND_PROCESSES = N > 0 el proceso web (uvicorn) solo recibe: guarda
+cada mensaje con su partición, phone_partition(número, N), y despierta al
+proceso worker de esa partición. Cada proceso worker tiene su propio event
+loop, su pool de workers de mensajes, su cola saliente y su outbox de la
+webapp, y solo atiende a los números de su partición. Así el trabajo de CPU
+(prompts, JSON, SQLite) se reparte entre núcleos.
+
+- Orden por número: un número cae siempre en la misma partición, que se lee
+  en orden de id, y cada número se procesa en serie.
+- Cachés: lo que se cachea por número (contexto reciente, usuario y acción
+  pendiente, goals) vive solo en el proceso de su partición. Ese proceso
+  añade al contexto reciente cada mensaje entrante al sacarlo de la cola (el
+  historial lo escribe el proceso web) y sus propias respuestas al enviarlas.
+  El leaderboard se cachea en cada proceso con su TTL corto.
+- Todos comparten la base de datos (WAL + busy_timeout). Las colas saliente
+  y de la webapp se filtran por partición con la función SQL phone_partition.
+- El ritmo de la cuenta de Twilio se reparte a partes iguales entre los N
+  procesos worker (respuestas) y el proceso web (broadcasts).
+- Cada proceso worker tiene dos pipes con el proceso web: por una recibe los
+  avisos de mensajes nuevos y por la otra envía los eventos del feed de
+  cambios y sus métricas. Entre procesos no se comparte ningún lock ni Event
+  que uno que muera pueda dejar a medias: los contadores de la cola y el
+  aviso de apagado son memoria compartida con un solo escritor.
+- Cada proceso worker tiene sus propios ficheros de respaldo del historial y
+  de los estados de entrega (con el número de partición en el nombre): cada
+  fichero tiene un solo proceso que escribe y lo reinserta al arrancar.
+
+Las peticiones al webhook que llegan a la vez se guardan en una sola
+transacción (group commit) y cada una responde cuando sus filas ya están
+escritas: la de la cola y la del historial, así el intent que asigna después
+el proceso worker siempre encuentra su fila.
+
+Un mensaje se borra de `inbound_queue` cuando su respuesta ya está en la cola
+saliente. Si un proceso worker cae, el supervisor lo relanza y retoma su
+partición desde el principio: lo que estaba a medias se procesa otra vez.
+Lo mismo pasa con todas las particiones al reiniciar el servicio.
+"""
+import asyncio
+import glob
+import importlib
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import time
+from datetime import datetime
+from multiprocessing.connection import wait
+from typing import Optional, Dict, Any, List, Callable
+
+from sqlalchemy import select, insert, update, delete, func
+
+from api_client import api_client
+from change_feed import change_feed
+from command_router import command_router
+from config import config
+from context_cache import context_cache
+from conversation_log import conversation_log
+from database import (
+    AsyncSessionLocal, InboundTaskDB, ConversationHistoryDB, phone_partition, init_async_db, close_async_db
+)
+from delivery_status import delivery_tracker
+from message_queue import MessageWorkerPool, InboundMessage
+from outbound_queue import outbound_queue
+from rate_limit import split_twilio_rate
+from twilio_service import twilio_service
+from webapp_outbox import webapp_outbox
+
+logger = logging.getLogger(__name__)
+
+# Mensajes que un proceso worker lee de su partición en cada consulta
+READ_BATCH = 200
+
+
+def spill_path(path: str, partition: int) -> str:
+    """Fichero de respaldo de una partición: x.spill.jsonl -> x.spill.w3.jsonl"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.w{partition}{ext}"
+
+
+def adopt_orphan_spills(path: str, partitions: int):
+    """
+    Pasa los ficheros de respaldo de particiones que ya no existen (bajó
+    INBOUND_PROCESSES) al de la partición 0, o al del proceso web si no hay
+    procesos worker. Se llama al arrancar, antes de que nadie los lea.
+    """
+    # Las filas no dependen de la partición: cualquier proceso puede reinsertarlas
+    target = spill_path(path, 0) if partitions else path
+    base, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(base) + r"\.w(\d+)" + re.escape(ext) + "$")
+    for orphan in glob.glob(f"{glob.escape(base)}.w*{ext}"):
+        match = pattern.match(orphan)
+        if not match or int(match.group(1)) < partitions:
+            continue
+        with open(orphan, encoding="utf-8") as src, open(target, "a", encoding="utf-8") as dst:
+            dst.write(src.read())
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(orphan)
+        logger.info(f"📥 {orphan} se reinsertará desde {target}")
+
+
+class PartitionedIntake:
+    """Proceso web: guarda los mensajes entrantes y los reparte entre las particiones"""
+
+    def __init__(self, processes: int = None, max_depth: int = None, orchestrator: str = "agents:orchestrator"):
+        self.processes = config.INBOUND_PROCESSES if processes is None else processes
+        self.max_depth = max_depth or config.INBOUND_DURABLE_QUEUE_MAX
+        # "módulo:atributo" que importa quien procesa los turnos
+        self.orchestrator = orchestrator
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._procs: List[multiprocessing.Process] = []
+        # Extremo de lectura de la pipe de eventos de cada proceso (None si el proceso murió)
+        self._channels: list = []
+        # Extremo de escritura (no bloqueante) de la pipe de avisos de cada proceso
+        self._wakeups: list = []
+        # Lo pone a 1 este proceso para que los procesos worker terminen
+        self._stopping_flag = None
+        # Por partición: mensajes guardados (los escribe este proceso) y
+        # terminados (los escribe el proceso worker); la diferencia es la profundidad
+        self._enqueued = None
+        self._done = None
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        # Sin procesos worker: la única partición se consume aquí
+        self._local: Optional[PartitionConsumer] = None
+        # Filas esperando al próximo commit, con el future de cada petición
+        self._batch: List[tuple] = []
+        self._commit_lock = asyncio.Lock()
+        self._worker_stats: Dict[int, Dict[str, Any]] = {}
+        self._stats = {
+            "enqueued": 0,
+            "rejected": 0,
+            "commits": 0,
+            "restarts": 0,
+            "events_forwarded": 0,
+        }
+
+    @property
+    def multiprocess(self) -> bool:
+        # La partición de las colas se calcula con una función registrada en SQLite
+        return self.processes > 0 and config.DATABASE_URL.startswith("sqlite")
+
+    @property
+    def partitions(self) -> int:
+        return self.processes if self.multiprocess else 1
+
+    async def start(self):
+        """Reparte lo que quedó en la cola y lanza un consumidor por partición"""
+        if self.multiprocess:
+            ctx = self._ctx
+            # Aquí solo se envían broadcasts
+            split_twilio_rate(self.processes + 1)
+            self._stopping_flag = ctx.Value("b", 0, lock=False)
+            self._channels = [None] * self.processes
+            self._wakeups = [None] * self.processes
+            self._enqueued = ctx.Array("q", self.processes, lock=False)
+            self._done = ctx.Array("q", self.processes, lock=False)
+            partition = func.phone_partition(InboundTaskDB.phone_number, self.processes)
+        else:
+            self._enqueued = [0]
+            self._done = [0]
+            partition = 0
+
+        async with AsyncSessionLocal() as db:
+            # Por si INBOUND_PROCESSES cambió desde el último arranque
+            await db.execute(update(InboundTaskDB).values(partition=partition))
+            await db.commit()
+            rows = (await db.execute(
+                select(InboundTaskDB.partition, func.count()).group_by(InboundTaskDB.partition)
+            )).all()
+        for partition, count in rows:
+            self._enqueued[partition] = count
+        if rows:
+            logger.info(f"📥 Retomando {sum(c for _, c in rows)} mensajes entrantes pendientes")
+
+        if not self.multiprocess:
+            pool = PartitionPool(load_orchestrator(self.orchestrator), 0, self._done)
+            await pool.start()
+            self._local = PartitionConsumer(pool, 0, self._enqueued, lambda: self._stopping)
+            self._tasks = [asyncio.create_task(self._local.run())]
+            return
+
+        self._procs = [self._spawn(index) for index in range(self.processes)]
+        self._tasks = [
+            asyncio.create_task(self._supervise()),
+            asyncio.create_task(self._drain_events()),
+        ]
+        logger.info(f"✅ {self.processes} procesos worker iniciados")
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        # Pipes nuevas: las de un proceso que murió pueden tener un mensaje a medias
+        reader, writer = self._ctx.Pipe(duplex=False)
+        wakeup_reader, wakeup_writer = self._ctx.Pipe(duplex=False)
+        proc = self._ctx.Process(
+            target=run_worker,
+            args=(index, self.processes, self.orchestrator, self._stopping_flag, self._enqueued, self._done,
+                  writer, wakeup_reader),
+            name=f"whatsapp-worker-{index}",
+            daemon=True
+        )
+        proc.start()
+        # Cada extremo queda solo en un proceso: si el otro muere, se lee EOF
+        writer.close()
+        wakeup_reader.close()
+        self._channels[index] = reader
+        # Un aviso es un byte; con la pipe llena ya hay avisos de sobra sin leer
+        os.set_blocking(wakeup_writer.fileno(), False)
+        if self._wakeups[index] is not None:
+            self._wakeups[index].close()
+        self._wakeups[index] = wakeup_writer
+        return proc
+
+    def _wake(self, index: int):
+        if self._local is not None:
+            self._local.wakeup.set()
+            return
+        try:
+            os.write(self._wakeups[index].fileno(), b"\0")
+        except (BlockingIOError, BrokenPipeError):
+            # Pipe llena (ya tiene avisos pendientes) o proceso caído (el supervisor lo relanza)
+            pass
+
+    async def stop(self, timeout: float = 15.0):
+        """Pide a los consumidores que terminen sus turnos y espera (con límite)"""
+        if self._local is not None:
+            self._stopping = True
+            self._local.wakeup.set()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            await self._local.pool.stop(timeout)
+            self._local = None
+            self._tasks = []
+            return
+        if not self._procs:
+            return
+        self._stopping = True
+        self._stopping_flag.value = 1
+        for index in range(self.processes):
+            self._wake(index)
+        supervisor, drain = self._tasks
+        supervisor.cancel()
+        await asyncio.gather(supervisor, return_exceptions=True)
+
+        # Se siguen leyendo las pipes: un proceso no termina con datos sin enviar
+        deadline = time.monotonic() + timeout
+        for proc in self._procs:
+            await asyncio.to_thread(proc.join, max(0.1, deadline - time.monotonic()))
+            if proc.is_alive():
+                logger.warning(f"⚠️ {proc.name} no terminó a tiempo, se detiene")
+                proc.terminate()
+                await asyncio.to_thread(proc.join, 5)
+        drain.cancel()
+        await asyncio.gather(drain, return_exceptions=True)
+        for wakeup in self._wakeups:
+            wakeup.close()
+        self._procs = []
+        self._tasks = []
+
+    def is_full(self) -> bool:
+        return self.depth() >= self.max_depth
+
+    def depth(self, partition: int = None) -> int:
+        if self._enqueued is None:
+            return 0
+        if partition is not None:
+            return self._enqueued[partition] - self._done[partition]
+        return sum(self._enqueued[:]) - sum(self._done[:])
+
+    async def submit(self, message: InboundMessage) -> bool:
+        """Guarda el mensaje en la cola durable. Devuelve False si está llena."""
+        if self.is_full():
+            self._stats["rejected"] += 1
+            logger.error(f"❌ Cola durable llena, mensaje de {message.phone_number} rechazado")
+            return False
+
+        row = {
+            "partition": phone_partition(message.phone_number, self.partitions),
+            "phone_number": message.phone_number,
+            "body": message.body,
+            "message_sid": message.message_sid,
+            "received_at": message.received_utc,
+        }
+        waiter = asyncio.get_running_loop().create_future()
+        self._batch.append((row, waiter))
+        if len(self._batch) == 1:
+            asyncio.create_task(self._commit())
+        return await waiter
+
+    async def _commit(self):
+        """Escribe en una transacción todo lo que se acumuló mientras esperaba"""
+        async with self._commit_lock:
+            batch, self._batch = self._batch, []
+            if not batch:
+                return
+            history = [
+                {
+                    "phone_number": row["phone_number"],
+                    "message_sid": row["message_sid"] or None,
+                    "direction": "inbound",
+                    "message": row["body"],
+                    "intent": None,
+                    "created_at": row["received_at"],
+                }
+                for row, _ in batch
+            ]
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(insert(InboundTaskDB.__table__), [row for row, _ in batch])
+                    await db.execute(insert(ConversationHistoryDB.__table__), history)
+                    await db.commit()
+            except Exception as e:
+                # El MessageSid ya está reclamado: mejor pedir al usuario que repita
+                logger.error(f"❌ Error guardando {len(batch)} mensajes en la cola durable: {str(e)}")
+                self._stats["rejected"] += len(batch)
+                for _, waiter in batch:
+                    waiter.set_result(False)
+                return
+
+            self._stats["commits"] += 1
+            self._stats["enqueued"] += len(batch)
+            conversation_log.publish(history)
+            # Después del commit: si un proceso ve el contador cambiar, las filas ya se leen
+            for row, _ in batch:
+                self._enqueued[row["partition"]] += 1
+            for partition in {row["partition"] for row, _ in batch}:
+                self._wake(partition)
+            for _, waiter in batch:
+                waiter.set_result(True)
+
+    async def _supervise(self):
+        """Relanza los procesos worker que terminan inesperadamente"""
+        while True:
+            await asyncio.sleep(1.0)
+            for index, proc in enumerate(self._procs):
+                if proc.is_alive() or self._stopping:
+                    continue
+                logger.error(f"❌ {proc.name} terminó (código {proc.exitcode}), se relanza")
+                self._stats["restarts"] += 1
+                self._procs[index] = self._spawn(index)
+
+    async def _drain_events(self):
+        """Eventos del feed y métricas que envían los procesos worker"""
+        while True:
+            channels = [channel for channel in self._channels if channel is not None]
+            for channel in await asyncio.to_thread(wait, channels, 0.5):
+                try:
+                    kind, *payload = channel.recv()
+                except (EOFError, OSError):
+                    # El proceso terminó; al relanzarlo se abre otra pipe
+                    channel.close()
+                    if channel in self._channels:
+                        self._channels[self._channels.index(channel)] = None
+                    continue
+                if kind == "event":
+                    change_feed.publish(*payload)
+                    self._stats["events_forwarded"] += 1
+                elif kind == "stats":
+                    index, stats = payload
+                    self._worker_stats[index] = stats
+
+    def stats(self) -> Dict[str, Any]:
+        if self._local is not None:
+            self._worker_stats[0] = {"inbound_queue": self._local.pool.stats()}
+        return {
+            **self._stats,
+            "processes": self.processes if self.multiprocess else 0,
+            "alive": sum(1 for proc in self._procs if proc.is_alive()),
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "partitions": [
+                {
+                    "partition": index,
+                    "depth": self.depth(index),
+                    **self._worker_stats.get(index, {}),
+                }
+                for index in range(self.partitions)
+            ],
+        }
+
+
+class PartitionPool(MessageWorkerPool):
+    """Pool de una partición: borra de la cola durable cada turno terminado"""
+
+    def __init__(self, orchestrator, partition: int, done):
+        super().__init__(orchestrator)
+        self.partition = partition
+        self._done = done
+
+    def submit(self, message: InboundMessage) -> bool:
+        if not super().submit(message):
+            return False
+        # El historial lo escribió la recepción (no conversation_log): el contexto no lo ha visto
+        context_cache.record(
+            message.phone_number, message.body, "inbound", message.message_sid or None,
+            created_at=message.received_utc
+        )
+        return True
+
+    async def _handle(self, phone_number: str, batch: List[InboundMessage]):
+        await super()._handle(phone_number, batch)
+        # La respuesta (o el mensaje de error) ya está en la cola saliente
+        ids = [m.queue_id for m in batch if m.queue_id is not None]
+        if not ids:
+            return
+        async with AsyncSessionLocal() as db:
+            deleted = (await db.execute(delete(InboundTaskDB).where(InboundTaskDB.id.in_(ids)))).rowcount
+            await db.commit()
+        self._done[self.partition] += deleted
+
+
+class PartitionConsumer:
+    """Pasa los mensajes de una partición de la cola durable a su pool, en orden de id"""
+
+    def __init__(self, pool: PartitionPool, partition: int, enqueued, should_stop: Callable[[], bool]):
+        self.pool = pool
+        self.partition = partition
+        self.enqueued = enqueued
+        self.should_stop = should_stop
+        # Se activa con cada aviso de mensajes nuevos en la partición
+        self.wakeup = asyncio.Event()
+
+    async def run(self):
+        last_id = 0
+        # Valor del contador de la partición en la última lectura completa
+        seen = None
+        while not self.should_stop():
+            # Antes de leer el contador: un aviso posterior no se pierde
+            self.wakeup.clear()
+            enqueued = self.enqueued[self.partition]
+            if enqueued == seen:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                rows = await self._read(last_id)
+            except Exception as e:
+                logger.error(f"❌ Error leyendo la cola durable: {str(e)}")
+                await asyncio.sleep(1.0)
+                continue
+
+            full = False
+            for row in rows:
+                if self.pool.is_full():
+                    full = True
+                    break
+                waited = max(0.0, (datetime.utcnow() - row.received_at).total_seconds())
+                self.pool.submit(InboundMessage(
+                    row.phone_number,
+                    row.body,
+                    row.message_sid or "",
+                    received_at=time.monotonic() - waited,
+                    received_utc=row.received_at,
+                    queue_id=row.id
+                ))
+                last_id = row.id
+
+            if full:
+                # Se relee desde last_id cuando el pool tenga sitio
+                await asyncio.sleep(0.05)
+            elif len(rows) < READ_BATCH:
+                seen = enqueued
+
+    async def _read(self, last_id: int) -> List[InboundTaskDB]:
+        async with AsyncSessionLocal() as db:
+            return list((await db.execute(
+                select(InboundTaskDB)
+                .where(InboundTaskDB.partition == self.partition)
+                .where(InboundTaskDB.id > last_id)
+                .order_by(InboundTaskDB.id)
+                .limit(READ_BATCH)
+            )).scalars().all())
+
+
+class PartitionWorker:
+    """Proceso worker: procesa los mensajes de una partición con su propio event loop"""
+
+    def __init__(self, index: int, total: int, orchestrator: str, stopping, enqueued, done, channel, wakeups):
+        self.index = index
+        self.total = total
+        self.stopping = stopping
+        self.channel = channel
+        self.wakeups = wakeups
+        # True si el proceso web desapareció (EOF en la pipe de avisos)
+        self._orphaned = False
+        self.pool = PartitionPool(load_orchestrator(orchestrator), index, done)
+        self.consumer = PartitionConsumer(
+            self.pool, index, enqueued, lambda: self.stopping.value or self._orphaned
+        )
+
+    def _forward_event(self, event_type: str, phone_number: Optional[str], data: Dict[str, Any]):
+        self.channel.send(("event", event_type, phone_number, data))
+
+    def _on_wakeup(self):
+        # Se leen todos los avisos pendientes de una vez
+        if not os.read(self.wakeups.fileno(), 4096):
+            logger.warning("⚠️ El proceso web ya no está, se termina")
+            asyncio.get_running_loop().remove_reader(self.wakeups.fileno())
+            self._orphaned = True
+        self.consumer.wakeup.set()
+
+    def _report(self):
+        self.channel.send(("stats", self.index, {
+            "pid": os.getpid(),
+            "reported_at": datetime.utcnow().isoformat(),
+            "inbound_queue": self.pool.stats(),
+            "outbound_queue": outbound_queue.stats(),
+            "webapp_outbox": webapp_outbox.stats(),
+            "conversation_log": conversation_log.stats(),
+        }))
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(config.WORKER_STATS_INTERVAL)
+            self._report()
+
+    async def run(self):
+        change_feed.forward_to(self._forward_event)
+        conversation_log.spill_path = spill_path(conversation_log.spill_path, self.index)
+        delivery_tracker.spill_path = spill_path(delivery_tracker.spill_path, self.index)
+        outbound_queue.set_partition(self.index, self.total)
+        split_twilio_rate(self.total + 1)
+        webapp_outbox.set_partition(self.index, self.total)
+
+        await init_async_db()
+        await conversation_log.start()
+        await api_client.start()
+        await twilio_service.start()
+        await delivery_tracker.start()
+        await outbound_queue.start()
+        await webapp_outbox.start()
+        command_router.train_from_history()
+        await self.pool.start()
+        asyncio.get_running_loop().add_reader(self.wakeups.fileno(), self._on_wakeup)
+        reporter = asyncio.create_task(self._report_loop())
+        try:
+            await self.consumer.run()
+        finally:
+            asyncio.get_running_loop().remove_reader(self.wakeups.fileno())
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
+            await self.pool.stop()
+            await webapp_outbox.stop()
+            await outbound_queue.stop()
+            await delivery_tracker.stop()
+            await conversation_log.stop()
+            await api_client.aclose()
+            await twilio_service.aclose()
+            await close_async_db()
+            if not self._orphaned:
+                self._report()
+
+
+def load_orchestrator(path: str):
+    """Importa el orquestador indicado como módulo:atributo"""
+    module, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def run_worker(index: int, total: int, orchestrator: str, stopping, enqueued, done, channel, wakeups):
+    """Punto de entrada de un proceso worker"""
+    # Ctrl+C llega a todo el grupo: el proceso web es quien ordena el apagado
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - worker-{index} - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(PartitionWorker(index, total, orchestrator, stopping, enqueued, done, channel, wakeups).run())
+
+
+# Instancia global
+partitioned_intake = PartitionedIntake()